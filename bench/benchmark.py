@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+
+# End-to-end benchmarks for the tool's subcommands.
+#
+# Each case generates a synthetic corpus, runs tool.py on it in a child
+# process against offline stand-ins (the math model, or the mock-server
+# subcommand with --backend mock-server, and a local page server for
+# download-csv) and records throughput, task latency, peak RSS and CPU time.
+# Results are saved as JSON so that two commits can be compared:
+#
+#   ./bench/benchmark.py run --size medium -o before.json
+#   ./bench/benchmark.py run --size medium -o after.json
+#   ./bench/benchmark.py compare before.json after.json
+
+import argparse
+import datetime
+import http.server
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOOL = os.path.join(ROOT_DIR, "tool.py")
+
+# lines: lines of input for the line based subcommands
+# files, file_lines: size of the folder for prompt-folder and map-reduce
+# urls: rows of the CSV for download-csv
+SIZES = {
+    "small": { "lines": 200, "files": 10, "file_lines": 20, "urls": 20 },
+    "medium": { "lines": 5000, "files": 100, "file_lines": 50, "urls": 200 },
+    "large": { "lines": 50000, "files": 500, "file_lines": 200, "urls": 1000 },
+}
+
+CASES = ["prompt-all", "prompt-folder", "map-reduce", "compute-embeddings", "download-csv"]
+
+# The pool logs one of these when it's joined; see AsyncWorkerPool.latency_summary
+LATENCY_RE = re.compile(r"\[pool\] (\d+) tasks; latency p50=([\d.]+)s p95=([\d.]+)s p99=([\d.]+)s max=([\d.]+)s")
+
+PAGE_TEMPLATE = '<html><body><div class="tablet-content">{paragraphs}</div></body></html>'
+
+def random_expression(rng):
+    terms = [ str(rng.randint(0, 99)) for _ in range(rng.randint(2, 6)) ]
+    expression = terms[0]
+    for term in terms[1:]:
+        expression += rng.choice("+-*") + term
+    return expression
+
+def page_text(index):
+    return [ f"Paragraph {j} of page {index} " + " ".join(f"word{k}" for k in range(40)) for j in range(5) ]
+
+# Writes the inputs for every case into directory.
+def generate_corpus(directory, size, seed):
+    rng = random.Random(seed)
+
+    with open(os.path.join(directory, "prompt.txt"), 'w') as f:
+        f.write("Evaluate each expression and answer with just the result.\n")
+
+    with open(os.path.join(directory, "lines.txt"), 'w') as f:
+        for _ in range(size["lines"]):
+            f.write(random_expression(rng) + "\n")
+
+    folder = os.path.join(directory, "folder")
+    os.mkdir(folder)
+    for i in range(size["files"]):
+        with open(os.path.join(folder, f"BH{i:05}.txt"), 'w') as f:
+            # vary the file sizes so that the scheduling matters
+            for _ in range(rng.randint(1, 2 * size["file_lines"])):
+                f.write(random_expression(rng) + "\n")
+
+    with open(os.path.join(directory, "urls.csv"), 'w') as f:
+        f.write("ID,Url,First line,Word count\n")
+        for i in range(size["urls"]):
+            paragraphs = page_text(i)
+            words = len("\n".join(paragraphs).split(" ")) + len(paragraphs)
+            f.write(f"BH{i:05},https://oceanoflights.org/bench/{i},{paragraphs[0][:40]},{words}\n")
+
+# Serves the pages that download-csv fetches, in the format its
+# oceanoflights.org parser expects.
+class PageHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        index = int(self.path.rstrip("/").split("/")[-1])
+        paragraphs = "".join(f"<p>{text}</p>" for text in page_text(index))
+        body = PAGE_TEMPLATE.format(paragraphs=paragraphs).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_page_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_mock_server(args, directory):
+    port = free_port()
+    command = [sys.executable, TOOL, "mock-server", "--port", str(port), "--latency", str(args.latency),
+               "-o", os.path.join(directory, "mock-server.txt")]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return process, f"http://127.0.0.1:{port}/v1"
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("mock server did not start")
+
+# The command line for a case, and how many units of work it does.
+def case_command(case, directory, size, args, api_base):
+    output = os.path.join(directory, f"{case}.out")
+    gpt = ["-m", "math"] if api_base is None else ["-m", "gpt-3.5-turbo", "--api-base", api_base]
+    common = ["-o", output, "-w", str(args.workers)]
+    prompt = os.path.join(directory, "prompt.txt")
+    folder = os.path.join(directory, "folder")
+
+    if case == "prompt-all":
+        return ["prompt-all", "-i", os.path.join(directory, "lines.txt"), "-p", prompt] + gpt + common, size["lines"], "line"
+    if case == "prompt-folder":
+        return ["prompt-folder", "-i", folder, "-p", prompt] + gpt + common, size["files"], "file"
+    if case == "map-reduce":
+        return ["map-reduce", "-i", folder, "-p", prompt, "-r", prompt] + gpt + common, size["files"], "file"
+    if case == "compute-embeddings":
+        return ["compute-embeddings", "-i", os.path.join(directory, "lines.txt")] + gpt + common, size["lines"], "line"
+    if case == "download-csv":
+        return ["download-csv", "-i", os.path.join(directory, "urls.csv"), "--output-dir", os.path.join(directory, "downloads")] + common, size["urls"], "url"
+    raise ValueError(f"Unknown case {case}")
+
+# Runs command in a child process and returns its wall time, exit code and
+# resource usage.
+def run_child(command, directory, name):
+    with open(os.path.join(directory, f"{name}.stdout"), 'w') as stdout:
+        start = time.monotonic()
+        process = subprocess.Popen(command, stdout=stdout, stderr=subprocess.STDOUT, cwd=ROOT_DIR)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.monotonic() - start
+    # negative for a signal, as subprocess does
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return seconds, process.returncode, usage
+
+def parse_latency(log_filename):
+    best = None
+    try:
+        with open(log_filename, 'r') as f:
+            for match in LATENCY_RE.finditer(f.read()):
+                tasks, p50, p95, p99, maximum = match.groups()
+                # with several pools, report the one that did the most work
+                if best is None or int(tasks) > best["tasks"]:
+                    best = { "tasks": int(tasks), "p50": float(p50), "p95": float(p95), "p99": float(p99), "max": float(maximum) }
+    except OSError:
+        pass
+    return best
+
+def run_case(case, directory, size, args, api_base, page_server):
+    arguments, units, unit = case_command(case, directory, size, args, api_base)
+    # the tool appends to its output and log, so clear them between repeats
+    for filename in [f"{case}.out", f"{case}.out.log"]:
+        if os.path.exists(os.path.join(directory, filename)):
+            os.remove(os.path.join(directory, filename))
+    if case == "download-csv":
+        page_url = f"http://127.0.0.1:{page_server.server_address[1]}"
+        command = [sys.executable, os.path.abspath(__file__), "child", "--pages", page_url, "--"] + arguments
+    else:
+        command = [sys.executable, TOOL] + arguments
+
+    seconds, returncode, usage = run_child(command, directory, case)
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    rss_scale = 1 if sys.platform == "darwin" else 1024
+    return {
+        "unit": unit,
+        "units": units,
+        "seconds": round(seconds, 3),
+        "units_per_second": round(units / seconds, 2) if seconds > 0 else None,
+        "latency": parse_latency(os.path.join(directory, f"{case}.out.log")),
+        "peak_rss_mb": round(usage.ru_maxrss * rss_scale / 1024 / 1024, 1),
+        "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+        "returncode": returncode
+    }
+
+def git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=ROOT_DIR)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+def run(args):
+    size = dict(SIZES[args.size])
+    for key in size:
+        if getattr(args, key) is not None:
+            size[key] = getattr(args, key)
+    cases = args.cases.split(",") if args.cases else CASES
+
+    directory = tempfile.mkdtemp(prefix="bench-")
+    generate_corpus(directory, size, args.seed)
+    page_server = start_page_server()
+    mock_server, api_base = (None, None)
+    if args.backend == "mock-server":
+        mock_server, api_base = start_mock_server(args, directory)
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": { "size": size, "backend": args.backend, "workers": args.workers, "seed": args.seed, "repeat": args.repeat },
+        "cases": {}
+    }
+
+    try:
+        # what every case pays to start the interpreter and import the tool
+        results["startup_seconds"] = round(min(run_child([sys.executable, TOOL], directory, "startup")[0] for _ in range(3)), 3)
+        print(f"Startup: {results['startup_seconds']}s")
+
+        for case in cases:
+            # keep the fastest of the repeats, which is the least noisy
+            runs = [ run_case(case, directory, size, args, api_base, page_server) for _ in range(args.repeat) ]
+            best = min(runs, key=lambda result: result["seconds"])
+            results["cases"][case] = best
+            print_result(case, best)
+    finally:
+        page_server.shutdown()
+        if mock_server is not None:
+            mock_server.terminate()
+            mock_server.wait()
+        if args.keep:
+            print(f"Kept the corpus and logs in {directory}")
+        else:
+            shutil.rmtree(directory)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote {args.output}")
+
+def print_result(case, result):
+    latency = result["latency"]
+    described = f"p50={latency['p50']:.3f}s p95={latency['p95']:.3f}s p99={latency['p99']:.3f}s" if latency else "no task latencies"
+    status = "" if result["returncode"] == 0 else f"  (exit code {result['returncode']})"
+    print(f"{case:>20}: {result['units_per_second']} {result['unit']}s/sec over {result['units']} {result['unit']}s in {result['seconds']}s; "
+          f"{described}; peak RSS {result['peak_rss_mb']} MB; CPU {result['cpu_seconds']}s{status}")
+
+# Compares two result files, flagging changes larger than --threshold.
+def compare(args):
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    with open(args.candidate, 'r') as f:
+        candidate = json.load(f)
+
+    print(f"{baseline.get('commit')} -> {candidate.get('commit')}")
+    regressions = 0
+    # (name, getter, True if bigger is better)
+    metrics = [
+        ("units/sec", lambda r: r["units_per_second"], True),
+        ("p50", lambda r: r["latency"] and r["latency"]["p50"], False),
+        ("p95", lambda r: r["latency"] and r["latency"]["p95"], False),
+        ("p99", lambda r: r["latency"] and r["latency"]["p99"], False),
+        ("peak RSS MB", lambda r: r["peak_rss_mb"], False),
+        ("CPU s", lambda r: r["cpu_seconds"], False),
+    ]
+    for case, new in candidate["cases"].items():
+        old = baseline["cases"].get(case)
+        if old is None:
+            continue
+        print(f"{case}:")
+        for name, get, bigger_is_better in metrics:
+            before, after = get(old), get(new)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = change < -args.threshold if bigger_is_better else change > args.threshold
+            regressions += worse
+            print(f"  {name:>12}: {before:>10} -> {after:>10} ({change:+.1%}){'  REGRESSION' if worse else ''}")
+
+    if regressions:
+        print(f"{regressions} regressions over {args.threshold:.0%}")
+        sys.exit(1)
+
+# Runs tool.py in this process, with the page downloads sent to the local
+# page server instead of the real sites.
+def child(args):
+    sys.path.insert(0, ROOT_DIR)
+    from urllib.parse import urlsplit
+    import tool
+    from src.url_downloader import UrlDownloader
+
+    download_html = UrlDownloader.download_html
+    async def download_local(self, url):
+        return await download_html(self, args.pages + urlsplit(url).path)
+    UrlDownloader.download_html = download_local
+
+    sys.argv = [TOOL] + args.arguments
+    tool.main()
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmarks for tool.py')
+    subparsers = parser.add_subparsers(title='Subcommands')
+
+    parser_run = subparsers.add_parser('run', help='Run the benchmarks')
+    parser_run.add_argument('--size', type=str, default='small', choices=list(SIZES), help='Size of the synthetic corpus.  Defaults to small.')
+    parser_run.add_argument('--lines', type=int, default=None, help='Override the number of input lines.')
+    parser_run.add_argument('--files', type=int, default=None, help='Override the number of files in the folder.')
+    parser_run.add_argument('--file-lines', type=int, default=None, help='Override the average number of lines per file.')
+    parser_run.add_argument('--urls', type=int, default=None, help='Override the number of URLs to download.')
+    parser_run.add_argument('--cases', type=str, default=None, help=f"Comma separated cases to run.  Defaults to all of {','.join(CASES)}.")
+    parser_run.add_argument('--backend', type=str, default='math', choices=['math', 'mock-server'],
+                            help='Answer with the math model, or send requests to the mock-server subcommand.  Defaults to math.')
+    parser_run.add_argument('--latency', type=float, default=0.05, help='Mean latency of the mock server.  Defaults to 0.05.')
+    parser_run.add_argument('-w', '--workers', type=int, default=10, help='Workers to pass to the tool.  Defaults to 10.')
+    parser_run.add_argument('--repeat', type=int, default=1, help='Run each case this many times and keep the fastest.  Defaults to 1.')
+    parser_run.add_argument('--seed', type=int, default=0, help='Seed for the synthetic corpus.  Defaults to 0.')
+    parser_run.add_argument('--keep', action="store_true", help='Keep the corpus and logs.')
+    parser_run.add_argument('-o', '--output', type=str, default=None, help='JSON file to write the results to.')
+    parser_run.set_defaults(func=run)
+
+    parser_compare = subparsers.add_parser('compare', help='Compare two result files')
+    parser_compare.add_argument('baseline', type=str)
+    parser_compare.add_argument('candidate', type=str)
+    parser_compare.add_argument('--threshold', type=float, default=0.1, help='Relative change that counts as a regression.  Defaults to 0.1.')
+    parser_compare.set_defaults(func=compare)
+
+    parser_child = subparsers.add_parser('child')
+    parser_child.add_argument('--pages', type=str, required=True)
+    parser_child.add_argument('arguments', nargs=argparse.REMAINDER)
+    parser_child.set_defaults(func=child)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        sys.exit(1)
+    if args.func == child and args.arguments[:1] == ["--"]:
+        args.arguments = args.arguments[1:]
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,7 @@ class MockLogger:
 
     # Synchronous methods
 
-    def output(self, message):
+    def output(self, message, echo=True):
         self.outputs.append(message)
 
     def log(self, message):
@@ -23,8 +23,8 @@ class MockLogger:
 
     # Asynchronous methods
 
-    async def output_async(self, message):
-        self.output(message)
+    async def output_async(self, message, echo=True):
+        self.output(message, echo)
 
     async def log_async(self, message):
         self.log(message)
@@ -0,0 +1,259 @@
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+import aiohttp
+from tenacity import ( retry, stop_after_attempt, wait_random_exponential )
+
+from src.gpt import evaluate_math
+from src.tokenizer import count_tokens
+
+CHAT_ENDPOINT = "/v1/chat/completions"
+EMBEDDINGS_ENDPOINT = "/v1/embeddings"
+
+# The batch API takes at most this many requests in one file; bigger jobs
+# are split over several batches.
+MAX_REQUESTS = 50000
+
+# Batches are billed at half the usual price.
+BATCH_DISCOUNT = 0.5
+
+# Answers one request of a batch file the way the batch API would, with
+# answer(messages) giving the content of a chat completion and embed(text)
+# an embedding.  For the local backend and the mock server.
+def answer_batch_request(request, answer, embed):
+    body = request["body"]
+    try:
+        if request["url"] == CHAT_ENDPOINT:
+            content = answer(body["messages"])
+            prompt_tokens = sum(count_tokens("math", message["content"] or "") for message in body["messages"])
+            completion_tokens = count_tokens("math", content)
+            response = {
+                "object": "chat.completion",
+                "model": body.get("model"),
+                "choices": [
+                    { "index": i, "message": { "role": "assistant", "content": content }, "finish_reason": "stop" }
+                    for i in range(body.get("n") or 1)
+                ],
+                "usage": { "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens }
+            }
+        else:
+            prompt_tokens = count_tokens("math", body["input"])
+            response = {
+                "object": "list",
+                "model": body.get("model"),
+                "data": [ { "object": "embedding", "index": 0, "embedding": embed(body["input"]) } ],
+                "usage": { "prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens }
+            }
+        status_code = 200
+    except Exception as e:
+        status_code = 400
+        response = { "error": { "message": f"Could not answer: {e}", "type": "invalid_request_error" } }
+
+    return {
+        "id": f"batch_req_{uuid.uuid4().hex}",
+        "custom_id": request["custom_id"],
+        "response": { "status_code": status_code, "request_id": uuid.uuid4().hex, "body": response },
+        "error": None
+    }
+
+# The OpenAI batch API (or a server like the mock server that speaks it,
+# with --api-base): upload the file, create a batch, poll it and download
+# the results.
+class OpenAIBatches:
+
+    def __init__(self, args, logger):
+        self.logger = logger
+        self.api_base = (getattr(args, "api_base", None) or "https://api.openai.com/v1").rstrip("/")
+        api_key = os.getenv('OPENAI_API_KEY')
+        if not api_key or api_key.strip() == '':
+            if not getattr(args, "api_base", None):
+                raise ValueError('Error: OPENAI_API_KEY environment variable is not set or is empty.')
+            api_key = "unused"
+        self.headers = { "Authorization": f"Bearer {api_key}" }
+
+    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
+    async def submit(self, filename, endpoint):
+        async with aiohttp.ClientSession(headers=self.headers) as session:
+            with open(filename, 'rb') as f:
+                form = aiohttp.FormData()
+                form.add_field("purpose", "batch")
+                form.add_field("file", f, filename=os.path.basename(filename), content_type="application/jsonl")
+                async with session.post(f"{self.api_base}/files", data=form) as response:
+                    response.raise_for_status()
+                    input_file = await response.json()
+
+            body = { "input_file_id": input_file["id"], "endpoint": endpoint, "completion_window": "24h" }
+            async with session.post(f"{self.api_base}/batches", json=body) as response:
+                response.raise_for_status()
+                return (await response.json())["id"]
+
+    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
+    async def status(self, batch_id):
+        async with aiohttp.ClientSession(headers=self.headers) as session:
+            async with session.get(f"{self.api_base}/batches/{batch_id}") as response:
+                response.raise_for_status()
+                return await response.json()
+
+    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
+    async def download(self, file_id, filename):
+        async with aiohttp.ClientSession(headers=self.headers) as session:
+            async with session.get(f"{self.api_base}/files/{file_id}/content") as response:
+                response.raise_for_status()
+                with open(filename, 'wb') as f:
+                    async for data in response.content.iter_chunked(1 << 16):
+                        f.write(data)
+
+# A stand-in for the batch API that works on files in a directory, for
+# testing without network access or cost.  Chat requests are answered by
+# the math model and embedding requests with embed (the math model's
+# Embeddings._test_math).  Like the real API, it answers on a later poll and
+# not in the order of the requests.
+class LocalBatches:
+
+    def __init__(self, args, logger, embed=None):
+        self.logger = logger
+        self.embed = embed
+        self.directory = args.output + ".batches"
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, batch_id, suffix):
+        return os.path.join(self.directory, f"{batch_id}.{suffix}")
+
+    def _write_status(self, status):
+        with open(self._path(status["id"], "json"), 'w') as f:
+            json.dump(status, f)
+
+    async def submit(self, filename, endpoint):
+        batch_id = f"batch_local_{uuid.uuid4().hex[:12]}"
+        with open(filename, 'rb') as source, open(self._path(batch_id, "input.jsonl"), 'wb') as target:
+            target.write(source.read())
+        self._write_status({ "id": batch_id, "endpoint": endpoint, "status": "validating", "created_at": int(time.time()) })
+        return batch_id
+
+    async def status(self, batch_id):
+        with open(self._path(batch_id, "json"), 'r') as f:
+            status = json.load(f)
+        if status["status"] == "validating":
+            status = self._process(status)
+        return status
+
+    def _process(self, status):
+        with open(self._path(status["id"], "input.jsonl"), 'r') as f:
+            requests = [ json.loads(line) for line in f if line.strip() ]
+
+        answer = lambda messages: evaluate_math(messages[-1]["content"], self.logger)
+        results = [ answer_batch_request(request, answer, self.embed) for request in requests ]
+        random.Random(status["id"]).shuffle(results)
+        with open(self._path(status["id"], "output.jsonl"), 'w') as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+        failed = sum(1 for result in results if result["response"]["status_code"] != 200)
+        status.update({
+            "status": "completed",
+            "output_file_id": status["id"],
+            "request_counts": { "total": len(results), "completed": len(results) - failed, "failed": failed }
+        })
+        self._write_status(status)
+        return status
+
+    async def download(self, file_id, filename):
+        with open(self._path(file_id, "output.jsonl"), 'rb') as source, open(filename, 'wb') as target:
+            target.write(source.read())
+
+# Runs a set of requests through the batch API instead of one at a time:
+# writes them to a batch file (--batch-file, by default <output>.batch.jsonl),
+# submits it, polls every --batch-poll seconds until it's done and reads the
+# answers back.  Batches are much cheaper and aren't held to the per-minute
+# limits, but may take up to a day.  embed is for the local backend, see
+# LocalBatches.
+class Batch:
+
+    def __init__(self, args, logger, endpoint, embed=None):
+        self.args = args
+        self.logger = logger
+        self.endpoint = endpoint
+        self.filename = args.batch_file or args.output + ".batch.jsonl"
+        self.poll = args.batch_poll
+        self.backend = LocalBatches(args, logger, embed) if args.batch_backend == "local" else OpenAIBatches(args, logger)
+
+        # the model of each request, for pricing the answers
+        self.models = {}
+        self._files = []
+        self._file = None
+        self._count = 0
+
+    def _part_filename(self, part):
+        if part == 0:
+            return self.filename
+        base, extension = os.path.splitext(self.filename)
+        return f"{base}.part{part}{extension}"
+
+    def add(self, custom_id, body):
+        if self._count % MAX_REQUESTS == 0:
+            if self._file is not None:
+                self._file.close()
+            self._files.append(self._part_filename(len(self._files)))
+            self._file = open(self._files[-1], 'w')
+
+        self._file.write(json.dumps({ "custom_id": custom_id, "method": "POST", "url": self.endpoint, "body": body }) + "\n")
+        self.models[custom_id] = body.get("model")
+        self._count += 1
+
+    # Returns { custom_id: response body } for the requests that succeeded.
+    async def run(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._count == 0:
+            return {}
+
+        if self.args.batch_id:
+            batch_ids = self.args.batch_id.split(",")
+            await self.logger.log_async(f"[batch] picking up batch {', '.join(batch_ids)}")
+        else:
+            batch_ids = [ await self.backend.submit(filename, self.endpoint) for filename in self._files ]
+            await self.logger.log_async(f"[batch] submitted {self._count} requests in {', '.join(self._files)} as batch {', '.join(batch_ids)}; "
+                                        f"if this run is interrupted, run it again with --batch-id {','.join(batch_ids)} to pick up the results")
+
+        results = {}
+        for part, batch_id in enumerate(batch_ids):
+            status = await self._wait(batch_id)
+            results_filename = self._part_filename(part) + ".results"
+            if status.get("output_file_id"):
+                await self.backend.download(status["output_file_id"], results_filename)
+                await self._read_results(results_filename, results)
+            if status.get("error_file_id"):
+                await self.backend.download(status["error_file_id"], results_filename + ".errors")
+                await self._read_results(results_filename + ".errors", results)
+
+        await self.logger.log_async(f"[batch] {len(results)} of {self._count} requests answered")
+        return results
+
+    async def _wait(self, batch_id):
+        while True:
+            status = await self.backend.status(batch_id)
+            counts = status.get("request_counts") or {}
+            await self.logger.log_async(f"[batch] {batch_id}: {status['status']} ({counts.get('completed', 0)} of {counts.get('total', '?')} done, {counts.get('failed', 0)} failed)")
+            if status["status"] in [ "completed", "failed", "expired", "cancelled" ]:
+                if status["status"] != "completed":
+                    await self.logger.log_async(f"Error: batch {batch_id} {status['status']}: {status.get('errors')}")
+                return status
+            await asyncio.sleep(self.poll)
+
+    async def _read_results(self, filename, results):
+        with open(filename, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code") == 200:
+                    results[result["custom_id"]] = response["body"]
+                else:
+                    error = result.get("error") or response.get("body", {}).get("error")
+                    await self.logger.log_async(f"Error: no result for {result['custom_id']}: {error}")
@@ -5,6 +5,7 @@ import sys
 
 from src.input import Input
 from src.gpt import GPT
+from src.chat_history import ChatHistory
 from src.worker_pool import AsyncWorkerPool
 
 class Chat:
@@ -39,7 +40,7 @@ class Chat:
         # Load prompt text
         prompt = self.args.prompt
         self.logger.log(f"Prompt: {prompt}")
-        messages = [ { "role": "system", "content": prompt } ] 
+        history = ChatHistory(self.args, self.logger, self.gpt, prompt)
 
         while True:
             # Get the next message
@@ -49,22 +50,42 @@ class Chat:
             if next_message == None:
                 break
 
+            history.append("user", next_message)
+            self.logger.log(f"User: {next_message}")
+
+            if self.args.stream:
+                # Show output as it arrives
+                response = await self.stream_response(await history.window())
+                history.append("assistant", response)
+                self.logger.output(response, echo=False)
+                continue
+
             # Start dot animation
             dots = asyncio.create_task(self.show_dots())
 
-            messages.append( { "role": "user", "content": next_message } )
-            self.logger.log(f"User: {next_message}")
-            response = await self.gpt.query_history(messages)
-            messages.append( { "role": "assistant", "content": response })
+            response = await self.gpt.query_history(await history.window())
+            history.append("assistant", response)
 
             # Show output
             dots.cancel()
             print("")
             self.logger.output(response)
 
+    async def stream_response(self, messages):
+        pieces = []
+        async for piece in self.gpt.stream_history(messages):
+            print(piece, end='', flush=True)
+            pieces.append(piece)
+        print("")
+        return "".join(pieces)
+
 
 
 async def chat(args, logger):
+    # without a budget nothing is ever dropped, so there'd be nothing to summarize
+    if args.summarize_history and not args.history_tokens:
+        logger.fatal_error(Exception("--summarize-history needs --history-tokens."))
+
     gpt = GPT(args, logger)
     manager = Chat(args, logger, gpt)
     await manager.chat()
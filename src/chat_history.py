@@ -0,0 +1,89 @@
+from src.tokenizer import Tokenizer
+
+# Rough per-message overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD = 4
+
+SUMMARY_PROMPT = "Summarize the following conversation between a user and an assistant in a short paragraph.  Keep any names, terms and decisions that later messages might refer to."
+
+# Keeps the messages of a chat and decides which of them to send: the system
+# prompt plus as many of the most recent turns as fit in the token budget.
+# With summarize turned on, turns that fall out of the window are folded into
+# a running summary that is sent after the system prompt.
+class ChatHistory:
+
+    def __init__(self, args, logger, gpt, system_prompt):
+        self.logger = logger
+        self.gpt = gpt
+        self.budget = args.history_tokens
+        self.summarize = args.summarize_history
+        self.tokenizer = Tokenizer(args, logger)
+
+        self.system = self._entry("system", system_prompt)
+        self.summary = None
+
+        # (message, token count) pairs, oldest first.  Counts are computed once
+        # when a message is added and a running total is kept.
+        self.turns = []
+        self.turn_tokens = 0
+
+    def _entry(self, role, content):
+        message = { "role": role, "content": content }
+        return (message, self.tokenizer.count(content) + MESSAGE_OVERHEAD)
+
+    def append(self, role, content):
+        entry = self._entry(role, content)
+        self.turns.append(entry)
+        self.turn_tokens += entry[1]
+
+    def total_tokens(self):
+        total = self.system[1] + self.turn_tokens
+        if self.summary:
+            total += self.summary[1]
+        return total
+
+    # Returns the messages to send, dropping (or summarizing) old turns so
+    # that they fit in the budget.  The latest message is always kept.
+    async def window(self):
+        dropped = self._make_room()
+        while dropped and self.summarize:
+            await self._summarize(dropped)
+            # the new summary takes up room too, so check the budget again
+            dropped = self._make_room()
+
+        if self.summary and self.budget and self.total_tokens() > self.budget:
+            self.logger.log(f"[chat history] dropped the summary to stay within {self.budget} tokens")
+            self.summary = None
+
+        messages = [ self.system[0] ]
+        if self.summary:
+            messages.append(self.summary[0])
+        messages.extend(message for message, _ in self.turns)
+        return messages
+
+    # Drops the oldest turns until the history fits in the budget, returning
+    # the dropped messages.
+    def _make_room(self):
+        dropped = []
+        while self.budget and self.total_tokens() > self.budget and len(self.turns) > 1:
+            dropped.append(self._drop_oldest())
+            # drop the assistant's answer along with the user message
+            if len(self.turns) > 1 and self.turns[0][0]["role"] == "assistant":
+                dropped.append(self._drop_oldest())
+
+        if dropped:
+            self.logger.log(f"[chat history] dropped {len(dropped)} old messages to stay within {self.budget} tokens")
+        return dropped
+
+    def _drop_oldest(self):
+        message, tokens = self.turns.pop(0)
+        self.turn_tokens -= tokens
+        return message
+
+    async def _summarize(self, dropped):
+        transcript = [ f"{message['role']}: {message['content']}" for message in dropped ]
+        if self.summary:
+            transcript.insert(0, self.summary[0]["content"])
+
+        summary = await self.gpt.query(system=SUMMARY_PROMPT, user="\n".join(transcript))
+        self.summary = self._entry("system", f"Summary of the earlier conversation: {summary}")
+        self.logger.log(f"[chat history] {self.summary[0]['content']}")
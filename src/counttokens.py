@@ -1,8 +1,10 @@
-import tiktoken
 import math
+import os
+import numpy as np
 
 from src.input import Input
 from src.logger import Logger
+from src.tokenizer import Tokenizer, count_files
 
 class CountTokens:
 
@@ -10,19 +12,69 @@ class CountTokens:
         self.args = args
         self.logger = logger
         self.data = data
+        self.tokenizer = Tokenizer(args, logger)
 
     def count_tokens(self):
         # Load input text
         input_text = self.data.get_text()
 
-        enc = tiktoken.encoding_for_model(self.args.model)
-
-        total_tokens = len(enc.encode(input_text))
+        total_tokens = self.tokenizer.count(input_text)
 
         # Print result
         self.logger.output(f"Number of tokens: {total_tokens}")
+        self._output_cost(total_tokens)
+
+        return total_tokens
+
+    # Counts the tokens of each line of the input, or of each file if the
+    # input is a directory, in parallel, and prints percentiles and a
+    # histogram of the counts.
+    def count_tokens_report(self):
+        if os.path.isdir(self.args.input):
+            unit = "file"
+            paths = self._get_txt_files(self.args.input)
+            counts = np.fromiter(self.tokenizer.count_parallel(paths, self.args.processes, counter=count_files, batch_size=16), dtype=np.int64)
+            for path, count in zip(paths, counts):
+                self.logger.output(f"{os.path.basename(path)}: {count}")
+        else:
+            unit = "line"
+            counts = np.fromiter(self.tokenizer.count_parallel(self.data.iter_lines(), self.args.processes), dtype=np.int64)
+
+        total_tokens = int(counts.sum())
+        self.logger.output(f"Number of tokens: {total_tokens}")
+        if len(counts) > 0:
+            p50, p90, p95, p99 = np.percentile(counts, [50, 90, 95, 99])
+            self.logger.output(f"Tokens per {unit} over {len(counts)} {unit}s: mean={counts.mean():.1f} p50={p50:.0f} p90={p90:.0f} p95={p95:.0f} p99={p99:.0f} max={counts.max()}")
+            for line in self._histogram(counts):
+                self.logger.output(line)
+        self._output_cost(total_tokens)
 
-        # Calculate and print costs
+        return counts
+
+    # Histogram with power-of-two buckets: 0, 1, 2-3, 4-7, ...
+    def _histogram(self, counts, width=40):
+        edges = [0, 1]
+        while edges[-1] <= counts.max():
+            edges.append(edges[-1] * 2)
+        frequencies, _ = np.histogram(counts, bins=edges)
+
+        lines = []
+        for low, high, frequency in zip(edges, edges[1:], frequencies):
+            label = str(low) if high - low == 1 else f"{low}-{high-1}"
+            bar = "#" * math.ceil(width * frequency / frequencies.max())
+            lines.append(f"  {label:>12}: {frequency:>8} {bar}")
+        return lines
+
+    def _get_txt_files(self, foldername):
+        txt_files = []
+        for f in sorted(os.scandir(foldername), key=lambda f: f.name):
+            if f.name.endswith(".txt"):
+                filename = os.path.join(foldername, f.name)
+                txt_files.append(filename)
+        return txt_files
+
+    # Calculate and print costs
+    def _output_cost(self, total_tokens):
         ktokens=math.ceil(total_tokens/1000)
         if self.args.model == "gpt-4":
             cost = round(ktokens*0.03,2)
@@ -31,9 +83,10 @@ class CountTokens:
             cost = round(ktokens*0.002,2)
             self.logger.output("GPT-3.5 prompting cost @ $0.002/1K tokens = $" + str(cost))
 
-        return total_tokens
-
 async def count_tokens(args, logger):
     data = Input(args, logger)
     ct = CountTokens(args, logger, data)
-    ct.count_tokens()
+    if args.per_line or os.path.isdir(args.input):
+        ct.count_tokens_report()
+    else:
+        ct.count_tokens()
@@ -92,7 +92,7 @@ class CsvDownloader:
         csv_rows = csv_rows[1:]
 
         # start the worker pool
-        pool = AsyncWorkerPool(worker_count=self.workers, logger=self.logger)
+        pool = AsyncWorkerPool(worker_count=self.workers, logger=self.logger, task_timeout=self.args.task_timeout)
         await pool.start()
 
         # launch the jobs
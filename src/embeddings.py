@@ -3,25 +3,37 @@ import functools
 import asyncio
 import os
 import json
+import time
 import numpy as np
 
-from collections import Counter
+from collections import Counter, OrderedDict
 
+from src.batch import Batch, BATCH_DISCOUNT, EMBEDDINGS_ENDPOINT
+from src.gpt import api_options
 from src.input import Input
+from src.metrics import registry
+from src.warm_state import warm_state
 from tenacity import ( retry, stop_after_attempt, wait_random_exponential )
 
+# How many recent embeddings to keep, so that looking up the nearest example
+# and the translation memory for the same text only costs one request
+CACHE_SIZE = 1000
+
 class Embeddings:
 
     def __init__(self,args,logger):
         self.logger = logger
         self.usage = 0
+        self._cache = OrderedDict()
 
         # this is used to determine if we should be in test mode
         self.model = args.model
 
+        self.api_options = api_options(args)
+
         # check that the API key is valid
         api_key = os.getenv('OPENAI_API_KEY')
-        if self.model == "math":
+        if self.model == "math" or self.api_options:
             return
 
         if not api_key or api_key.strip() == '':
@@ -39,22 +51,64 @@ class Embeddings:
     async def query(self, text):
         if self.model == "math":
             return self._test_math(text)
-        else:
-            return await self._get_embedding(text)
-
-    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-    async def _get_embedding(self,text):
-        response = openai.Embedding.create(
-            input=text,
-            model="text-embedding-ada-002"
-        )
-        embedding = response["data"][0]["embedding"]
+        if text in self._cache:
+            self._cache.move_to_end(text)
+            return self._cache[text]
+
+        async with warm_state.request_slot():
+            embedding = (await self._get_embeddings([text]))[0]
+        self._remember(text, embedding)
+        return embedding
+
+    # Embeds several texts with one request (the API takes a list of inputs).
+    # The embeddings are cached as well, so query() for any of the texts
+    # afterwards doesn't make another request.
+    async def query_batch(self, texts):
+        if self.model == "math":
+            return [ self._test_math(text) for text in texts ]
+
+        missing = list(dict.fromkeys(text for text in texts if text not in self._cache))
+        if missing:
+            async with warm_state.request_slot():
+                embeddings = await self._get_embeddings(missing)
+            for text, embedding in zip(missing, embeddings):
+                self._remember(text, embedding)
+        return [ self._cache[text] if text in self._cache else await self.query(text) for text in texts ]
+
+    def _remember(self, text, embedding):
+        self._cache[text] = embedding
+        self._cache.move_to_end(text)
+        if len(self._cache) > CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    # The API call blocks, so it runs in a thread like GPT's do; otherwise it
+    # would hold up the whole event loop while it's in flight.
+    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6), before_sleep=registry.retry_counter("embedding"))
+    async def _get_embeddings(self, texts):
+        stub = functools.partial(openai.Embedding.create, input=texts, model="text-embedding-ada-002", **self.api_options)
+        loop = asyncio.get_running_loop()
+        registry.increment("embedding_requests_total")
+        start = time.monotonic()
+        response = await loop.run_in_executor(None, stub)
+        embeddings = [ data["embedding"] for data in sorted(response["data"], key=lambda data: data["index"]) ]
+        registry.observe("embedding_request_seconds", time.monotonic() - start)
         self.usage += response["usage"]["prompt_tokens"]
+        registry.increment("embedding_tokens_total", response["usage"]["prompt_tokens"])
 
         cost = self.get_cost()
         self.logger.log(f"[Embeddings] usage: {self.usage}.  Cost: ${cost}.")
 
-        return embedding
+        return embeddings
+
+    # The body of a request for text in a batch file (see src/batch.py).
+    def batch_body(self, text):
+        return { "model": "text-embedding-ada-002", "input": text }
+
+    # The embedding in the body of a batch response, counting its usage.
+    def read_batch_response(self, body):
+        self.usage += body["usage"]["prompt_tokens"]
+        registry.increment("embedding_tokens_total", body["usage"]["prompt_tokens"])
+        return body["data"][0]["embedding"]
 
     # This function is so that we can test against a "mock" GPT without incurring costs
     def _test_math(self, input_string):
@@ -91,10 +145,29 @@ class Embeddings:
         # Compute the cosine similarity between two arrays
         return np.dot(array1,array2)
 
+# With --batch every line is sent in one batch job (see src/batch.py) and
+# the embeddings are written out in order once it's done.
+async def compute_embeddings_batch(args, logger, data, embeddings):
+    batch = Batch(args, logger, EMBEDDINGS_ENDPOINT, embed=embeddings._test_math)
+    count = 0
+    for index, line in enumerate(data.iter_lines()):
+        batch.add(str(index), embeddings.batch_body(line))
+        count += 1
+
+    results = await batch.run()
+    for index in range(count):
+        if str(index) in results:
+            logger.output(json.dumps(embeddings.read_batch_response(results[str(index)])))
+        else:
+            logger.output("null")
+    logger.log(f"[Embeddings] usage: {embeddings.usage}.  Cost at batch prices: ${round(embeddings.get_cost() * BATCH_DISCOUNT, 2)}.")
+
 async def compute_embeddings(args, logger):
     data = Input(args, logger)
     embeddings = Embeddings(args, logger)
-    lines = data.get_text_lines()
-    for line in lines:
+    if args.batch:
+        await compute_embeddings_batch(args, logger, data, embeddings)
+        return
+    for line in data.iter_lines():
         embedding = await embeddings.query(line)
         logger.output(json.dumps(embedding))
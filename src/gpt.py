@@ -1,10 +1,157 @@
 import openai
 import functools
 import asyncio
+import json
 import os
+import re
+import time
+import traceback
+
+from collections import deque
 
 from tenacity import ( retry, stop_after_attempt, wait_random_exponential )
 
+from src.metrics import registry
+from src.tokenizer import Tokenizer
+from src.tracing import tracer
+from src.warm_state import NO_LIMIT, warm_state
+
+# Dollars per 1K tokens
+PRICING = {
+    "gpt-4": {
+        "prompt": 0.03,
+        "completion": 0.06
+    },
+    "gpt-3.5-turbo": {
+        "prompt": 0.002,
+        "completion": 0.002
+    },
+    "math": {
+        "prompt": 0,
+        "completion": 0
+    }
+}
+
+# How many recent request latencies to keep for picking the hedging delay,
+# and how many we need before we start hedging at all.
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+
+# Evaluates each line of problems as an arithmetic expression.  This is the
+# "math" model, which is also what the mock server answers with.
+def evaluate_math(problems, logger):
+    safe_env = {
+        '__builtins__': {},
+        'min': min,
+        'max': max
+    }
+    try:
+        exprs = [ expr for expr in problems.split("\n") if expr ]
+        logger.debug(f"exprs={exprs}")
+        outputs = map(lambda e : str(eval(e, safe_env)), exprs)
+        return "\n".join(outputs)
+    except Exception as e:
+        logger.log(f"Error evaluating expression: {expr}")
+        logger.log(traceback.format_exc())
+        raise e
+
+# Extra arguments for the API calls when --api-base points somewhere other
+# than OpenAI, e.g. at the mock server.  Such servers may not need a key.
+def api_options(args):
+    api_base = getattr(args, "api_base", None)
+    if not api_base:
+        return {}
+    options = { "api_base": api_base }
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key or api_key.strip() == '':
+        options["api_key"] = "unused"
+    return options
+
+# Keeps requests within a requests-per-minute and tokens-per-minute budget
+# by waiting until enough of the last minute's requests have aged out.
+class RateLimiter:
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._sent = deque()
+        self._tokens = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens=0):
+        if not self.rpm and not self.tpm:
+            return
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._sent and self._sent[0][0] <= now - 60:
+                    self._tokens -= self._sent.popleft()[1]
+
+                # a single request bigger than the whole tpm budget still goes, on its own
+                requests_ok = not self.rpm or len(self._sent) < self.rpm
+                tokens_ok = not self.tpm or self._tokens + tokens <= self.tpm or not self._sent
+                if requests_ok and tokens_ok:
+                    break
+                await asyncio.sleep(self._sent[0][0] + 60 - now)
+
+            self._sent.append((now, tokens))
+            self._tokens += tokens
+
+# One entry of --routes: requests whose user message matches it go to its
+# model, with at most concurrency of them in flight and within its rpm and
+# tpm.  A route matches when the message has at least min_input_tokens and
+# at most max_input_tokens tokens and contains pattern (a regular
+# expression); conditions that aren't given always hold.
+class Route:
+
+    KEYS = [ "model", "min_input_tokens", "max_input_tokens", "pattern", "concurrency", "rpm", "tpm" ]
+
+    def __init__(self, spec):
+        unknown = [ key for key in spec if key not in Route.KEYS ]
+        if unknown:
+            raise ValueError(f"Error: unknown keys in route {spec}: {', '.join(unknown)}")
+
+        self.model = spec["model"]
+        self.min_input_tokens = spec.get("min_input_tokens")
+        self.max_input_tokens = spec.get("max_input_tokens")
+        self.pattern = re.compile(spec["pattern"]) if spec.get("pattern") else None
+        self.slots = asyncio.Semaphore(spec["concurrency"]) if spec.get("concurrency") else NO_LIMIT
+        self.limiter = RateLimiter(spec.get("rpm"), spec.get("tpm"))
+
+        # recent request latencies, for the hedging delay; kept per route
+        # since the models of different routes answer at different speeds
+        self.latencies = deque(maxlen=HEDGE_WINDOW)
+
+    def matches(self, text, count_tokens):
+        if self.pattern is not None and not self.pattern.search(text):
+            return False
+        if self.min_input_tokens is None and self.max_input_tokens is None:
+            return True
+        tokens = count_tokens(text)
+        if self.min_input_tokens is not None and tokens < self.min_input_tokens:
+            return False
+        return self.max_input_tokens is None or tokens <= self.max_input_tokens
+
+# The routes in the --routes JSON file, a list of objects with the keys of
+# Route, e.g.
+#
+#   [ { "model": "gpt-3.5-turbo", "max_input_tokens": 40, "concurrency": 20 },
+#     { "model": "gpt-4", "concurrency": 5, "rpm": 200 } ]
+def load_routes(args):
+    filename = getattr(args, "routes", None)
+    if not filename:
+        return []
+    with open(filename, 'r') as f:
+        specs = json.load(f)
+    if not isinstance(specs, list):
+        raise ValueError(f"Error: {filename} should hold a list of routes")
+    for spec in specs:
+        # the models we know the prices of
+        if spec.get("model") not in PRICING:
+            raise ValueError(f"Error: route {spec} needs a model, one of {', '.join(PRICING)}")
+    return [ Route(spec) for spec in specs ]
+
 class GPT:
 
     def __init__(self,args,logger):
@@ -14,14 +161,34 @@ class GPT:
         self.max_tokens = args.max_tokens
         self.n = args.gpt_n
         self.logger = logger
+        self.tokenizer = Tokenizer(args, logger)
 
         self.prompt_tokens = 0
         self.completion_tokens = 0
         self.total_tokens = 0
+        self.usage_by_model = {}
+
+        # requests that match none of the --routes go to --model
+        self.routes = load_routes(args)
+        self.default_route = Route({ "model": self.model })
+
+        # hedging: if a request is slower than the given percentile of recent
+        # requests, send a duplicate and take whichever answers first
+        self.hedge_percentile = args.hedge_percentile
+        self.hedge_budget = args.hedge_budget
+        self.requests = 0
+        self.hedged_requests = 0
+
+        # identical requests that are in flight at the same time share one call
+        self._in_flight = {}
+        self.coalesced_requests = 0
+
+        self.api_options = api_options(args)
 
         # check that the API key is valid
         api_key = os.getenv('OPENAI_API_KEY')
-        if self.model == "math":
+        models = [ self.model ] + [ route.model for route in self.routes ]
+        if all(model == "math" for model in models) or self.api_options:
             return
 
         if not api_key or api_key.strip() == '':
@@ -30,29 +197,18 @@ class GPT:
 
 
 
-    def get_pricing(self):
-        if self.model == "gpt-4":
-            return {
-                    "prompt": 0.03,
-                    "completion": 0.06
-                }
-        elif self.model == "gpt-3.5-turbo":
-             return {
-                    "prompt": 0.002,
-                    "completion": 0.002
-                }
-        elif self.model == "math":
-            return {
-                    "prompt": 0,
-                    "completion": 0
-                }
-           
-    def get_cost(self):
-        usage = self.get_usage()
-        prompt_cost = usage["prompt"]*self.get_pricing()["prompt"]/1000
-        completion_cost = usage["completion"]*self.get_pricing()["completion"]/1000
-        total_cost = round(prompt_cost + completion_cost,2)
-        return total_cost
+    def get_pricing(self, model=None):
+        return PRICING.get(model or self.model)
+
+    def get_cost(self, model=None):
+        models = [ model ] if model else self.usage_by_model
+        total_cost = 0
+        for model in models:
+            usage = self.usage_by_model.get(model, { "prompt": 0, "completion": 0 })
+            prompt_cost = usage["prompt"]*self.get_pricing(model)["prompt"]/1000
+            completion_cost = usage["completion"]*self.get_pricing(model)["completion"]/1000
+            total_cost += prompt_cost + completion_cost
+        return round(total_cost,2)
 
     def get_usage(self):
         return {
@@ -62,8 +218,8 @@ class GPT:
         }
 
 
-    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-    async def query(self, system, user):
+    @staticmethod
+    def messages(system, user):
         msgs=[]
 
         if system is not None:
@@ -71,51 +227,241 @@ class GPT:
         if user is not None:
             msgs.append({"role": "user", "content": user })
 
-        return await self._query(msgs)
+        return msgs
+
+    async def query(self, system, user):
+        return await self._single_flight(GPT.messages(system, user))
 
-    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
     async def query_history(self, messages):
-        return await self._query(messages)
+        return await self._single_flight(messages)
+
+    # If an identical request is already in flight (e.g. a repeated line in
+    # prompt-all) we wait for its answer instead of sending another one.
+    # Not when sampling (n > 1 or top_p < 1), since then each caller expects
+    # answers of its own.
+    async def _single_flight(self, messages):
+        if self.n > 1 or self.top_p < 1:
+            with tracer.span("gpt", shared=False):
+                return await self._query_with_retry(messages)
+
+        key = json.dumps(messages, sort_keys=True)
+        flight = self._in_flight.get(key)
+        shared = flight is not None
+        if flight is None:
+            # the request and how many callers are waiting for it
+            flight = self._in_flight[key] = [ asyncio.ensure_future(self._query_with_retry(messages)), 0 ]
+            flight[0].add_done_callback(lambda f: self._in_flight.pop(key) if self._in_flight.get(key) is flight else None)
+        else:
+            self.coalesced_requests += 1
+            self.logger.log(f"[GPT] sharing an identical in-flight request ({self.coalesced_requests} shared so far)")
+
+        # shielded so that one caller timing out doesn't cancel the others;
+        # once every caller has gone (e.g. after --task-timeout) it's cancelled
+        # so that it doesn't keep retrying for nobody
+        future = flight[0]
+        flight[1] += 1
+        try:
+            with tracer.span("gpt", shared=shared):
+                return await asyncio.shield(future)
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not future.done():
+                # the request may take a while to wind down (see _create);
+                # later callers send a new one rather than join it
+                if self._in_flight.get(key) is flight:
+                    self._in_flight.pop(key)
+                future.cancel()
+
+    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6), before_sleep=registry.retry_counter("gpt"))
+    async def _query_with_retry(self, messages):
+        with tracer.span("gpt attempt"):
+            async with warm_state.request_slot():
+                return await self._query(messages)
+
+    # The first of the --routes that the user message matches, or the
+    # route to --model.
+    def _route(self, messages):
+        text = messages[-1]["content"]
+        for route in self.routes:
+            if route.matches(text, self.tokenizer.count):
+                return route
+        return self.default_route
 
     async def _query(self, messages):
-        if self.model == "math":
+        route = self._route(messages)
+        if route.model == "math":
             return self._test_math(messages[-1]["content"])
 
         self.logger.debug("Messages=")
         self.logger.debug(messages)
-        self.logger.debug(f"model={self.model}, top_p={self.top_p}, best_of={self.best_of}, n={self.n}")
+        self.logger.debug(f"model={route.model}, top_p={self.top_p}, best_of={self.best_of}, n={self.n}")
 
-        stub = functools.partial(openai.ChatCompletion.create, model=self.model, top_p=self.top_p, messages=messages, n=self.n)
-        loop = asyncio.get_running_loop()
-        result = await loop.run_in_executor(None, stub)
+        self.requests += 1
+        if self.hedge_percentile:
+            result = await self._hedged_create(messages, route)
+        else:
+            result = await self._create(messages, route)
 
-        self.prompt_tokens = self.prompt_tokens + result.usage["prompt_tokens"]
-        self.completion_tokens = self.completion_tokens + result.usage["completion_tokens"]
-        self.total_tokens = self.total_tokens + result.usage["total_tokens"]
-        usage = self.get_usage()
-        cost = self.get_cost()
-        self.logger.log(f"[GPT] usage: {self.get_usage()}.  Cost: ${cost}.")
+        self._add_usage(result.usage["prompt_tokens"], result.usage["completion_tokens"], route.model)
 
         self.logger.debug(result.choices)
         return result.choices[0].message["content"]
 
+    def _add_usage(self, prompt_tokens, completion_tokens, model=None):
+        model = model or self.model
+        self.prompt_tokens = self.prompt_tokens + prompt_tokens
+        self.completion_tokens = self.completion_tokens + completion_tokens
+        self.total_tokens = self.total_tokens + prompt_tokens + completion_tokens
+
+        usage = self.usage_by_model.setdefault(model, { "prompt": 0, "completion": 0, "total": 0 })
+        usage["prompt"] += prompt_tokens
+        usage["completion"] += completion_tokens
+        usage["total"] += prompt_tokens + completion_tokens
+
+        registry.increment("gpt_prompt_tokens_total", prompt_tokens)
+        registry.increment("gpt_completion_tokens_total", completion_tokens)
+        cost = self.get_cost()
+        self.logger.log(f"[GPT] usage: {self.get_usage()}.  Cost: ${cost}.")
+        if self.routes:
+            by_model = "; ".join(f"{model}: {usage}, ${self.get_cost(model)}" for model, usage in self.usage_by_model.items())
+            self.logger.log(f"[GPT] usage by model: {by_model}")
+
+    # What to count against a route's tpm: the tokens of the messages plus
+    # as many again for the answer.
+    def _estimate_tokens(self, messages, route):
+        if not route.limiter.tpm:
+            return 0
+        return 2 * sum(self.tokenizer.count(message["content"]) for message in messages)
+
+    # Like query, but yields the answer in pieces as they arrive.
+    async def stream(self, system, user):
+        async for piece in self.stream_history(GPT.messages(system, user)):
+            yield piece
+
+    # Like query_history, but yields the answer in pieces as they arrive.
+    # Only opening the stream is retried, since by the time a later chunk
+    # fails the caller has already seen the earlier ones.
+    async def stream_history(self, messages):
+        route = self._route(messages)
+        if route.model == "math":
+            yield self._test_math(messages[-1]["content"])
+            return
+
+        self.logger.debug("Messages=")
+        self.logger.debug(messages)
+        self.logger.debug(f"model={route.model}, top_p={self.top_p}, stream=True")
+
+        loop = asyncio.get_running_loop()
+        chunks = await self._open_stream(messages, route)
+        pieces = []
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                break
+            content = chunk["choices"][0]["delta"].get("content")
+            if content:
+                pieces.append(content)
+                yield content
+
+        # streamed responses don't report usage, so we count the tokens ourselves
+        prompt_tokens = sum(self.tokenizer.count(message["content"]) for message in messages)
+        completion_tokens = self.tokenizer.count("".join(pieces))
+        self._add_usage(prompt_tokens, completion_tokens, route.model)
+
+    # The stream holds on to one of the route's slots only while it's being
+    # opened, since the API counts concurrent requests as they arrive.
+    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6), before_sleep=registry.retry_counter("gpt"))
+    async def _open_stream(self, messages, route):
+        stub = functools.partial(openai.ChatCompletion.create, model=route.model, top_p=self.top_p, messages=messages, stream=True, **self.api_options)
+        async with route.slots:
+            await route.limiter.acquire(self._estimate_tokens(messages, route))
+            registry.increment("gpt_requests_total")
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, stub)
+
+    # Sends one request to the API, keeping track of how long it took.  If
+    # this is cancelled (the losing half of a hedged request), the thread
+    # carries on sending the request, so we hold on to the route's slot until
+    # it's done and still count how long it took: otherwise the latencies
+    # would only hold the winners and the hedging delay would keep dropping.
+    async def _create(self, messages, route):
+        stub = functools.partial(openai.ChatCompletion.create, model=route.model, top_p=self.top_p, messages=messages, n=self.n, **self.api_options)
+        loop = asyncio.get_running_loop()
+        async with route.slots:
+            await route.limiter.acquire(self._estimate_tokens(messages, route))
+            start = time.monotonic()
+            registry.increment("gpt_requests_total")
+            request = loop.run_in_executor(None, stub)
+            try:
+                return await asyncio.shield(request)
+            finally:
+                while not request.done():
+                    try:
+                        await asyncio.wait([request])
+                    except asyncio.CancelledError:
+                        pass
+                if request.exception() is None:
+                    route.latencies.append(time.monotonic() - start)
+                    registry.observe("gpt_request_seconds", route.latencies[-1])
+
+    # The body of a request for messages in a batch file (see src/batch.py),
+    # sent to the model of the route it matches.
+    def batch_body(self, messages):
+        route = self._route(messages)
+        return { "model": route.model, "messages": messages, "top_p": self.top_p, "n": self.n }
+
+    # The answer in the body of a batch response, counting its usage against
+    # model, the model the request was sent to.  The response names a
+    # versioned model (e.g. gpt-4-0613) that isn't in PRICING.
+    def read_batch_response(self, body, model):
+        self._add_usage(body["usage"]["prompt_tokens"], body["usage"]["completion_tokens"], model)
+        return body["choices"][0]["message"]["content"]
+
+    # The delay after which we send a duplicate of a request on route, or
+    # None if we don't have enough samples for it yet.
+    def _hedge_delay(self, route):
+        if len(route.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(route.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))
+        return ordered[index]
+
+    # Caps the duplicate requests at hedge_budget (e.g. 0.05 = 5%) of all requests.
+    def _can_hedge(self):
+        return self.hedged_requests + 1 <= self.hedge_budget * self.requests
+
+    async def _hedged_create(self, messages, route):
+        primary = asyncio.ensure_future(self._create(messages, route))
+        attempts = [primary]
+        try:
+            delay = self._hedge_delay(route)
+            if delay is not None:
+                done, _ = await asyncio.wait(attempts, timeout=delay)
+                if not done and self._can_hedge():
+                    self.hedged_requests += 1
+                    self.logger.log(f"[GPT] no answer after {delay:.1f}s; sending hedged request ({self.hedged_requests} of {self.requests} requests hedged)")
+                    attempts.append(asyncio.ensure_future(self._create(messages, route)))
+
+            # take the first successful answer; only fail if every attempt failed
+            pending = set(attempts)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        return attempt.result()
+                if not pending:
+                    raise done.pop().exception()
+        finally:
+            # The losing request can't be stopped once it's on the wire, so
+            # the API may still bill for it even though we don't count its
+            # usage here; see _create for its slot and latency.
+            for attempt in attempts:
+                attempt.cancel()
+
 
     # This function is so that we can test against a "mock" GPT without incurring costs
     def _test_math(self, problems):
-        safe_env = {
-            '__builtins__': {},
-            'min': min,
-            'max': max
-        }
-        try:
-            exprs = [ expr for expr in problems.split("\n") if expr ]
-            self.logger.debug(f"exprs={exprs}")
-            outputs = map(lambda e : str(eval(e, safe_env)), exprs)
-            return "\n".join(outputs)
-        except Exception as e:
-            self.logger.log(f"Error evaluating expression: {expr}")
-            self.logger.log(traceback.format_exc())
-            raise e
+        return evaluate_math(problems, self.logger)
 
         
 
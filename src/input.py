@@ -2,6 +2,8 @@ import os
 import sys
 import traceback
 
+from src.line_index import LineIndex
+
 class Input:
 
     def __init__(self, args, logger):
@@ -14,6 +16,36 @@ class Input:
     def get_text(self):
         return '\n'.join(self._extract_text())
 
+    # Yields the relevant lines one at a time without reading the whole file
+    # into memory.  Line ranges (-L) are looked up through a LineIndex.
+    def iter_lines(self):
+        try:
+            if not self.args.lines:
+                with open(self.args.input, 'r') as f:
+                    yield from f
+                return
+
+            index = LineIndex(self.args.input, self.logger)
+            ranges = self._parse_ranges(index.line_count)
+        except Exception as e:
+            self.logger.fatal_error(e)
+            return
+
+        for start, end in ranges:
+            yield from index.read_lines(start, end)
+
+    # How many lines iter_lines() will yield, or None if the input can't be
+    # read.  Only -L needs the LineIndex; otherwise the lines are just counted.
+    def count_lines(self):
+        try:
+            if not self.args.lines:
+                with open(self.args.input, 'r') as f:
+                    return sum(1 for _ in f)
+            index = LineIndex(self.args.input, self.logger)
+            return sum(end - start + 1 for start, end in self._parse_ranges(index.line_count))
+        except Exception:
+            return None
+
     # Opens the input file and pulls out the relevant lines
     def _extract_text(self):
         try:
@@ -30,24 +62,32 @@ class Input:
             self.logger.fatal_error(e)
 
     def _filter_lines(self, lines):
+        filtered_lines = []
+        for start, end in self._parse_ranges(len(lines)):
+            filtered_lines.extend(lines[start-1:end])
+
+        return filtered_lines
+
+    # Turns the --lines argument into a list of (start, end) pairs, 1-based
+    # and inclusive, checking them against the number of lines in the file.
+    def _parse_ranges(self, line_count):
         if not self.args.lines:
             raise ValueError("Line numbers or range must be provided")
             
-        filtered_lines = []
+        ranges = []
         parts = self.args.lines.split(',')
 
         for part in parts:
             if '-' in part:
                 start, end = map(int, part.split('-'))
-                if start < 1 or end > len(lines) or start > end:
+                if start < 1 or end > line_count or start > end:
                     raise ValueError(f"Invalid line range: {part}")
-                filtered_lines.extend(lines[start-1:end])
+                ranges.append((start, end))
             else:
                 n = int(part)
-                if n < 1 or n > len(lines):
+                if n < 1 or n > line_count:
                     raise ValueError(f"Invalid line number: {part}")
-                filtered_lines.append(lines[n-1])
-
-        return filtered_lines
+                ranges.append((n, n))
 
+        return ranges
 
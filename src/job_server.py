@@ -0,0 +1,171 @@
+import asyncio
+import contextlib
+import io
+import itertools
+import os
+import tempfile
+import time
+import traceback
+
+from aiohttp import web
+
+from src.logger import Logger
+from src.warm_state import warm_state
+
+# Subcommands that serve runs as jobs
+SERVED_COMMANDS = [ "prompt-all", "prompt-folder", "map-reduce" ]
+
+# Options that name files; they're relative to the directory of whoever
+# submitted the job, not to the server's.
+PATH_OPTIONS = [ "input", "input_dir", "output", "logfile", "prompt", "map_prompt", "reduce_prompt",
+                 "examples_in", "examples_out", "examples_embeddings", "wordlist", "map_store", "job_queue", "translation_memory",
+                 "previous_input", "previous_output", "routes", "batch_file" ]
+
+# Options that act on the whole process, so they can only be given to serve
+# itself, where they cover every job.
+SERVER_OPTIONS = { "profile": "--profile", "trace": "--trace", "metrics_interval": "--metrics-interval",
+                   "metrics_port": "--metrics-port", "shards": "--shards", "shard_worker": "--shard-worker" }
+
+def default_socket():
+    return os.path.join(tempfile.gettempdir(), f"gpt-translation-tools-{os.getuid()}.sock")
+
+class JobError(Exception):
+    pass
+
+# A long-running process that runs prompt-all, prompt-folder and map-reduce
+# jobs sent to it over HTTP on a Unix socket.  The process (and with it the
+# imports, tiktoken's encodings and the API client's connections) stays up
+# between jobs, parsed examples and wordlists are kept in warm_state, and
+# the jobs share one budget of --workers requests in flight.
+#
+#   POST /jobs    body {"argv": ["prompt-all", "-i", ...], "cwd": "/home/..."};
+#                 answers when the job is done
+#   GET  /status  the jobs that are running and the cache statistics
+class JobServer:
+
+    def __init__(self, args, logger, parser):
+        self.args = args
+        self.logger = logger
+        self.parser = parser
+        self.socket = args.socket or default_socket()
+        self.running = {}
+        self.finished = 0
+        self.failed = 0
+        self._ids = itertools.count(1)
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post('/jobs', self._submit)
+        app.router.add_get('/status', self._status)
+        return app
+
+    async def _submit(self, request):
+        try:
+            body = await request.json()
+            argv = body["argv"]
+            cwd = body.get("cwd") or os.getcwd()
+        except Exception:
+            return web.json_response({ "status": "error", "error": 'expected a JSON body like {"argv": [...], "cwd": "..."}' }, status=400)
+
+        id = next(self._ids)
+        start = time.monotonic()
+        try:
+            job_args = self.parse_job(argv, cwd)
+        except JobError as e:
+            self.logger.log(f"[serve] job {id} rejected: {e}")
+            return web.json_response({ "status": "error", "id": id, "error": str(e) }, status=400)
+
+        self.running[id] = argv
+        try:
+            error = await self.run_job(id, argv, job_args)
+        finally:
+            del self.running[id]
+
+        seconds = time.monotonic() - start
+        if error is None:
+            self.finished += 1
+            return web.json_response({ "status": "done", "id": id, "output": job_args.output, "seconds": seconds })
+        self.failed += 1
+        return web.json_response({ "status": "error", "id": id, "output": job_args.output, "seconds": seconds, "error": error })
+
+    async def _status(self, request):
+        return web.json_response({
+            "running": { str(id): argv for id, argv in self.running.items() },
+            "finished": self.finished,
+            "failed": self.failed,
+            "cache": { "hits": warm_state.hits, "misses": warm_state.misses }
+        })
+
+    # Parses a job's command line the way tool.py would, with its paths
+    # made absolute against cwd.
+    def parse_job(self, argv, cwd):
+        if not argv or argv[0] not in SERVED_COMMANDS:
+            raise JobError(f"only {', '.join(SERVED_COMMANDS)} can be submitted")
+
+        # argparse reports bad arguments on stderr and exits
+        errors = io.StringIO()
+        try:
+            with contextlib.redirect_stderr(errors):
+                job_args = self.parser.parse_args(argv)
+        except SystemExit:
+            raise JobError(errors.getvalue().strip().splitlines()[-1])
+
+        for name, option in SERVER_OPTIONS.items():
+            if getattr(job_args, name, None):
+                raise JobError(f"{option} can't be used with a submitted job; give it to serve instead")
+
+        for name in PATH_OPTIONS:
+            value = getattr(job_args, name, None)
+            if isinstance(value, str):
+                setattr(job_args, name, os.path.join(cwd, value))
+        return job_args
+
+    # Runs one job with its own log and output files.  Returns None, or a
+    # description of what went wrong.
+    async def run_job(self, id, argv, job_args):
+        logger = Logger(job_args)
+        self.logger.log(f"[serve] job {id}: {' '.join(argv)}")
+        logger.log(f"[serve] job {id}: {' '.join(argv)}")
+        logger.log("")
+        start = time.monotonic()
+        try:
+            await job_args.func(job_args, logger)
+        except SystemExit:
+            # a fatal error, already written to the job's output and log
+            error = f"job failed; see {logger.log_filename}"
+        except Exception as e:
+            logger.log(traceback.format_exc())
+            error = f"{type(e).__name__}: {e}"
+        else:
+            error = None
+
+        duration = int(time.monotonic() - start)
+        logger.log(f"Total duration: {duration} seconds")
+        self.logger.log(f"[serve] job {id} {'failed: ' + error if error else 'done'} after {duration} seconds")
+        return error
+
+async def serve(args, logger):
+    server = JobServer(args, logger, args.job_parser)
+    if os.path.exists(server.socket):
+        # left behind by a server that's gone, unless one still answers on it
+        try:
+            _, writer = await asyncio.open_unix_connection(server.socket)
+            writer.close()
+            logger.fatal_error(Exception(f"Another server is already listening on {server.socket}"))
+        except OSError:
+            os.remove(server.socket)
+
+    warm_state.start(args.workers)
+    runner = web.AppRunner(server.make_app())
+    await runner.setup()
+    await web.UnixSite(runner, server.socket).start()
+    logger.output(f"Serving jobs on {server.socket} (submit them with ./submit.py)")
+
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await runner.cleanup()
+        warm_state.stop()
+        if os.path.exists(server.socket):
+            os.remove(server.socket)
@@ -0,0 +1,98 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+# Every STRIDE-th line start is recorded, so finding a line means one seek
+# plus reading at most STRIDE-1 lines, and the index stays small.
+INDEX_STRIDE = 1024
+
+# Where the indexes are saved: a directory of our own in the temporary
+# directory, so that nothing is written next to the input files.
+def index_directory():
+    return os.path.join(tempfile.gettempdir(), f"gpt-translation-tools-{os.getuid()}-lineidx")
+
+# Sparse index of the byte offsets at which lines start in a text file.  It's
+# saved in index_directory() and rebuilt whenever the file's size or
+# modification time changes, so that reading a range of lines from a big file
+# doesn't require scanning the whole file each time.  Lines are numbered the
+# way open(path, 'r') reads them: they end at "\n", "\r\n" or a lone "\r".
+class LineIndex:
+
+    def __init__(self, path, logger):
+        self.path = os.path.abspath(path)
+        self.logger = logger
+        name = hashlib.sha256(self.path.encode('utf-8')).hexdigest()
+        self.index_path = os.path.join(index_directory(), f"{name}.lineidx")
+
+        if not self._load():
+            self._build()
+            self._save()
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if data.get("path") != self.path or [data.get("size"), data.get("mtime_ns")] != list(self._stat()) or data.get("stride") != INDEX_STRIDE:
+            return False
+
+        self.line_count = data["lines"]
+        self.offsets = data["offsets"]
+        return True
+
+    def _build(self):
+        self.logger.debug(f"[line index] indexing {self.path}")
+        self.offsets = []
+        self.line_count = 0
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                # a binary line only ends at "\n"; split it further at lone "\r"s
+                ending = 2 if line.endswith(b'\r\n') else 1 if line.endswith(b'\n') else 0
+                pieces = line[:len(line) - ending].split(b'\r')
+                lengths = [ len(piece) + 1 for piece in pieces[:-1] ]
+                if pieces[-1] or ending:
+                    lengths.append(len(pieces[-1]) + ending)
+                for length in lengths:
+                    if self.line_count % INDEX_STRIDE == 0:
+                        self.offsets.append(offset)
+                    offset += length
+                    self.line_count += 1
+
+    def _save(self):
+        size, mtime_ns = self._stat()
+        data = {
+            "path": self.path,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "stride": INDEX_STRIDE,
+            "lines": self.line_count,
+            "offsets": self.offsets
+        }
+        try:
+            os.makedirs(index_directory(), exist_ok=True)
+            with open(self.index_path, 'w') as f:
+                json.dump(data, f)
+        except OSError as e:
+            # the index is only an optimization, so carry on without saving it
+            self.logger.debug(f"[line index] could not save {self.index_path}: {e}")
+
+    # Yields lines start through end (1-based, inclusive) as text, like readlines() would.
+    def read_lines(self, start, end):
+        with open(self.path, 'rb') as raw:
+            raw.seek(self.offsets[(start - 1) // INDEX_STRIDE])
+            # universal newlines from here on, as in _build, and the same
+            # (locale) encoding as open(path, 'r') in Input
+            with io.TextIOWrapper(raw) as f:
+                for _ in range((start - 1) % INDEX_STRIDE):
+                    f.readline()
+                for _ in range(end - start + 1):
+                    yield f.readline()
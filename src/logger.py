@@ -13,13 +13,15 @@ class Logger:
 
     # Synchronous methods
 
-    def output(self, message):
+    # echo=False skips printing, e.g. when the message was already streamed to the terminal
+    def output(self, message, echo=True):
         with open(self.output_filename, 'a') as output_file:
             output_file.write(str(message) + '\n')
             output_file.flush()
 
         self.log(message)
-        print(message)
+        if echo:
+            print(message)
 
     def log(self, message):
         with open(self.log_filename, 'a') as log_file:
@@ -42,13 +44,14 @@ class Logger:
 
     # Asynchronous methods
 
-    async def output_async(self, message):
+    async def output_async(self, message, echo=True):
         async with aiofiles.open(self.output_filename, 'a') as output_file:
             await output_file.write(str(message) + '\n')
             await output_file.flush()
 
         await self.log_async(message)
-        print(message)
+        if echo:
+            print(message)
 
     async def log_async(self, message):
         async with aiofiles.open(self.log_filename, 'a') as log_file:
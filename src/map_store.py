@@ -0,0 +1,83 @@
+import asyncio
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+# Outputs are committed in groups of this many rather than one at a time.
+COMMIT_EVERY = 100
+
+# On-disk store of map-reduce map outputs, keyed by the file id, the line
+# index, a hash of the map prompt and a hash of the line itself.  Re-running
+# with a different reduce prompt, or after editing a few lines, only needs
+# the map calls for lines that aren't in the store yet.
+#
+# The database is only used from a thread of its own, so that lookups and
+# commits don't hold up the event loop; outputs that haven't been committed
+# yet are committed by close().
+class MapStore:
+
+    def __init__(self, path, logger):
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        self._uncommitted = 0
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._executor.submit(self._open, path).result()
+
+    def _open(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS map_outputs (
+                fileid TEXT NOT NULL,
+                line INTEGER NOT NULL,
+                prompt_hash TEXT NOT NULL,
+                line_hash TEXT NOT NULL,
+                output TEXT NOT NULL,
+                PRIMARY KEY (fileid, line, prompt_hash, line_hash)
+            )""")
+        self.connection.commit()
+
+    async def _run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    def hash(self, text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    async def get(self, fileid, line, prompt_hash, line_hash):
+        return await self._run(self._get, fileid, line, prompt_hash, line_hash)
+
+    def _get(self, fileid, line, prompt_hash, line_hash):
+        row = self.connection.execute(
+            "SELECT output FROM map_outputs WHERE fileid=? AND line=? AND prompt_hash=? AND line_hash=?",
+            (fileid, line, prompt_hash, line_hash)).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return row[0]
+
+    async def put(self, fileid, line, prompt_hash, line_hash, output):
+        await self._run(self._put, fileid, line, prompt_hash, line_hash, output)
+
+    def _put(self, fileid, line, prompt_hash, line_hash, output):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO map_outputs (fileid, line, prompt_hash, line_hash, output) VALUES (?, ?, ?, ?, ?)",
+            (fileid, line, prompt_hash, line_hash, output))
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_EVERY:
+            self.connection.commit()
+            self._uncommitted = 0
+
+    def _close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def close(self):
+        self._executor.submit(self._close).result()
+        self._executor.shutdown()
@@ -7,14 +7,21 @@ import os
 from src.input import Input
 from src.logger import Logger
 from src.gpt import GPT
-from src.worker_pool import AsyncWorkerPool
+from src.planner import Planner
+from src.map_store import MapStore
+from src.worker_pool import AsyncWorkerPool, PRIORITY_HIGH, PRIORITY_NORMAL
 from src.template import Template
-from src.translation_helper import TranslationHelper
+from src.tracing import tracer
+from src.tokenizer import Tokenizer
+from src.translation_helper import TranslationHelper, prompt_hash
 
 # Idea is that we are given:
 # (1) an input folder of texts
 # (2) a "map" prompt which is applied to each line individually of each text
 # (3) a "reduce" prompt that is applied to the outputs of the mapping step
+#
+# If the outputs of the mapping step don't fit in one reduce request, they're
+# reduced in chunks and the partial results are reduced again (a tree reduce).
 
 class MapReduce:
     def __init__(self, args, logger, gpt):
@@ -22,14 +29,21 @@ class MapReduce:
         self.logger = logger
         self.gpt = gpt
         self.workers = args.workers
+        self.schedule = args.schedule
+        self.reduce_tokens = args.reduce_tokens
 
         self._output_data = {}
         self._map_done = {}
-        self._output_lock = {}
-        self._global_lock = asyncio.Lock()
+        self._remaining = {}
+        self._partials = {}
 
+        self.tokenizer = Tokenizer(args, logger)
         self.translation_helper = TranslationHelper(args, logger)
 
+        self.map_store = None
+        if args.map_store:
+            self.map_store = MapStore(args.map_store, logger)
+
     async def map_reduce(self):
         # Get the list of files
         file_data = []
@@ -52,6 +66,10 @@ class MapReduce:
         except e:
             self.logger.fatal_error(e)
 
+        # Stored map outputs are only reused for the same map prompt and model
+        if self.map_store:
+            self.map_prompt_hash = prompt_hash(self.args, self.map_prompt)
+
         # Get the reduce prompt
         try:
             with open(self.args.reduce_prompt, 'r') as f:
@@ -60,15 +78,23 @@ class MapReduce:
             self.logger.fatal_error(e)
 
         # Setup the pool
-        self.pool = AsyncWorkerPool(self.workers, self.logger)
+        self.pool = AsyncWorkerPool(self.workers, self.logger, task_timeout=self.args.task_timeout)
         await self.pool.start()
 
         # Run the mapping step for each file in its own queue
         #  (once some finish it will invoke the reduce step)
-        for data in file_data:
-            await self._start_map_jobs(data["id"], data["path"])
-
-        await self.pool.join()
+        try:
+            for data in file_data:
+                await self._start_map_jobs(data["id"], data["path"])
+
+            await self.pool.join()
+        finally:
+            # if the run is cut short (cancelled, or a fatal error reading a
+            # file) the workers are stopped and what's been mapped is committed
+            await self.pool.stop()
+            if self.map_store:
+                await self.logger.log_async(f"[map store] reused {self.map_store.hits} map outputs, computed {self.map_store.misses}")
+                self.map_store.close()
 
     def _get_txt_files(self, foldername):
         txt_files = []
@@ -91,75 +117,119 @@ class MapReduce:
         for line in file_contents:
             original_length += self._count_words(line)
 
+        # setup the data structures before any of the map jobs can finish
+        self._output_data[fileid] = {}
+        self._remaining[fileid] = len(file_contents)
+        self._map_done[fileid] = False
+
+        # with largest-first scheduling, lines of the biggest files are mapped first
+        priority = PRIORITY_NORMAL
+        if self.schedule == "largest-first":
+            priority = -sum(len(line) for line in file_contents)
+
         for index, line in enumerate(file_contents): 
             callback = functools.partial(self._map_callback, fileid=fileid, index=index, total_lines=len(file_contents), original_length = original_length)
-            await self.pool.add_task(self._map, line, fileid, index, callback=callback)
+            await self.pool.add_task(self._map, line, fileid, index, callback=callback, priority=priority)
 
 
     async def _map(self, text, fileid, index):
-        # TODO: check if data is in cache
+        if self.map_store:
+            line_hash = self.map_store.hash(text)
+            stored = await self.map_store.get(fileid, index, self.map_prompt_hash, line_hash)
+            if stored is not None:
+                await self.logger.log_async(f"[_map] reusing stored output for fileid={fileid} index={index}")
+                return stored
 
         variables = await self.translation_helper.get_variables(text, fileid)
-        template = Template(self.args, self.logger, self.map_prompt)
-        prompt = template.expand(variables)
+        with tracer.span("template"):
+            template = Template(self.args, self.logger, self.map_prompt)
+            prompt = template.expand(variables)
 
         await self.logger.log_async("[_map] prompt: " + prompt)
         result = await self.gpt.query(prompt, text)
         result = result.replace("\n","\t")
-        return result
-
 
+        if self.map_store:
+            await self.map_store.put(fileid, index, self.map_prompt_hash, line_hash, result)
 
-    async def _map_callback(self, result, fileid, index, total_lines, original_length):
-        
-        # setup the data structures if we haven't already
-        if not fileid in self._output_data:
+        return result
 
-            # only acquire global lock if we're touching the data structures
-            async with self._global_lock:
 
-                # check the condition again
-                if not fileid in self._output_data:
-                    self._map_done[fileid] = False
-                    self._output_data[fileid] = {}
-                    self._output_lock[fileid] = asyncio.Lock()
 
+    async def _map_callback(self, result, fileid, index, total_lines, original_length):
         ourmap = self._output_data[fileid]
+
+        # count down the lines still to be mapped; there's no await between
+        # the check and the update, so this is atomic on the event loop
+        if index not in ourmap:
+            self._remaining[fileid] -= 1
         ourmap[index] = result
         await self.logger.log_async(f"[_map_callback] fileid={fileid} index={index} output={result}")
 
-        # TODO: write data to cache
-
-        async with self._output_lock[fileid]:
-
-            hasIndex = [ i in ourmap for i in range(total_lines) ]
-            hasAll = all(hasIndex)
-            self.logger.debug(f"fileId={fileid} hasIndex={hasIndex} hasAll={hasAll} self._map_done[fileid]={self._map_done[fileid]}")
-
-            if hasAll and not self._map_done[fileid]:
-                self.logger.debug(f"Queue reduce for {fileid}")
-                self._map_done[fileid] = True
-                lines = [ ourmap[i] for i in range(total_lines) ]
-                
-                # queue reduce job
-                await self.pool.add_task(self._reduce, fileid, lines, original_length, callback=None)
-
-
+        hasAll = self._remaining[fileid] == 0
+        if hasAll and not self._map_done[fileid]:
+            self.logger.debug(f"Queue reduce for {fileid}")
+            self._map_done[fileid] = True
+            lines = [ ourmap[i] for i in range(total_lines) ]
+            await self._queue_reduce(fileid, lines, original_length, level=0)
+
+    # Queues the reduce jobs for a file, ahead of any remaining map jobs.  If
+    # the outputs and the reduce prompt don't fit in --reduce-tokens the
+    # outputs are split into chunks that are reduced in parallel, and
+    # _partial_callback reduces the partial results one level up until
+    # everything fits in a single reduce.
+    async def _queue_reduce(self, fileid, outputs, original_length, level):
+        # jobs that failed or timed out have no output
+        outputs = [ output for output in outputs if output is not None ]
+
+        # at least two outputs per chunk, so each level makes progress
+        budget = self.reduce_tokens - self.tokenizer.count(self._reduce_prompt_for(fileid))
+        chunks = self.tokenizer.pack(outputs, budget, min_pieces=2)
+        if len(chunks) <= 1:
+            await self.pool.add_task(self._reduce, fileid, outputs, original_length, callback=None, priority=PRIORITY_HIGH - level)
+            return
+
+        await self.logger.log_async(f"[_queue_reduce] fileid={fileid} level={level}: reducing {len(outputs)} outputs in {len(chunks)} chunks")
+        self._partials[(fileid, level)] = { "remaining": len(chunks), "results": {} }
+        for index, chunk in enumerate(chunks):
+            callback = functools.partial(self._partial_callback, fileid=fileid, level=level, index=index, total=len(chunks), original_length=original_length)
+            await self.pool.add_task(self._reduce_chunk, fileid, chunk, callback=callback, priority=PRIORITY_HIGH - level)
+
+    async def _partial_callback(self, result, fileid, level, index, total, original_length):
+        partial = self._partials[(fileid, level)]
+        if index not in partial["results"]:
+            partial["remaining"] -= 1
+        partial["results"][index] = result
+        await self.logger.log_async(f"[_partial_callback] fileid={fileid} level={level} index={index} output={result}")
+
+        if partial["remaining"] == 0:
+            del self._partials[(fileid, level)]
+            results = [ partial["results"][i] for i in range(total) ]
+            await self._queue_reduce(fileid, results, original_length, level + 1)
 
     # Applies the reduce prompt to the mapped data and returns the final output.
     async def _reduce(self, fileid, mapped_outputs, original_length):
+        result = await self._reduce_chunk(fileid, mapped_outputs)
+        with tracer.span("output"):
+            self.logger.output(f"REDUCTION FOR {fileid}: {result}")
+        return result
 
-
+    # The reduce prompt expanded for a file.
+    def _reduce_prompt_for(self, fileid):
         variables = {
             "AUTHOR": self.translation_helper.id_to_author(fileid)
         }
-        template = Template(self.args, self.logger, self.reduce_prompt)
-        prompt = template.expand(variables)
+        with tracer.span("template"):
+            template = Template(self.args, self.logger, self.reduce_prompt)
+            return template.expand(variables)
+
+    # Applies the reduce prompt to some of the outputs for a file.
+    async def _reduce_chunk(self, fileid, outputs):
+        prompt = self._reduce_prompt_for(fileid)
         await self.logger.log_async(f"[_reduce] prompt: {prompt}")
-        data = "\n".join(mapped_outputs)
+        data = "\n".join(outputs)
         result = await self.gpt.query(system=prompt, user=data)
         result = result.replace("\n","\t")
-        self.logger.output(f"REDUCTION FOR {fileid}: {result}")
         return result
 
     def _count_words(self, text):
@@ -167,6 +237,11 @@ class MapReduce:
 
 
 async def map_reduce(args, logger):
+    if args.dry_run:
+        planner = Planner(args, logger)
+        await planner.plan_map_reduce(MapReduce(planner.mock_args, logger, None))
+        return
+
     gpt = GPT(args, logger)
     manager = MapReduce(args, logger, gpt)
     await manager.map_reduce()
@@ -0,0 +1,212 @@
+import asyncio
+import json
+import os
+import time
+
+from collections import deque
+
+import numpy as np
+from aiohttp import web
+
+# Rates are worked out over this many seconds of recent snapshots
+RATE_WINDOW = 60
+
+# How many recent latencies each percentile is computed from
+LATENCY_WINDOW = 1000
+
+# Counters and gauges that the worker pool, GPT and Embeddings update as they
+# go.  There's one registry per process (see `registry` below) so that the
+# pieces don't need to be handed a reference; a MetricsReporter started by
+# --metrics-interval or --metrics-port turns it into progress lines, a JSON
+# file and Prometheus text.
+class Metrics:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.enabled = False
+        self.start_time = time.monotonic()
+        self.counters = {}
+        self.gauges = {}
+        self.latencies = {}
+        self.expected_tasks = None
+        self._history = deque()
+
+    def increment(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add(self, name, amount):
+        self.gauges[name] = self.gauges.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        if name not in self.latencies:
+            self.latencies[name] = deque(maxlen=LATENCY_WINDOW)
+        self.latencies[name].append(seconds)
+
+    # For subcommands that know up front how many tasks there will be, so
+    # the ETA doesn't have to rely on the queue (which may be bounded).
+    def expect_tasks(self, count):
+        self.expected_tasks = count
+
+    # A tenacity before_sleep callback that counts the retries of name.
+    def retry_counter(self, name):
+        def before_sleep(retry_state):
+            self.increment(f"{name}_retries_total")
+        return before_sleep
+
+    def percentiles(self, name):
+        latencies = self.latencies.get(name)
+        if not latencies:
+            return None
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        return { "p50": p50, "p95": p95, "p99": p99 }
+
+    def _rate(self, name, now):
+        # compare against the oldest snapshot still in the window
+        if self._history:
+            then, counters = self._history[0]
+        else:
+            then, counters = self.start_time, {}
+        if now <= then:
+            return 0.0
+        return (self.counters.get(name, 0) - counters.get(name, 0)) / (now - then)
+
+    # Everything in one dict, which is also what the metrics file holds.
+    def snapshot(self):
+        now = time.monotonic()
+        while self._history and self._history[0][0] < now - RATE_WINDOW:
+            self._history.popleft()
+
+        completions_per_second = self._rate("tasks_completed_total", now)
+        tokens_per_second = self._rate("gpt_prompt_tokens_total", now) + self._rate("gpt_completion_tokens_total", now)
+        snapshot = {
+            "time": time.time(),
+            "elapsed_seconds": now - self.start_time,
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "rates": {
+                "tasks_completed_per_second": completions_per_second,
+                "gpt_requests_per_second": self._rate("gpt_requests_total", now),
+                "gpt_tokens_per_second": tokens_per_second,
+                "embedding_requests_per_second": self._rate("embedding_requests_total", now)
+            },
+            "latency_seconds": { name: self.percentiles(name) for name in self.latencies },
+            "eta_seconds": self._eta(completions_per_second)
+        }
+        self._history.append((now, dict(self.counters)))
+        return snapshot
+
+    def _eta(self, completions_per_second):
+        if self.expected_tasks is not None:
+            remaining = self.expected_tasks - self.counters.get("tasks_completed_total", 0)
+        else:
+            remaining = self.gauges.get("tasks_queued", 0) + self.gauges.get("tasks_in_flight", 0)
+        if remaining <= 0:
+            return 0
+        if completions_per_second <= 0:
+            return None
+        return remaining / completions_per_second
+
+registry = Metrics()
+
+# Prints a progress line and rewrites <output>.metrics.json every
+# --metrics-interval seconds, and serves the registry in the Prometheus
+# text format on --metrics-port.
+class MetricsReporter:
+
+    def __init__(self, args, logger):
+        self.logger = logger
+        self.interval = args.metrics_interval
+        self.port = args.metrics_port
+        self.filename = args.output + ".metrics.json"
+        self._task = None
+        self._runner = None
+
+    async def start(self):
+        registry.reset()
+        registry.enabled = True
+        if self.interval:
+            self._task = asyncio.create_task(self._report_loop())
+        if self.port:
+            app = web.Application()
+            app.router.add_get('/metrics', self._serve)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+            self.logger.log(f"[metrics] serving http://127.0.0.1:{self.port}/metrics")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._runner is not None:
+            await self._runner.cleanup()
+        self.report()
+        registry.enabled = False
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.report()
+
+    def report(self):
+        snapshot = registry.snapshot()
+        line = progress_line(snapshot)
+        self.logger.log(line)
+        print(line)
+
+        # written to a temporary file and renamed so readers never see half a file
+        temporary = self.filename + ".tmp"
+        with open(temporary, 'w') as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(temporary, self.filename)
+
+    async def _serve(self, request):
+        return web.Response(text=prometheus_text(registry.snapshot()), content_type="text/plain")
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{int(seconds/3600)}h {int(seconds%3600/60)}m {seconds%60}s"
+
+# e.g. "[metrics] tasks: 120 done, 10 in flight, 20 queued, 3.2/s | GPT: 130 requests, 2 retries, 850 tokens/s, p50=1.20s p95=3.10s p99=4.00s | ETA 0h 5m 12s"
+def progress_line(snapshot):
+    counters, gauges, rates = snapshot["counters"], snapshot["gauges"], snapshot["rates"]
+    parts = [ f"tasks: {counters.get('tasks_completed_total', 0)} done, {gauges.get('tasks_in_flight', 0)} in flight, "
+              f"{gauges.get('tasks_queued', 0)} queued, {rates['tasks_completed_per_second']:.1f}/s" ]
+
+    if counters.get("gpt_requests_total"):
+        gpt = f"GPT: {counters['gpt_requests_total']} requests, {counters.get('gpt_retries_total', 0)} retries, {rates['gpt_tokens_per_second']:.0f} tokens/s"
+        latency = snapshot["latency_seconds"].get("gpt_request_seconds")
+        if latency:
+            gpt += f", p50={latency['p50']:.2f}s p95={latency['p95']:.2f}s p99={latency['p99']:.2f}s"
+        parts.append(gpt)
+
+    if counters.get("embedding_requests_total"):
+        parts.append(f"embeddings: {counters['embedding_requests_total']} requests, {counters.get('embedding_retries_total', 0)} retries")
+
+    eta = snapshot["eta_seconds"]
+    parts.append(f"ETA {format_duration(eta)}" if eta is not None else "ETA unknown")
+    return "[metrics] " + " | ".join(parts)
+
+def prometheus_text(snapshot):
+    lines = []
+    for name, value in sorted(snapshot["counters"].items()):
+        lines.append(f"# TYPE gpttools_{name} counter")
+        lines.append(f"gpttools_{name} {value}")
+    for name, value in sorted(snapshot["gauges"].items()):
+        lines.append(f"# TYPE gpttools_{name} gauge")
+        lines.append(f"gpttools_{name} {value}")
+    for name, value in sorted(snapshot["rates"].items()):
+        lines.append(f"# TYPE gpttools_{name} gauge")
+        lines.append(f"gpttools_{name} {value}")
+    for name, quantiles in sorted(snapshot["latency_seconds"].items()):
+        if quantiles is None:
+            continue
+        lines.append(f"# TYPE gpttools_{name} summary")
+        for key, quantile in [("p50", "0.5"), ("p95", "0.95"), ("p99", "0.99")]:
+            lines.append(f'gpttools_{name}{{quantile="{quantile}"}} {quantiles[key]}')
+    if snapshot["eta_seconds"] is not None:
+        lines.append("# TYPE gpttools_eta_seconds gauge")
+        lines.append(f"gpttools_eta_seconds {snapshot['eta_seconds']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,274 @@
+import asyncio
+import copy
+import json
+import math
+import random
+import re
+import time
+
+from collections import deque
+
+from aiohttp import web
+
+from src.batch import answer_batch_request
+from src.embeddings import Embeddings
+from src.gpt import evaluate_math
+from src.tokenizer import count_tokens
+
+# A local stand-in for the OpenAI API, speaking enough of the chat
+# completions (including streaming) and embeddings protocols for GPT and
+# Embeddings to be pointed at it with --api-base.  Answers are deterministic
+# (the math model, or an echo of the last message), while latency, rate
+# limits and errors can be configured to load-test the real I/O path.
+#
+# It also takes batches (files and batches), which are kept in memory and
+# finish on the second time their status is asked for.
+class MockServer:
+
+    def __init__(self, args, logger):
+        self.args = args
+        self.logger = logger
+        self.random = random.Random(args.seed)
+
+        math_args = copy.copy(args)
+        math_args.model = "math"
+        self.embeddings = Embeddings(math_args, logger)
+
+        # throughput cap: requests past this many at once wait their turn
+        self.concurrency = asyncio.Semaphore(args.concurrency) if args.concurrency else None
+
+        # (time, tokens) of the requests accepted in the last minute, for --rpm and --tpm
+        self._window = deque()
+
+        self.stats = { "requests": 0, "ok": 0, "429": 0, "500": 0, "400": 0 }
+
+        # uploaded and result files by id, and batches by id
+        self.files = {}
+        self.batches = {}
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.chat_completions)
+        app.router.add_post('/v1/embeddings', self.embeddings_handler)
+        app.router.add_post('/v1/files', self.upload_file)
+        app.router.add_get('/v1/files/{file_id}/content', self.file_content)
+        app.router.add_post('/v1/batches', self.create_batch)
+        app.router.add_get('/v1/batches/{batch_id}', self.batch_status)
+        return app
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        messages = body.get("messages", [])
+        prompt_tokens = sum(count_tokens("math", message.get("content") or "") for message in messages)
+
+        error = self._check_limits(prompt_tokens)
+        if error is not None:
+            return error
+
+        try:
+            answer = self._answer(messages)
+        except Exception as e:
+            self.stats["400"] += 1
+            return self._error(400, "invalid_request_error", f"Could not answer: {e}")
+        completion_tokens = count_tokens("math", answer)
+
+        if body.get("stream"):
+            return await self._stream(request, body, answer)
+
+        await self._respond_after(completion_tokens)
+        response = {
+            "id": f"chatcmpl-mock{self.stats['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [
+                { "index": i, "message": { "role": "assistant", "content": answer }, "finish_reason": "stop" }
+                for i in range(body.get("n") or 1)
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+        self.stats["ok"] += 1
+        return web.json_response(response)
+
+    async def embeddings_handler(self, request):
+        body = await request.json()
+        inputs = body.get("input")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        prompt_tokens = sum(count_tokens("math", text) for text in inputs)
+
+        error = self._check_limits(prompt_tokens)
+        if error is not None:
+            return error
+
+        await self._respond_after(0)
+        response = {
+            "object": "list",
+            "model": body.get("model"),
+            "data": [
+                { "object": "embedding", "index": i, "embedding": self.embeddings._test_math(text) }
+                for i, text in enumerate(inputs)
+            ],
+            "usage": { "prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens }
+        }
+        self.stats["ok"] += 1
+        return web.json_response(response)
+
+    async def upload_file(self, request):
+        form = await request.post()
+        file_id = f"file-mock{len(self.files)}"
+        self.files[file_id] = form["file"].file.read()
+        return web.json_response({ "id": file_id, "object": "file", "purpose": form.get("purpose"), "bytes": len(self.files[file_id]) })
+
+    async def file_content(self, request):
+        file_id = request.match_info["file_id"]
+        if file_id not in self.files:
+            return self._error(404, "invalid_request_error", f"No such file: {file_id}")
+        return web.Response(body=self.files[file_id], content_type="application/jsonl")
+
+    async def create_batch(self, request):
+        body = await request.json()
+        if body.get("input_file_id") not in self.files:
+            return self._error(400, "invalid_request_error", f"No such file: {body.get('input_file_id')}")
+        batch_id = f"batch_mock{len(self.batches)}"
+        self.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body.get("endpoint"),
+            "input_file_id": body["input_file_id"],
+            "completion_window": body.get("completion_window"),
+            "status": "validating",
+            "created_at": int(time.time())
+        }
+        return web.json_response(self.batches[batch_id])
+
+    async def batch_status(self, request):
+        batch = self.batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return self._error(404, "invalid_request_error", f"No such batch: {request.match_info['batch_id']}")
+
+        if batch["status"] == "validating":
+            batch["status"] = "in_progress"
+        elif batch["status"] == "in_progress":
+            lines = self.files[batch["input_file_id"]].decode("utf-8").splitlines()
+            results = [ answer_batch_request(json.loads(line), self._answer, self.embeddings._test_math) for line in lines if line.strip() ]
+            self.random.shuffle(results)
+            output_file_id = f"file-mock{len(self.files)}"
+            self.files[output_file_id] = "".join(json.dumps(result) + "\n" for result in results).encode("utf-8")
+
+            failed = sum(1 for result in results if result["response"]["status_code"] != 200)
+            batch.update({
+                "status": "completed",
+                "output_file_id": output_file_id,
+                "request_counts": { "total": len(results), "completed": len(results) - failed, "failed": failed }
+            })
+        return web.json_response(batch)
+
+    def _answer(self, messages):
+        content = messages[-1]["content"] if messages else ""
+        if self.args.responder == "echo":
+            return content
+        return evaluate_math(content, self.logger)
+
+    # Injected errors and the --rpm/--tpm limits, as the API would report them.
+    def _check_limits(self, tokens):
+        self.stats["requests"] += 1
+
+        roll = self.random.random()
+        if roll < self.args.error_429:
+            self.stats["429"] += 1
+            return self._error(429, "rate_limit_error", "Rate limit reached (injected)", retry_after=1)
+        if roll < self.args.error_429 + self.args.error_500:
+            self.stats["500"] += 1
+            return self._error(500, "server_error", "The server had an error while processing your request (injected)")
+
+        now = time.monotonic()
+        while self._window and self._window[0][0] <= now - 60:
+            self._window.popleft()
+        used = sum(used_tokens for _, used_tokens in self._window)
+        if (self.args.rpm and len(self._window) >= self.args.rpm) or (self.args.tpm and self._window and used + tokens > self.args.tpm):
+            self.stats["429"] += 1
+            retry_after = math.ceil(self._window[0][0] + 60 - now)
+            return self._error(429, "rate_limit_error", "Rate limit reached for requests", retry_after=retry_after)
+
+        self._window.append((now, tokens))
+        return None
+
+    def _error(self, status, error_type, message, retry_after=None):
+        self.logger.debug(f"[mock server] {status} {message}")
+        headers = { "Retry-After": str(retry_after) } if retry_after is not None else None
+        body = { "error": { "message": message, "type": error_type, "param": None, "code": None } }
+        return web.json_response(body, status=status, headers=headers)
+
+    # Time to the first token, drawn from --latency-distribution with mean --latency.
+    def _latency(self):
+        mean = self.args.latency
+        if mean <= 0:
+            return 0
+        distribution = self.args.latency_distribution
+        if distribution == "uniform":
+            return self.random.uniform(0, 2 * mean)
+        if distribution == "exponential":
+            return self.random.expovariate(1 / mean)
+        if distribution == "lognormal":
+            sigma = self.args.latency_sigma
+            return self.random.lognormvariate(math.log(mean) - sigma * sigma / 2, sigma)
+        return mean
+
+    async def _respond_after(self, completion_tokens):
+        delay = self._latency() + completion_tokens * self.args.latency_per_token
+        if self.concurrency is None:
+            await asyncio.sleep(delay)
+            return
+        async with self.concurrency:
+            await asyncio.sleep(delay)
+
+    # Sends the answer a word at a time as server-sent events.
+    async def _stream(self, request, body, answer):
+        response = web.StreamResponse(headers={ "Content-Type": "text/event-stream" })
+        await response.prepare(request)
+
+        async def send(delta, finish_reason=None):
+            chunk = {
+                "id": f"chatcmpl-mock{self.stats['requests']}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [ { "index": 0, "delta": delta, "finish_reason": finish_reason } ]
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+
+        await self._respond_after(0)
+        await send({ "role": "assistant" })
+        for piece in re.findall(r'\s*\S+\s*', answer) or [answer]:
+            if self.args.latency_per_token:
+                await asyncio.sleep(self.args.latency_per_token)
+            await send({ "content": piece })
+        await send({}, "stop")
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        self.stats["ok"] += 1
+        return response
+
+    def summary(self):
+        return ", ".join(f"{key}={value}" for key, value in self.stats.items())
+
+async def mock_server(args, logger):
+    server = MockServer(args, logger)
+    runner = web.AppRunner(server.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, args.host, args.port)
+    await site.start()
+    logger.output(f"Mock server listening on http://{args.host}:{args.port}/v1 (use --api-base to point the other subcommands at it)")
+
+    try:
+        while True:
+            await asyncio.sleep(60)
+            logger.log(f"[mock server] {server.summary()}")
+    finally:
+        logger.log(f"[mock server] {server.summary()}")
+        await runner.cleanup()
@@ -0,0 +1,253 @@
+import asyncio
+import copy
+import math
+import os
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from src.gpt import PRICING, load_routes
+from src.template import Template
+from src.tokenizer import Tokenizer, count_batch
+from src.translation_helper import TranslationHelper
+
+# Default rate limits and a rough model of request latency
+# (overhead + seconds per completion token) used for the projection.
+MODEL_LIMITS = {
+    "gpt-4": { "rpm": 200, "tpm": 40000, "overhead": 1.0, "seconds_per_token": 0.06 },
+    "gpt-3.5-turbo": { "rpm": 3500, "tpm": 90000, "overhead": 0.5, "seconds_per_token": 0.015 },
+}
+DEFAULT_LIMITS = { "rpm": 3500, "tpm": 90000, "overhead": 0.5, "seconds_per_token": 0.02 }
+
+# How long we assume each reduce answer in map-reduce is
+REDUCE_OUTPUT_TOKENS = 500
+
+# Texts are counted in blocks of this many requests
+BLOCK_SIZE = 500
+
+# Works out what a prompt-all, prompt-folder or map-reduce run would send,
+# without calling GPT: every prompt is expanded with the real Template and
+# TranslationHelper (using the mock embedding for the nearest example), the
+# tokens are counted, and the cost and duration are projected from the
+# model's rate limits and --workers.  With --routes each request is priced
+# at the model of the route GPT would send it to.
+class Planner:
+
+    def __init__(self, args, logger):
+        self.args = args
+        self.logger = logger
+        self.model = args.model
+        self.routes = load_routes(args)
+        self.tokenizer = Tokenizer(args, logger)
+
+        # the helper (and anything else that would call the API) runs in math
+        # mode so that embeddings are mocked
+        self.mock_args = copy.copy(args)
+        self.mock_args.model = "math"
+        self.mock_args.map_store = None
+        self.mock_args.translation_memory = None
+        self.translation_helper = TranslationHelper(self.mock_args, logger)
+        if self.translation_helper.embeddings is not None:
+            examples = [ self.translation_helper.embeddings._test_math(example) for example in self.translation_helper.examples_in ]
+            self.translation_helper.examples_embeddings = np.vstack(examples)
+
+        limits = MODEL_LIMITS.get(self.model, DEFAULT_LIMITS)
+        self.rpm = args.rpm or limits["rpm"]
+        self.tpm = args.tpm or limits["tpm"]
+        self.overhead = limits["overhead"]
+        self.seconds_per_token = limits["seconds_per_token"]
+
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency = 0.0
+        self.usage_by_model = {}
+
+        # the texts of the requests still to be counted, and their models
+        self._block = []
+        self._block_models = []
+        self._pending = deque()
+        self._executor = None
+
+    # Records a request with the given system prompt and user message.  The
+    # completion is assumed to be --completion-ratio times the user message.
+    async def add_request(self, system, user):
+        self._block.append(system)
+        self._block.append(user)
+        self._block_models.append(self._route_model(user))
+        if len(self._block) >= 2 * BLOCK_SIZE:
+            await self._flush()
+
+    # Records a request whose size we already know.
+    def add_counted_request(self, prompt_tokens, completion_tokens, model=None):
+        model = model or self.model
+        self.requests += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+
+        usage = self.usage_by_model.setdefault(model, { "requests": 0, "prompt": 0, "completion": 0 })
+        usage["requests"] += 1
+        usage["prompt"] += prompt_tokens
+        usage["completion"] += completion_tokens
+
+        if model == self.model:
+            self.latency += self.overhead + self.seconds_per_token * completion_tokens
+        else:
+            limits = MODEL_LIMITS.get(model, DEFAULT_LIMITS)
+            self.latency += limits["overhead"] + limits["seconds_per_token"] * completion_tokens
+
+    # The model of the route GPT._route would pick for this user message.
+    def _route_model(self, user):
+        for route in self.routes:
+            if route.matches(user, self.tokenizer.count):
+                return route.model
+        return self.model
+
+    # The same for a reduce request with tokens of input.  Its input is made
+    # of map answers we don't have, so routes with a pattern are taken not to
+    # match it.
+    def _reduce_model(self, tokens):
+        for route in self.routes:
+            if route.pattern is None and route.matches("", lambda text: tokens):
+                return route.model
+        return self.model
+
+    def _tally(self, counts, models):
+        for i, model in enumerate(models):
+            system_tokens, user_tokens = counts[2*i], counts[2*i+1]
+            self.add_counted_request(system_tokens + user_tokens, math.ceil(user_tokens * self.args.completion_ratio), model)
+
+    # Counts a block of texts.  The first block is counted here; once there's
+    # more than one, blocks go to a process pool while we expand the next.
+    async def _flush(self):
+        texts, models = self._block, self._block_models
+        self._block, self._block_models = [], []
+        if not texts:
+            return
+
+        if self._executor is None and (self.args.processes == 1 or self.requests == 0):
+            self._tally(count_batch(self.model, texts), models)
+            return
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.args.processes)
+        loop = asyncio.get_running_loop()
+        self._pending.append((loop.run_in_executor(self._executor, count_batch, self.model, texts), models))
+        if len(self._pending) > 2 * (self.args.processes or os.cpu_count() or 1):
+            await self._tally_pending()
+
+    async def _tally_pending(self):
+        counts, models = self._pending.popleft()
+        self._tally(await counts, models)
+
+    async def _finish(self):
+        await self._flush()
+        while self._pending:
+            await self._tally_pending()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    async def expand(self, template, text, fileid=""):
+        variables = await self.translation_helper.get_variables(text, fileid)
+        return template.expand(variables)
+
+    def _read_prompt(self, filename):
+        with open(filename, 'r') as f:
+            return Template(self.args, self.logger, f.read())
+
+    # Lines in skip (those reused from a previous run) don't need requests.
+    async def plan_prompt_all(self, data, skip=()):
+        template = self._read_prompt(self.args.prompt)
+        for index, line in enumerate(data.iter_lines()):
+            if index in skip:
+                continue
+            await self.add_request(await self.expand(template, line), line)
+        await self._finish()
+        self.report()
+
+    # manager is a PromptFolder made with mock_args; its chunking is used
+    # (with the real model's tokenizer) to work out the requests for each file
+    async def plan_prompt_folder(self, manager):
+        manager.tokenizer = self.tokenizer
+        template = self._read_prompt(self.args.prompt)
+        for filename in manager.get_txt_files(self.args.input_dir):
+            fileid = os.path.basename(filename)[:-4]
+            with open(filename, 'r') as f:
+                contents = f.read()
+            for chunk in manager._split(contents):
+                await self.add_request(await self.expand(template, chunk, fileid), chunk)
+        await self._finish()
+        self.report()
+
+    async def plan_map_reduce(self, manager):
+        map_template = self._read_prompt(self.args.map_prompt)
+        reduce_template = self._read_prompt(self.args.reduce_prompt)
+        for path in manager._get_txt_files(self.args.input_dir):
+            fileid = os.path.basename(path)[:-4]
+            with open(path, 'r') as f:
+                lines = f.readlines()
+
+            # the reduce input is made of the map answers, which aren't counted
+            # until _finish, so it's estimated from the lines instead
+            mapped_tokens = 0
+            for line in lines:
+                await self.add_request(await self.expand(map_template, line, fileid), line)
+                mapped_tokens += math.ceil(self.tokenizer.count(line) * self.args.completion_ratio)
+
+            reduce_prompt = reduce_template.expand({ "AUTHOR": self.translation_helper.id_to_author(fileid) })
+            self._plan_reduce(self.tokenizer.count(reduce_prompt), mapped_tokens)
+        await self._finish()
+        self.report()
+
+    # Adds the requests of a tree reduce over tokens worth of mapped outputs,
+    # packed as MapReduce._queue_reduce does with room left for the prompt.
+    def _plan_reduce(self, prompt_tokens, tokens):
+        budget = self.args.reduce_tokens - prompt_tokens
+        while tokens > budget:
+            chunks = math.ceil(tokens / budget)
+            if chunks * REDUCE_OUTPUT_TOKENS >= tokens:
+                break
+            for _ in range(chunks):
+                self.add_counted_request(prompt_tokens + budget, REDUCE_OUTPUT_TOKENS, self._reduce_model(budget))
+            tokens = chunks * REDUCE_OUTPUT_TOKENS
+        self.add_counted_request(prompt_tokens + tokens, REDUCE_OUTPUT_TOKENS, self._reduce_model(tokens))
+
+    # Projected wall clock time in seconds, and what limits it.
+    def projected_duration(self):
+        limits = {
+            f"requests per minute ({self.rpm})": self.requests / self.rpm * 60,
+            f"tokens per minute ({self.tpm})": (self.prompt_tokens + self.completion_tokens) / self.tpm * 60,
+            f"workers ({self.args.workers})": self.latency / self.args.workers
+        }
+        bottleneck = max(limits, key=limits.get)
+        return limits[bottleneck], bottleneck
+
+    def projected_cost(self, model=None):
+        models = [ model ] if model else self.usage_by_model
+        cost = 0
+        for model in models:
+            usage = self.usage_by_model.get(model, { "prompt": 0, "completion": 0 })
+            pricing = PRICING.get(model, { "prompt": 0, "completion": 0 })
+            cost += usage["prompt"] * pricing["prompt"] / 1000 + usage["completion"] * pricing["completion"] / 1000
+        return round(cost, 2)
+
+    def report(self):
+        duration, bottleneck = self.projected_duration()
+        seconds = int(duration)
+        mean = self.prompt_tokens / self.requests if self.requests else 0
+
+        self.logger.output(f"Dry run for {self.model}: {self.requests} requests")
+        self.logger.output(f"Prompt tokens: {self.prompt_tokens} (mean {mean:.0f} per request)")
+        self.logger.output(f"Estimated completion tokens: {self.completion_tokens}")
+        unpriced = [ model for model in self.usage_by_model if model not in PRICING ]
+        if unpriced:
+            self.logger.output(f"Estimated cost: unknown (no pricing for {', '.join(unpriced)})")
+        else:
+            self.logger.output(f"Estimated cost: ${self.projected_cost()}")
+        if self.routes:
+            for model, usage in self.usage_by_model.items():
+                cost = f"${self.projected_cost(model)}" if model in PRICING else "unknown"
+                self.logger.output(f"  {model}: {usage['requests']} requests, {usage['prompt']} prompt tokens, {usage['completion']} completion tokens, {cost}")
+        self.logger.output(f"Projected duration: {seconds} seconds ({int(seconds/3600)} hours, {int(seconds%3600/60)} minutes, {seconds%60} seconds), limited by {bottleneck}")
@@ -0,0 +1,62 @@
+import difflib
+import hashlib
+
+# The input and output of an earlier prompt-all run, for --previous-input
+# and --previous-output.  Lines of the new input are lined up with the old
+# ones by a hash of their contents, so that lines which were inserted,
+# deleted or edited since don't shift the rest; every line that's unchanged
+# (and got an answer last time) can reuse its old answer.
+class PreviousRun:
+
+    def __init__(self, args, logger):
+        self.args = args
+        self.logger = logger
+
+        try:
+            with open(args.previous_input, 'r') as f:
+                self.input_hashes = [ self.hash(line) for line in f ]
+            with open(args.previous_output, 'r') as f:
+                self.outputs = f.read().split("\n")
+        except Exception as e:
+            self.logger.fatal_error(e)
+
+        # every answer is written as one line, so the last "line" is the
+        # empty string after the final newline
+        if self.outputs and self.outputs[-1] == "":
+            self.outputs.pop()
+        if len(self.outputs) != len(self.input_hashes):
+            self.logger.fatal_error(Exception(
+                f"{args.previous_output} has {len(self.outputs)} lines but {args.previous_input} has {len(self.input_hashes)}; "
+                "they need to be the input and output of the same run."))
+
+    def hash(self, line):
+        return hashlib.blake2b(line.rstrip("\n").encode("utf-8"), digest_size=16).digest()
+
+    # Returns { index in lines: old answer } for the lines that can be reused.
+    def reusable_outputs(self, lines):
+        hashes = [ self.hash(line) for line in lines ]
+        matcher = difflib.SequenceMatcher(None, self.input_hashes, hashes, autojunk=False)
+
+        reused = {}
+        inserted = deleted = changed = unanswered = 0
+        for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+            if tag == "equal":
+                for offset in range(new_end - new_start):
+                    output = self.outputs[old_start + offset]
+                    # a line that failed last time was written out empty
+                    if output == "":
+                        unanswered += 1
+                        continue
+                    reused[new_start + offset] = output
+            elif tag == "insert":
+                inserted += new_end - new_start
+            elif tag == "delete":
+                deleted += old_end - old_start
+            else:
+                changed += min(old_end - old_start, new_end - new_start)
+                inserted += max(0, (new_end - new_start) - (old_end - old_start))
+                deleted += max(0, (old_end - old_start) - (new_end - new_start))
+
+        self.logger.log(f"[previous run] {len(reused)} of {len(hashes)} lines unchanged; {changed} changed, {inserted} inserted, "
+                        f"{deleted} deleted and {unanswered} without an answer last time; sending {len(hashes) - len(reused)} lines to GPT")
+        return reused
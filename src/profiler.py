@@ -0,0 +1,175 @@
+import asyncio
+import cProfile
+import os
+import sys
+import threading
+import tracemalloc
+
+from collections import Counter
+
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+
+# How many allocation sites to list, and how many frames to keep for each
+TOP_ALLOCATIONS = 30
+TRACEMALLOC_FRAMES = 10
+
+# Profiles a whole run for --profile.  Three files are written next to the
+# log:
+#
+#   <output>.prof       cProfile stats for the event loop thread (load with pstats)
+#   <output>.collapsed  sampled stacks in the collapsed format that
+#                       flamegraph.pl and speedscope read
+#   <output>.alloc.txt  the top allocation sites from tracemalloc
+#
+# cProfile can't tell time spent waiting from time spent working, so the
+# sampler also looks at the event loop: while it's busy we record its stack,
+# and while it's idle in select() we record "[idle]" plus, under "[awaiting]",
+# the coroutine chain each task is suspended in (e.g. GPT._create waiting on
+# the API).  Executor threads, where the API calls run, are sampled too.
+#
+# The [awaiting] counts are in task-samples: an idle sample with ten tasks
+# waiting adds one to each of their ten chains, so [awaiting] adds up to
+# [idle] times the number of tasks, and shows where the tasks wait rather
+# than how long the loop did.  The tasks can only be read on the loop's own
+# thread, so they're read when a sample finds the loop busy (asking an idle
+# loop would wake it up, and change what's being measured), and the chains
+# from then are used for the idle samples that follow.
+class Profiler:
+
+    def __init__(self, args, logger):
+        self.logger = logger
+        self.prof_filename = args.output + ".prof"
+        self.collapsed_filename = args.output + ".collapsed"
+        self.alloc_filename = args.output + ".alloc.txt"
+
+        self.stacks = Counter()
+        self.samples = 0
+        self.idle_samples = 0
+        self._stop = threading.Event()
+
+        # the last snapshot of _task_chains(), taken on the event loop, and
+        # whether a new one has been asked for
+        self._chains = []
+        self._snapshot_pending = False
+
+    # Must be called from the event loop that runs the subcommand.
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+        self._sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self.profile.disable()
+        self._stop.set()
+        self._sampler.join()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        self.profile.dump_stats(self.prof_filename)
+        self._write_collapsed()
+        self._write_allocations(snapshot)
+
+        idle = 100 * self.idle_samples / self.samples if self.samples else 0
+        self.logger.log(f"[profile] {self.samples} samples, event loop idle {idle:.0f}% of the time")
+        self.logger.log(f"[profile] wrote {self.prof_filename}, {self.collapsed_filename} and {self.alloc_filename}")
+
+    def _sample_loop(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            self._sample()
+
+    def _sample(self):
+        frames = sys._current_frames()
+        own = threading.get_ident()
+        names = { thread.ident: thread.name for thread in threading.enumerate() }
+
+        for ident, frame in frames.items():
+            if ident == own:
+                continue
+            stack = self._frame_stack(frame)
+            if ident != self.loop_thread:
+                # idle pool threads just sit in the queue; leave them out
+                if stack and not stack[-1].startswith("_worker (") and "wait (threading.py" not in stack[-1]:
+                    self.stacks[";".join([f"[thread {names.get(ident, ident)}]"] + stack)] += 1
+                continue
+
+            self.samples += 1
+            if self._is_idle(frame):
+                self.idle_samples += 1
+                self.stacks["[idle]"] += 1
+                for chain in self._chains:
+                    self.stacks[";".join(["[awaiting]"] + chain)] += 1
+            else:
+                self.stacks[";".join(stack)] += 1
+                if not self._snapshot_pending:
+                    self._snapshot_pending = True
+                    try:
+                        self.loop.call_soon_threadsafe(self._snapshot_chains)
+                    except RuntimeError:
+                        pass
+
+    # The event loop is idle when it's blocked in the selector.
+    def _is_idle(self, frame):
+        return os.path.basename(frame.f_code.co_filename) == "selectors.py" and frame.f_code.co_name == "select"
+
+    def _frame_stack(self, frame):
+        stack = []
+        while frame is not None:
+            stack.append(self._label(frame.f_code))
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+
+    def _label(self, code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _snapshot_chains(self):
+        self._chains = self._task_chains()
+        self._snapshot_pending = False
+
+    # For each suspended task, the coroutines it's awaiting through, outermost
+    # first.  Must be called on the event loop.
+    def _task_chains(self):
+        try:
+            tasks = asyncio.all_tasks(self.loop)
+        except RuntimeError:
+            return []
+
+        chains = []
+        for task in tasks:
+            chain = []
+            awaited = task.get_coro()
+            while awaited is not None:
+                frame = getattr(awaited, "cr_frame", None) or getattr(awaited, "gi_frame", None) or getattr(awaited, "ag_frame", None)
+                if frame is None:
+                    chain.append(type(awaited).__name__)
+                    break
+                chain.append(self._label(frame.f_code))
+                awaited = getattr(awaited, "cr_await", None) or getattr(awaited, "gi_yieldfrom", None) or getattr(awaited, "ag_await", None)
+            chains.append(chain)
+        return chains
+
+    def _write_collapsed(self):
+        with open(self.collapsed_filename, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def _write_allocations(self, snapshot):
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+        statistics = snapshot.statistics('traceback')
+        total = sum(statistic.size for statistic in statistics)
+        with open(self.alloc_filename, 'w') as f:
+            f.write(f"Total allocated at the end of the run: {total / 1024:.1f} KiB\n")
+            for i, statistic in enumerate(statistics[:TOP_ALLOCATIONS]):
+                f.write(f"\n#{i+1}: {statistic.size / 1024:.1f} KiB in {statistic.count} blocks\n")
+                for line in statistic.traceback.format():
+                    f.write(line + "\n")
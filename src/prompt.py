@@ -17,6 +17,17 @@ class PromptOne:
 
         # Load input text
         input_text = self.data.get_text()
+
+        if getattr(self.args, "stream", False):
+            # print the answer as it arrives, then write the whole thing out
+            pieces = []
+            async for piece in self.gpt.stream(None, input_text):
+                print(piece, end='', flush=True)
+                pieces.append(piece)
+            print("")
+            await self.logger.output_async("".join(pieces), echo=False)
+            return
+
         result = await self.gpt.query(None, input_text)
         await self.logger.output_async(result)
 
@@ -3,12 +3,19 @@ import aiofiles
 import functools
 import re
 
+from src.batch import Batch, BATCH_DISCOUNT, CHAT_ENDPOINT
 from src.input import Input
 from src.logger import Logger
+from src.metrics import registry
 from src.gpt import GPT
+from src.planner import Planner
+from src.previous_run import PreviousRun
+from src.sharding import ShardCoordinator, ShardWorker
 from src.worker_pool import AsyncWorkerPool
 from src.template import Template
+from src.tracing import tracer
 from src.translation_helper import TranslationHelper
+from src.translation_memory import open_translation_memory, close_translation_memory
 
 class PromptAll:
     def __init__(self, args, logger, data, gpt):
@@ -24,64 +31,278 @@ class PromptAll:
 
 
         self.translation_helper = TranslationHelper(args, logger)
+        self.memory = None
 
     async def prompt_all(self):
-        # Load input text
-        input_text = self.data.get_text_lines()
+        # Lines that haven't changed since --previous-input keep their old answers
+        reused = {}
+        if getattr(self.args, "previous_input", None):
+            reused = PreviousRun(self.args, self.logger).reusable_outputs(self.data.iter_lines())
 
+        # Stream the input text
+        input_text = self.data.iter_lines()
+        lines = self.data.count_lines() if registry.enabled else None
+        if lines is not None:
+            lines -= len(reused)
+            # the pipeline's preparation stage has a task per --embedding-batch lines as well
+            if getattr(self.args, "embedding_workers", 0):
+                lines += -(-lines // self.args.embedding_batch)
+            registry.expect_tasks(lines)
+
+        template = await self.load_template()
+        self.memory = open_translation_memory(self.args, self.logger, template, self.translation_helper)
+        try:
+            if getattr(self.args, "embedding_workers", 0):
+                await self._launch_pipeline(input_text, template, reused)
+            else:
+                await self._launch_jobs(input_text, template, reused)
+        finally:
+            await close_translation_memory(self.memory, self.logger)
+
+    async def load_template(self):
         # Get the prompt
         try:
             with open(self.args.prompt, 'r') as f:
                 prompt_text = f.read()
-        except e:
+        except Exception as e:
             self.logger.fatal_error(e)
 
         await self.logger.log_async(f"Prompt: {prompt_text}")
-        template = Template(self.args, self.logger, prompt_text)
+        return Template(self.args, self.logger, prompt_text)
+
+    # With --batch every line that needs GPT is sent in one batch job, and the
+    # answers are written out in order once it's done.
+    async def prompt_all_batch(self):
+        reused = {}
+        if getattr(self.args, "previous_input", None):
+            reused = PreviousRun(self.args, self.logger).reusable_outputs(self.data.iter_lines())
+
+        template = await self.load_template()
+        self.memory = open_translation_memory(self.args, self.logger, template, self.translation_helper)
+
+        try:
+            batch = Batch(self.args, self.logger, CHAT_ENDPOINT)
+            inputs = {}
+            for index, line in enumerate(self.data.iter_lines()):
+                if index in reused:
+                    continue
+                if self.memory:
+                    remembered = await self.memory.lookup(line)
+                    if remembered is not None:
+                        reused[index] = remembered
+                        continue
+                prompt = await self._expand_prompt(line, template)
+                batch.add(str(index), self.gpt.batch_body(GPT.messages(prompt, line)))
+                inputs[index] = line
+
+            results = await batch.run()
+            for index in range(len(inputs) + len(reused)):
+                if index in reused:
+                    output = reused[index]
+                elif str(index) in results:
+                    output = self.gpt.read_batch_response(results[str(index)], batch.models[str(index)]).replace("\n","\t")
+                    if self.memory:
+                        await self.memory.store(inputs[index], output)
+                else:
+                    output = None
+                await self.callback(output, index)
 
-        await self._launch_jobs(input_text, template)
+            await self.logger.log_async(f"[batch] cost at batch prices: ${round(self.gpt.get_cost() * BATCH_DISCOUNT, 2)}")
+        finally:
+            await close_translation_memory(self.memory, self.logger)
+
+    # With --shards the lines are put in a job queue and run by worker
+    # processes; this writes their answers out in order.
+    async def prompt_all_sharded(self):
+        async def write(index, outputs):
+            await self.logger.output_async(outputs[0] if outputs[0] is not None else "")
+
+        jobs = ( (str(index), [line]) for index, line in enumerate(self.data.iter_lines()) )
+        await ShardCoordinator(self.args, self.logger).run(jobs, write)
+
+    # One of the worker processes of a sharded run.
+    async def prompt_all_shard_worker(self):
+        template = await self.load_template()
+        self.memory = open_translation_memory(self.args, self.logger, template, self.translation_helper)
+        try:
+            await ShardWorker(self.args, self.logger).run(lambda index, line: self._run_prompt(line, template))
+        finally:
+            await close_translation_memory(self.memory, self.logger)
+
+    async def callback(self, output, index):
+        # a failed or timed out line still gets written (as an empty line) so
+        # that it doesn't block the lines after it
+        if output is None:
+            await self.logger.log_async(f"Error: no result for line {index}")
+            output = ""
 
-    async def callback(self, output, index, total_lines):
         self.output_data[index] = output
         await self.logger.debug_async("callback with index=" + str(index) + " output=" + output)
         await self.logger.log_async(f"result: {index} -> {output}")
 
+        # write out (and forget) every answer we can in order
         async with self._output_lock:
-            while self.next_to_write < total_lines:
-                if self.next_to_write in self.output_data.keys():
-                    next_answer = self.output_data[self.next_to_write]
+            with tracer.span("output"):
+                while self.next_to_write in self.output_data:
+                    next_answer = self.output_data.pop(self.next_to_write)
                     await self.logger.debug_async("writing index " + str(self.next_to_write))
                     await self.logger.output_async(next_answer)
                     self.next_to_write = self.next_to_write + 1
-                else:
-                    break
 
-    async def _launch_jobs(self, input_text, template):
-        # launch the jobs
-        pool = AsyncWorkerPool(worker_count=self.workers, logger=self.logger)
+    async def _launch_jobs(self, input_text, template, reused=None):
+        reused = reused or {}
+
+        # launch the jobs; the pool only holds a few lines beyond what the
+        # workers are doing, so the input is read as the work progresses
+        pool = AsyncWorkerPool(worker_count=self.workers, logger=self.logger, task_timeout=self.args.task_timeout, max_queued=2*self.workers)
         await pool.start()
 
-        for index, line in enumerate(input_text):
-            callback = functools.partial(self.callback, total_lines=len(input_text), index=index)
-            await pool.add_task(self._run_prompt, line, template, callback=callback)
+        try:
+            for index, line in enumerate(input_text):
+                callback = functools.partial(self.callback, index=index)
+                if index in reused:
+                    await callback(reused.pop(index))
+                    continue
+                await pool.add_task(self._run_prompt, line, template, callback=callback)
+        except BaseException:
+            # cancelled (e.g. Ctrl-C), or a fatal error reading the input,
+            # which exits with SystemExit; the workers mustn't be left running
+            await pool.shutdown()
+            raise
 
         await pool.join()
 
+    # With --embedding-workers the lines go through two pools.  The
+    # preparation stage embeds --embedding-batch lines with one request,
+    # checks the translation memory and expands their prompts; the
+    # generation stage of --workers workers only calls GPT.  Each has its own
+    # concurrency, and the queue between them is bounded so that preparation
+    # only runs a few lines ahead, but GPT workers never wait on an embedding.
+    async def _launch_pipeline(self, input_text, template, reused=None):
+        reused = reused or {}
+        preparers = self.args.embedding_workers
+
+        generation = AsyncWorkerPool(worker_count=self.workers, logger=self.logger, task_timeout=self.args.task_timeout, max_queued=2*self.workers)
+        preparation = AsyncWorkerPool(worker_count=preparers, logger=self.logger, task_timeout=self.args.task_timeout, max_queued=2*preparers)
+        await generation.start()
+        await preparation.start()
+
+        async def prepare(batch):
+            callback = functools.partial(self._dispatch, batch=batch, generation=generation)
+            await preparation.add_task(self._prepare, batch, template, callback=callback)
+
+        try:
+            batch = []
+            for index, line in enumerate(input_text):
+                if index in reused:
+                    await self.callback(reused.pop(index), index)
+                    continue
+                batch.append((index, line))
+                if len(batch) == self.args.embedding_batch:
+                    await prepare(batch)
+                    batch = []
+            if batch:
+                await prepare(batch)
+        except BaseException:
+            # as in _launch_jobs
+            await preparation.shutdown()
+            await generation.shutdown()
+            raise
+
+        await preparation.join()
+        await generation.join()
+
+    # The preparation stage: returns (index, line, prompt, remembered answer)
+    # for each line of batch.  The nearest examples and the translation
+    # memory find the embeddings in the cache that query_batch filled.
+    async def _prepare(self, batch, template):
+        embeddings = self.translation_helper.embeddings or (self.memory.embeddings if self.memory else None)
+        if embeddings is not None:
+            with tracer.span("embedding batch", lines=len(batch)):
+                await embeddings.query_batch([ line for _, line in batch ])
+
+        prepared = []
+        for index, line in batch:
+            remembered = await self._remembered(line)
+            prompt = await self._expand_prompt(line, template) if remembered is None else None
+            prepared.append((index, line, prompt, remembered))
+        return prepared
+
+    # Hands the prepared lines to the generation stage.  This runs as the
+    # preparation task's callback rather than in the task, so that waiting
+    # for room in the generation queue doesn't count against --task-timeout.
+    async def _dispatch(self, prepared, batch, generation):
+        # the preparation failed or timed out, so the lines get no answer
+        if prepared is None:
+            for index, _ in batch:
+                await self.callback(None, index)
+            return
+
+        for index, line, prompt, remembered in prepared:
+            callback = functools.partial(self.callback, index=index)
+            if remembered is not None:
+                await callback(remembered)
+                continue
+            await generation.add_task(self._generate, line, prompt, callback=callback)
+
     def _count_words(self, text):
         return len(text.split())
 
-    async def _run_prompt(self, input_text, template):
+    async def _expand_prompt(self, input_text, template):
         variables = await self.translation_helper.get_variables(input_text)
-        prompt = template.expand(variables)
+        with tracer.span("template"):
+            prompt = template.expand(variables)
         await self.logger.log_async("[_run_prompt] prompt: " + prompt)
+        return prompt
+
+    async def _remembered(self, input_text):
+        if not self.memory:
+            return None
+        remembered = await self.memory.lookup(input_text)
+        if remembered is not None:
+            await self.logger.log_async("[_run_prompt] answer from the translation memory")
+        return remembered
+
+    async def _run_prompt(self, input_text, template):
+        remembered = await self._remembered(input_text)
+        if remembered is not None:
+            return remembered
 
+        prompt = await self._expand_prompt(input_text, template)
+        return await self._generate(input_text, prompt)
 
+    async def _generate(self, input_text, prompt):
         result = await self.gpt.query(system=prompt, user=input_text)
         result = result.replace("\n","\t")
+        if self.memory:
+            await self.memory.store(input_text, result)
         return result
 
 async def prompt_all(args, logger):
     data = Input(args, logger)
+    if bool(args.previous_input) != bool(args.previous_output):
+        logger.fatal_error(Exception("--previous-input and --previous-output have to be given together."))
+    if args.previous_input and (args.lines or args.shards or args.shard_worker):
+        logger.fatal_error(Exception("--previous-input can't be combined with --lines or --shards."))
+    if args.embedding_workers and args.embedding_batch < 1:
+        logger.fatal_error(Exception("--embedding-batch has to be at least 1."))
+    if args.batch and (args.shards or args.shard_worker):
+        logger.fatal_error(Exception("--batch can't be combined with --shards."))
+
+    if args.dry_run:
+        reused = PreviousRun(args, logger).reusable_outputs(data.iter_lines()) if args.previous_input else {}
+        await Planner(args, logger).plan_prompt_all(data, reused)
+        return
+
+    if args.shards:
+        await PromptAll(args, logger, data, None).prompt_all_sharded()
+        return
+
     gpt = GPT(args, logger)
     manager = PromptAll(args, logger, data, gpt)
-    await manager.prompt_all()
+    if args.shard_worker:
+        await manager.prompt_all_shard_worker()
+    elif args.batch:
+        await manager.prompt_all_batch()
+    else:
+        await manager.prompt_all()
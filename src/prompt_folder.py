@@ -4,12 +4,18 @@ import functools
 import re
 import os
 
+from src.batch import Batch, BATCH_DISCOUNT, CHAT_ENDPOINT
 from src.input import Input
 from src.logger import Logger
 from src.gpt import GPT
-from src.worker_pool import AsyncWorkerPool
+from src.planner import Planner
+from src.sharding import ShardCoordinator, ShardWorker
+from src.worker_pool import AsyncWorkerPool, PRIORITY_NORMAL
 from src.template import Template
+from src.tracing import tracer
+from src.tokenizer import Tokenizer
 from src.translation_helper import TranslationHelper
+from src.translation_memory import open_translation_memory, close_translation_memory
 
 class PromptFolder:
     def __init__(self, args, logger, gpt):
@@ -20,8 +26,13 @@ class PromptFolder:
         self.next_to_write = 0
         self._output_lock = asyncio.Lock()
         self.workers = args.workers
+        self.schedule = args.schedule
+        self.chunk_tokens = args.chunk_tokens
+        self._chunks = {}
 
+        self.tokenizer = Tokenizer(args, logger)
         self.translation_helper = TranslationHelper(args, logger)
+        self.memory = None
 
     def get_txt_files(self, foldername):
         txt_files = []
@@ -31,7 +42,7 @@ class PromptFolder:
                 txt_files.append(filename)
         return txt_files
 
-    async def prompt_folder(self):
+    async def load_template(self):
         # Get the prompt
         try:
             with open(self.args.prompt, 'r') as f:
@@ -41,47 +52,206 @@ class PromptFolder:
 
         # Setup the template
         await self.logger.log_async(f"Prompt: {prompt_text}")
-        template = Template(self.args, self.logger, prompt_text)
+        return Template(self.args, self.logger, prompt_text)
+
+    # With --shards every chunk of every file is put in a job queue and run
+    # by worker processes; the chunks of a file are joined back together as
+    # in _chunk_callback.  Files are queued in --schedule order, which is
+    # also the order they're written in.
+    async def prompt_folder_sharded(self):
+        async def write(fileid, outputs):
+            await self.callback("\t".join(output or "" for output in outputs), fileid)
+
+        def jobs():
+            for filename in sorted(self.get_txt_files(self.args.input_dir), key=self._priority):
+                fileid = filename.split("/")[-1][:-4]
+                with open(filename, 'r') as f:
+                    yield fileid, self._split(f.read())
+
+        await ShardCoordinator(self.args, self.logger).run(jobs(), write)
+
+    # With --batch every chunk of every file is sent in one batch job; once
+    # it's done the chunks of each file are joined back together as in
+    # _chunk_callback and the files are written in order of their names.
+    async def prompt_folder_batch(self):
+        template = await self.load_template()
+        self.memory = open_translation_memory(self.args, self.logger, template, self.translation_helper)
+
+        try:
+            batch = Batch(self.args, self.logger, CHAT_ENDPOINT)
+            files = []
+            for filename in sorted(self.get_txt_files(self.args.input_dir)):
+                fileid = filename.split("/")[-1][:-4]
+                with open(filename, 'r') as f:
+                    chunks = self._split(f.read())
+
+                remembered = {}
+                for index, chunk in enumerate(chunks):
+                    if self.memory:
+                        remembered[index] = await self.memory.lookup(chunk)
+                        if remembered[index] is not None:
+                            continue
+                    prompt = await self._expand_prompt(chunk, fileid, template)
+                    batch.add(f"{fileid}/{index}", self.gpt.batch_body(GPT.messages(prompt, chunk)))
+                files.append((fileid, chunks, remembered))
+
+            results = await batch.run()
+            for fileid, chunks, remembered in files:
+                outputs = []
+                for index, chunk in enumerate(chunks):
+                    output = remembered.get(index)
+                    if output is None and f"{fileid}/{index}" in results:
+                        output = self.gpt.read_batch_response(results[f"{fileid}/{index}"], batch.models[f"{fileid}/{index}"]).replace("\n","\t")
+                        if self.memory:
+                            await self.memory.store(chunk, output)
+                    outputs.append(output or "")
+                await self.callback("\t".join(outputs), fileid)
+
+            await self.logger.log_async(f"[batch] cost at batch prices: ${round(self.gpt.get_cost() * BATCH_DISCOUNT, 2)}")
+        finally:
+            await close_translation_memory(self.memory, self.logger)
+
+    # One of the worker processes of a sharded run.
+    async def prompt_folder_shard_worker(self):
+        template = await self.load_template()
+        self.memory = open_translation_memory(self.args, self.logger, template, self.translation_helper)
+        try:
+            await ShardWorker(self.args, self.logger).run(lambda fileid, chunk: self._run_prompt(chunk, fileid, template))
+        finally:
+            await close_translation_memory(self.memory, self.logger)
+
+    async def prompt_folder(self):
+        template = await self.load_template()
 
         # Get the file names
         input_files = self.get_txt_files(self.args.input_dir)
 
-        await self._launch_jobs(input_files, template)
+        self.memory = open_translation_memory(self.args, self.logger, template, self.translation_helper)
+        try:
+            await self._launch_jobs(input_files, template)
+        finally:
+            await close_translation_memory(self.memory, self.logger)
 
     async def callback(self, output, fileid):
         await self.logger.log_async(f"result: {fileid} -> {output}")
 
         async with self._output_lock:
-            await self.logger.output_async(f"{fileid}: {output}")
+            with tracer.span("output"):
+                await self.logger.output_async(f"{fileid}: {output}")
 
     async def _launch_jobs(self, input_files, template):
         # launch the jobs
-        pool = AsyncWorkerPool(worker_count=self.workers, logger=self.logger)
+        pool = AsyncWorkerPool(worker_count=self.workers, logger=self.logger, task_timeout=self.args.task_timeout)
         await pool.start()
 
-        for filename in input_files:
-            fileid = filename.split("/")[-1][:-4]
-            callback = functools.partial(self.callback, fileid=fileid)
-            await pool.add_task(self._run_prompt, filename, fileid, template, callback=callback)
+        try:
+            for filename in input_files:
+                fileid = filename.split("/")[-1][:-4]
+                async with aiofiles.open(filename, mode='r') as f:
+                    contents = await f.read()
+
+                chunks = self._split(contents)
+                if len(chunks) == 1:
+                    callback = functools.partial(self.callback, fileid=fileid)
+                    await pool.add_task(self._run_prompt, contents, fileid, template, callback=callback, priority=self._priority(filename))
+                    continue
+
+                # large files are split up and run on several workers at once
+                await self.logger.log_async(f"[_launch_jobs] splitting {fileid} into {len(chunks)} chunks")
+                self._chunks[fileid] = { "remaining": len(chunks), "results": {} }
+                for index, chunk in enumerate(chunks):
+                    callback = functools.partial(self._chunk_callback, fileid=fileid, index=index, total=len(chunks))
+                    await pool.add_task(self._run_prompt, chunk, fileid, template, callback=callback, priority=self._priority(filename))
+        except BaseException:
+            # cancelled, a file that can't be read or a fatal error; the
+            # workers mustn't be left running
+            await pool.shutdown()
+            raise
 
         await pool.join()
 
+    # Splits a file into chunks of at most --chunk-tokens tokens on paragraph
+    # boundaries.  Paragraphs that are too big on their own are split by line.
+    # Joining the chunks gives back the original text.
+    def _split(self, contents):
+        if not self.chunk_tokens or self.tokenizer.count(contents) <= self.chunk_tokens:
+            return [contents]
+
+        pieces = []
+        parts = re.split(r'(\n\s*\n)', contents)
+        for i in range(0, len(parts), 2):
+            paragraph = parts[i] + (parts[i+1] if i + 1 < len(parts) else "")
+            if self.tokenizer.count(paragraph) > self.chunk_tokens:
+                pieces.extend(paragraph.splitlines(keepends=True))
+            else:
+                pieces.append(paragraph)
+
+        return [ "".join(chunk) for chunk in self.tokenizer.pack(pieces, self.chunk_tokens) ]
+
+    # Collects the results for the chunks of a file and writes the file's
+    # output, in order, once they've all finished.
+    async def _chunk_callback(self, output, fileid, index, total):
+        chunks = self._chunks[fileid]
+        if index not in chunks["results"]:
+            chunks["remaining"] -= 1
+        chunks["results"][index] = output
+        await self.logger.log_async(f"chunk result: {fileid}[{index}] -> {output}")
+
+        if chunks["remaining"] == 0:
+            del self._chunks[fileid]
+            # chunks that failed or timed out have no output
+            results = [ chunks["results"][i] or "" for i in range(total) ]
+            await self.callback("\t".join(results), fileid)
+
+    # With largest-first scheduling the biggest files are started first so
+    # that a single huge file doesn't determine the tail latency of the run.
+    def _priority(self, filename):
+        if self.schedule == "largest-first":
+            return -os.path.getsize(filename)
+        return PRIORITY_NORMAL
+
     def _count_words(self, text):
         return len(text.split())
 
-    async def _run_prompt(self, input_file, fileid, template):
-        async with aiofiles.open(input_file, mode='r') as f:
-            contents = await f.read()
-
+    async def _expand_prompt(self, contents, fileid, template):
         variables = await self.translation_helper.get_variables(contents, fileid)
-        prompt = template.expand(variables)
+        with tracer.span("template"):
+            prompt = template.expand(variables)
         await self.logger.log_async("[_run_prompt] prompt: " + prompt)
+        return prompt
+
+    async def _run_prompt(self, contents, fileid, template):
+        if self.memory:
+            remembered = await self.memory.lookup(contents)
+            if remembered is not None:
+                await self.logger.log_async(f"[_run_prompt] answer for {fileid} from the translation memory")
+                return remembered
 
+        prompt = await self._expand_prompt(contents, fileid, template)
         result = await self.gpt.query(system=prompt, user=contents)
         result = result.replace("\n","\t")
+        if self.memory:
+            await self.memory.store(contents, result)
         return result
 
 async def prompt_folder(args, logger):
+    if args.dry_run:
+        planner = Planner(args, logger)
+        await planner.plan_prompt_folder(PromptFolder(planner.mock_args, logger, None))
+        return
+
+    if args.batch and (args.shards or args.shard_worker):
+        logger.fatal_error(Exception("--batch can't be combined with --shards."))
+
+    if args.shards:
+        await PromptFolder(args, logger, None).prompt_folder_sharded()
+        return
+
     gpt = GPT(args, logger)
     manager = PromptFolder(args, logger, gpt)
-    await manager.prompt_folder()
+    if args.shard_worker:
+        await manager.prompt_folder_shard_worker()
+    elif args.batch:
+        await manager.prompt_folder_batch()
+    else:
+        await manager.prompt_folder()
@@ -0,0 +1,274 @@
+import asyncio
+import itertools
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.worker_pool import AsyncWorkerPool
+
+# Jobs are added to the queue in batches of this many
+INSERT_BATCH = 1000
+
+# A claimed job whose lease hasn't been renewed for this many seconds is
+# assumed to belong to a worker that died, and is handed out again.  The
+# lease is renewed when the job starts running (it may wait in the worker's
+# pool first) and every LEASE_SECONDS / 3 while it runs.
+LEASE_SECONDS = 600
+
+# How often the coordinator checks for finished jobs
+POLL_INTERVAL = 0.5
+
+# Options that act on the whole process (and the files or ports it opens).
+# They stay with the coordinator and aren't passed on to the worker
+# processes, which would fight over them; True for those that take a value.
+PROCESS_OPTIONS = { "--metrics-port": True, "--metrics-interval": True, "--trace": True, "--logfile": True, "--profile": False }
+
+# The coordinator's command line without the PROCESS_OPTIONS.
+def worker_argv(argv):
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+            continue
+        option = arg.split("=", 1)[0]
+        if option in PROCESS_OPTIONS:
+            skip = PROCESS_OPTIONS[option] and "=" not in arg
+            continue
+        result.append(arg)
+    return result
+
+# Job queue shared by the processes of a sharded run, kept in SQLite so that
+# any process that can open the file (on this machine, or on others through
+# a shared filesystem) can take part.  It uses SQLite's rollback journal
+# rather than WAL, which needs memory shared between the processes and so
+# doesn't work across machines; the shared filesystem has to support file
+# locking.  A job is one piece of work for one
+# key (a line of prompt-all, or one chunk of a file in prompt-folder); jobs
+# are handed out in the order they were added.
+#
+# From async code the methods are run with call(), on a thread of the
+# queue's own, so that waiting on the database (or on another process's
+# lock) doesn't hold up the event loop.
+class JobQueue:
+
+    def __init__(self, path, logger):
+        self.logger = logger
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                key TEXT NOT NULL,
+                part INTEGER NOT NULL,
+                parts INTEGER NOT NULL,
+                input TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                claimed_at REAL,
+                output TEXT
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+
+    async def call(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, method, *args)
+
+    def clear(self):
+        self.connection.execute("DELETE FROM jobs")
+
+    # jobs yields (key, pieces) pairs; each piece becomes a job of its own.
+    def add_jobs(self, jobs):
+        rows = ( (key, part, len(pieces), piece) for key, pieces in jobs for part, piece in enumerate(pieces) )
+        while True:
+            batch = list(itertools.islice(rows, INSERT_BATCH))
+            if not batch:
+                return
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany("INSERT INTO jobs (key, part, parts, input) VALUES (?, ?, ?, ?)", batch)
+            self.connection.execute("COMMIT")
+
+    # Hands out up to count pending jobs (or ones whose lease ran out) to worker.
+    def claim(self, worker, count):
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.connection.execute(
+                "SELECT id, key, input FROM jobs WHERE status='pending' OR (status='claimed' AND claimed_at < ?) ORDER BY id LIMIT ?",
+                (now - LEASE_SECONDS, count)).fetchall()
+            self.connection.executemany(
+                "UPDATE jobs SET status='claimed', worker=?, claimed_at=? WHERE id=?",
+                [ (worker, now, row[0]) for row in rows ])
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return rows
+
+    def renew(self, worker, id):
+        self.connection.execute("UPDATE jobs SET claimed_at=? WHERE id=? AND worker=? AND status='claimed'", (time.time(), id, worker))
+
+    def complete(self, id, output):
+        self.connection.execute("UPDATE jobs SET status='done', output=? WHERE id=?", (output, id))
+
+    def fail(self, id):
+        self.connection.execute("UPDATE jobs SET status='failed' WHERE id=?", (id,))
+
+    def fail_claimed_by(self, workers):
+        self.connection.executemany("UPDATE jobs SET status='failed' WHERE status='claimed' AND worker=?", [ (worker,) for worker in workers ])
+
+    def fail_unfinished(self):
+        self.connection.execute("UPDATE jobs SET status='failed' WHERE status IN ('pending', 'claimed')")
+
+    # Finished jobs from id onwards, in order, up to the first unfinished one.
+    def finished_from(self, id, limit=INSERT_BATCH):
+        rows = self.connection.execute(
+            "SELECT id, key, part, parts, status, output FROM jobs WHERE id >= ? ORDER BY id LIMIT ?", (id, limit)).fetchall()
+        finished = []
+        for row in rows:
+            if row[0] != id + len(finished) or row[4] not in ('done', 'failed'):
+                break
+            finished.append(row)
+        return finished
+
+    def counts(self):
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    # Whether no claimed job has had its lease renewed in LEASE_SECONDS.
+    def leases_expired(self):
+        oldest = self.connection.execute("SELECT MIN(claimed_at) FROM jobs WHERE status='claimed'").fetchone()[0]
+        return oldest is None or oldest < time.time() - LEASE_SECONDS
+
+    def close(self):
+        self._executor.shutdown()
+        self.connection.close()
+
+def job_queue_path(args):
+    return args.job_queue or args.output + ".jobs.sqlite"
+
+# Runs a sharded job: fills the queue, starts --shards worker processes
+# (each is this same command line with --shard-worker added) and writes the
+# results out in the order the jobs were added as they finish.
+class ShardCoordinator:
+
+    def __init__(self, args, logger):
+        self.args = args
+        self.logger = logger
+        self.path = job_queue_path(args)
+        self.queue = JobQueue(self.path, logger)
+
+    # write(key, outputs) is called with the outputs of every piece of a
+    # key, in order; a piece that failed has None as its output.
+    async def run(self, jobs, write):
+        await self.queue.call(self.queue.clear)
+        await self.queue.call(self.queue.add_jobs, jobs)
+        counts = await self.queue.call(self.queue.counts)
+        await self.logger.log_async(f"[shards] {counts.get('pending', 0)} jobs in {self.path}; starting {self.args.shards} worker processes")
+
+        processes = [ self._start_worker(i) for i in range(self.args.shards) ]
+        next_id = 1
+        pieces = []
+        try:
+            while True:
+                # counted first, since jobs may finish in between: when
+                # nothing is left after this, finished has the last of them
+                counts = await self.queue.call(self.queue.counts)
+                finished = await self.queue.call(self.queue.finished_from, next_id)
+                for id, key, part, parts, status, output in finished:
+                    if status == 'failed':
+                        await self.logger.log_async(f"Error: no result for {key} (part {part+1} of {parts})")
+                    pieces.append(output if status == 'done' else None)
+                    if part + 1 == parts:
+                        await write(key, pieces)
+                        pieces = []
+                next_id += len(finished)
+
+                if not counts.get('pending') and not counts.get('claimed') and not finished:
+                    break
+                if all(process.poll() is not None for process in processes) and not finished:
+                    # jobs our own workers had claimed won't finish now, but
+                    # remote workers might still be going; only give up on
+                    # the rest when nobody is working on any of them
+                    await self.queue.call(self.queue.fail_claimed_by, [ f"{socket.gethostname()}:{process.pid}" for process in processes ])
+                    counts = await self.queue.call(self.queue.counts)
+                    if counts.get('pending') and (not counts.get('claimed') or await self.queue.call(self.queue.leases_expired)):
+                        await self.logger.log_async(f"[shards] worker processes exited with jobs unfinished: {counts}")
+                        await self.queue.call(self.queue.fail_unfinished)
+                if not finished:
+                    await asyncio.sleep(POLL_INTERVAL)
+        except asyncio.CancelledError:
+            for process in processes:
+                process.terminate()
+            raise
+        finally:
+            for process in processes:
+                process.wait()
+            self.queue.close()
+
+        await self.logger.log_async(f"[shards] done; worker logs are in {self.args.output}.shard<N>.log")
+
+    def _start_worker(self, number):
+        # options given again later on the command line override the earlier ones
+        command = [ sys.executable ] + worker_argv(sys.argv) + [
+            "--shards", "0", "--shard-worker", "--job-queue", self.path, "-o", f"{self.args.output}.shard{number}" ]
+        return subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+# One worker process of a sharded run: claims jobs from the queue and runs
+# them on its own pool until there are none left.
+class ShardWorker:
+
+    def __init__(self, args, logger):
+        self.args = args
+        self.logger = logger
+        self.workers = args.workers
+        self.queue = JobQueue(job_queue_path(args), logger)
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+
+    # run_job(key, input) returns the output for one job.
+    async def run(self, run_job):
+        pool = AsyncWorkerPool(worker_count=self.workers, logger=self.logger, task_timeout=self.args.task_timeout, max_queued=2*self.workers)
+        await pool.start()
+        done = 0
+        try:
+            while True:
+                # this also picks up jobs whose lease ran out
+                jobs = await self.queue.call(self.queue.claim, self.name, self.workers)
+                if not jobs:
+                    break
+
+                for id, key, text in jobs:
+                    await pool.add_task(self._run_job, run_job, id, key, text, callback=lambda output, id=id: self._finished(id, output))
+                done += len(jobs)
+        except BaseException:
+            # cancelled, or a fatal error; the workers mustn't be left running
+            await pool.shutdown()
+            raise
+
+        await pool.join()
+        self.queue.close()
+        await self.logger.log_async(f"[shards] worker {self.name} ran {done} jobs")
+
+    # Runs a job, holding on to its lease for as long as it takes.
+    async def _run_job(self, run_job, id, key, text):
+        await self.queue.call(self.queue.renew, self.name, id)
+        renewing = asyncio.ensure_future(self._keep_lease(id))
+        try:
+            return await run_job(key, text)
+        finally:
+            renewing.cancel()
+
+    async def _keep_lease(self, id):
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            await self.queue.call(self.queue.renew, self.name, id)
+
+    async def _finished(self, id, output):
+        if output is None:
+            await self.queue.call(self.queue.fail, id)
+        else:
+            await self.queue.call(self.queue.complete, id, output)
@@ -0,0 +1,94 @@
+import functools
+import itertools
+import os
+import tiktoken
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+BATCH_SIZE = 1000
+
+# Looking up an encoding loads its BPE ranks (downloading them the first time),
+# so we only do it once per model.
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    return tiktoken.encoding_for_model(model)
+
+def count_tokens(model, text):
+    # the math stub has no tokenizer; words are close enough for testing
+    if model == "math":
+        return len(text.split())
+    return len(get_encoding(model).encode(text))
+
+# Counts each of a batch of texts.  Module level so it can run in a process pool.
+def count_batch(model, texts):
+    return [ count_tokens(model, text) for text in texts ]
+
+# Counts the tokens in each of a batch of files.
+def count_files(model, paths):
+    counts = []
+    for path in paths:
+        with open(path, 'r') as f:
+            counts.append(count_tokens(model, f.read()))
+    return counts
+
+class Tokenizer:
+
+    def __init__(self, args, logger):
+        self.model = args.model
+        self.logger = logger
+
+    def count(self, text):
+        return count_tokens(self.model, text)
+
+    # Greedily packs pieces, in order, into chunks of at most budget tokens.
+    # A piece larger than the budget ends up in a chunk of its own, unless
+    # min_pieces forces chunks to take at least that many pieces.
+    def pack(self, pieces, budget, min_pieces=1):
+        chunks = []
+        current = []
+        current_tokens = 0
+        for piece in pieces:
+            tokens = self.count(piece)
+            if current and current_tokens + tokens > budget and len(current) >= min_pieces:
+                chunks.append(current)
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += tokens
+
+        if current:
+            chunks.append(current)
+        return chunks
+
+    # Counts the tokens of each item, yielding the counts in order.  Batches
+    # of items are spread over a pool of processes; counter is count_batch
+    # for texts or count_files for file paths.  Input that fits in a single
+    # batch is counted here rather than starting processes.
+    def count_parallel(self, items, processes=None, counter=count_batch, batch_size=BATCH_SIZE):
+        batches = self._batches(items, batch_size)
+        head = list(itertools.islice(batches, 2))
+        if processes == 1 or len(head) < 2:
+            for batch in itertools.chain(head, batches):
+                yield from counter(self.model, batch)
+            return
+
+        # only keep a couple of batches per process in flight so that
+        # streamed input isn't read any faster than it's counted
+        limit = 2 * (processes or os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            pending = deque()
+            for batch in itertools.chain(head, batches):
+                pending.append(executor.submit(counter, self.model, batch))
+                if len(pending) >= limit:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def _batches(self, items, batch_size):
+        items = iter(items)
+        while True:
+            batch = list(itertools.islice(items, batch_size))
+            if not batch:
+                return
+            yield batch
@@ -0,0 +1,94 @@
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import time
+
+# Which row of the trace the current code belongs to.  Each pool worker sets
+# its own lane, and asyncio copies context variables into the tasks it
+# starts, so spans recorded deep inside a task end up on its worker's row.
+lane = contextvars.ContextVar("trace_lane", default=0)
+
+_NOT_TRACING = contextlib.nullcontext()
+
+# Records timed spans and exports them in the Chrome trace-event format
+# (load the file in chrome://tracing or https://ui.perfetto.dev).  There's
+# one tracer per process (see `tracer` below); it does nothing until --trace
+# starts it, so spans are cheap to leave in place.
+class Tracer:
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._ids = itertools.count(1)
+        self._lane_names = { 0: "main" }
+
+    def start(self, filename):
+        self.filename = filename
+        self.enabled = True
+        self.events = []
+        self._lane_names = { 0: "main" }
+        self._origin = time.perf_counter()
+
+    def _now(self):
+        return (time.perf_counter() - self._origin) * 1_000_000
+
+    # A new row for the trace, e.g. for one pool worker.
+    def new_lane(self, name):
+        if not self.enabled:
+            return 0
+        number = len(self._lane_names)
+        self._lane_names[number] = name
+        return number
+
+    # Times the block as a span on the current lane.  If it raises, the
+    # span records the error.
+    def span(self, name, **args):
+        if not self.enabled:
+            return _NOT_TRACING
+        return self._span(name, args)
+
+    @contextlib.contextmanager
+    def _span(self, name, args):
+        start = self._now()
+        try:
+            yield
+        except BaseException as e:
+            args["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.events.append({
+                "name": name, "ph": "X", "ts": start, "dur": self._now() - start,
+                "pid": os.getpid(), "tid": lane.get(), "args": args
+            })
+
+    # Spans that overlap others on the same row, like queue waits, are
+    # recorded as async events that get rows of their own.  Returns the
+    # (name, id) to pass to end_async.
+    def begin_async(self, name, **args):
+        if not self.enabled:
+            return None
+        handle = (name, next(self._ids))
+        self.events.append({ "name": name, "ph": "b", "cat": name, "id": handle[1], "ts": self._now(), "pid": os.getpid(), "tid": 0, "args": args })
+        return handle
+
+    def end_async(self, handle):
+        if handle is None or not self.enabled:
+            return
+        name, id = handle
+        self.events.append({ "name": name, "ph": "e", "cat": name, "id": id, "ts": self._now(), "pid": os.getpid(), "tid": 0 })
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        metadata = [
+            { "name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": number, "args": { "name": name } }
+            for number, name in self._lane_names.items()
+        ]
+        with open(self.filename, 'w') as f:
+            json.dump({ "traceEvents": metadata + self.events, "displayTimeUnit": "ms" }, f)
+        self.events = []
+
+tracer = Tracer()
@@ -1,3 +1,4 @@
+import hashlib
 import re
 import traceback
 import numpy as np
@@ -5,6 +6,23 @@ import json
 
 from src.embeddings import Embeddings
 from src.arabic_strings import ArabicStrings
+from src.tracing import tracer
+from src.warm_state import warm_state
+
+# A hash of everything besides the input that goes into a request made with
+# prompt: the model, the prompt and the examples and wordlist it's expanded
+# with.  Stored answers (--map-store, --translation-memory) are only reused
+# under the same hash.
+def prompt_hash(args, prompt):
+    key = [ args.model, prompt ]
+    for name in [ "examples_in", "examples_out", "examples_embeddings", "wordlist" ]:
+        path = getattr(args, name, None)
+        if isinstance(path, str):
+            with open(path, 'r') as f:
+                key.append(f.read())
+        else:
+            key.append(None)
+    return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
 
 class TranslationHelper:
     def __init__(self, args, logger):
@@ -43,8 +61,20 @@ class TranslationHelper:
             self.examples_out = None
             self.examples_embeddings = None
             return
-        else:
-            self.logger.debug("[translation helper] Parsing example data")
+
+        paths = [ self.args.examples_in, self.args.examples_out, self.args.examples_embeddings ]
+        self.examples_in, self.examples_out, self.examples_embeddings = warm_state.load("examples", paths, self._load_examples, self.logger)
+
+        if len(self.examples_in) != len(self.examples_out):
+            self.logger.fatal_error(Exception(f"Wrong number of output examples; expected {len(self.examples_in)} but got {len(self.examples_out)}."))
+        
+        if len(self.examples_in) != len(self.examples_embeddings):
+            self.logger.fatal_error(Exception("Wrong number of example embeddings; expected {len(self.examples_in)} but got {len(self.examples_embeddings)}."))
+
+        self.embeddings = Embeddings(self.args, self.logger)
+
+    def _load_examples(self):
+        self.logger.debug("[translation helper] Parsing example data")
 
         try:
             with open(self.args.examples_in, 'r') as f:
@@ -64,18 +94,8 @@ class TranslationHelper:
         examples_out = [ x for x in examples_out if len(x) > 0 ]
         embeddings = [ x for x in embeddings if len(x) > 0 ]
 
-        self.examples_in = examples_in
-        self.examples_out = examples_out
         embedding_arrays = [np.array(json.loads(line)) for line in embeddings]
-        self.examples_embeddings = np.vstack(embedding_arrays)
-
-        if len(self.examples_in) != len(self.examples_out):
-            self.logger.fatal_error(Exception(f"Wrong number of output examples; expected {len(self.examples_in)} but got {len(self.examples_out)}."))
-        
-        if len(self.examples_in) != len(self.examples_embeddings):
-            self.logger.fatal_error(Exception("Wrong number of example embeddings; expected {len(self.examples_in)} but got {len(self.examples_embeddings)}."))
-
-        self.embeddings = Embeddings(self.args, self.logger)
+        return examples_in, examples_out, np.vstack(embedding_arrays)
 
     def _initialize_wordlist(self):
 
@@ -87,7 +107,10 @@ class TranslationHelper:
         if not isinstance(self.args.wordlist, str):
             return
 
-        self.wordlist = []
+        self.wordlist = warm_state.load("wordlist", [ self.args.wordlist ], self._load_wordlist, self.logger)
+
+    def _load_wordlist(self):
+        wordlist = []
 
         try:
             with open(self.args.wordlist, 'r') as f:
@@ -111,18 +134,24 @@ class TranslationHelper:
                     "translations": line[1],
                     "comment": line[2]
                 }
-            self.wordlist.append(obj)
+            wordlist.append(obj)
+
+        return wordlist
 
     async def get_variables(self, text, fileid=""):
-        example_in, example_out = await self.get_nearest_example(text)
-
-        return {
-            "LEN": self.get_wordcount(text),
-            "NEAREST_EXAMPLE_IN": example_in,
-            "NEAREST_EXAMPLE_OUT": example_out,
-            "WORDLIST": self.get_wordlist(text),
-            "AUTHOR": self.id_to_author(fileid)
-        }
+        with tracer.span("get_variables"):
+            with tracer.span("embedding"):
+                example_in, example_out = await self.get_nearest_example(text)
+            with tracer.span("wordlist"):
+                wordlist = self.get_wordlist(text)
+
+            return {
+                "LEN": self.get_wordcount(text),
+                "NEAREST_EXAMPLE_IN": example_in,
+                "NEAREST_EXAMPLE_OUT": example_out,
+                "WORDLIST": wordlist,
+                "AUTHOR": self.id_to_author(fileid)
+            }
 
     def _word_is_relevant(self, word, text):
         normalized_word = self.arabic_strings.strip_diacritical(word)
@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+import sqlite3
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from src.arabic_strings import ArabicStrings
+from src.embeddings import Embeddings
+from src.tracing import tracer
+from src.translation_helper import prompt_hash
+
+# Rows the matrix of embeddings starts with; it doubles whenever it's full.
+INITIAL_ROWS = 64
+
+# New answers are written in groups of this many rather than one at a time.
+COMMIT_EVERY = 100
+
+# On-disk memory of past answers, so that passages we've already translated
+# don't cost another GPT call.  Each answer is kept with its input's
+# normalized text (without diacritics, see ArabicStrings.strip_diacritical)
+# and embedding, under a hash of the model and prompt it was made with.
+#
+# An input whose normalized text matches a stored one gets the stored answer.
+# Otherwise the most similar stored input is found by embedding; when it's
+# at least as similar as the threshold it's logged as a near match, and with
+# reuse_near its answer is used as well.
+#
+# The database is only used from a thread of its own, so that lookups don't
+# hold up the event loop.  New answers are kept in memory and written
+# COMMIT_EVERY at a time, and the rest by close().
+class TranslationMemory:
+
+    def __init__(self, path, logger, embeddings, prompt_hash, threshold, reuse_near=False):
+        self.logger = logger
+        self.embeddings = embeddings
+        self.prompt_hash = prompt_hash
+        self.threshold = threshold
+        self.reuse_near = reuse_near
+        self.arabic_strings = ArabicStrings(logger)
+
+        self.lookups = 0
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.near_flagged = 0
+
+        # the answers stored since the last write, by normalized input
+        self._pending = {}
+
+        # the embeddings for this prompt are searched in memory: the first
+        # _count rows of _matrix, with where each row's input and answer are
+        # in _rows (the id of its row in the database, or the (input, output)
+        # of an answer stored in this run)
+        self._rows = []
+        self._matrix = None
+        self._count = 0
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        for id, embedding in self._executor.submit(self._open, path).result():
+            self._add_vector(id, np.frombuffer(embedding, dtype=np.float32))
+
+    # Opens the database and returns the (id, embedding) rows for this prompt.
+    def _open(self, path):
+        # sharded runs have several processes writing at once
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS memory (
+                id INTEGER PRIMARY KEY,
+                prompt_hash TEXT NOT NULL,
+                normalized TEXT NOT NULL,
+                input TEXT NOT NULL,
+                output TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                UNIQUE (prompt_hash, normalized)
+            )""")
+        self.connection.commit()
+        return self.connection.execute("SELECT id, embedding FROM memory WHERE prompt_hash=? ORDER BY id", (self.prompt_hash,)).fetchall()
+
+    async def _run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    @staticmethod
+    def hash(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def normalize(self, text):
+        return self.arabic_strings.strip_diacritical(text)
+
+    # Returns the remembered answer for text, or None.
+    async def lookup(self, text):
+        with tracer.span("translation memory"):
+            self.lookups += 1
+            normalized = self.normalize(text)
+            pending = self._pending.get(normalized)
+            output = pending[1] if pending else await self._run(self._find, normalized)
+            if output is not None:
+                self.exact_hits += 1
+                return output
+
+            match = await self._nearest(text)
+            if match is None:
+                return None
+
+            similarity, input, output = match
+            if self.reuse_near:
+                self.near_hits += 1
+                await self.logger.log_async(f"[translation memory] reusing near match ({similarity:.3f}) for: {text.strip()}\n  remembered input: {input.strip()}")
+                return output
+
+            self.near_flagged += 1
+            await self.logger.log_async(f"[translation memory] near match ({similarity:.3f}) for: {text.strip()}\n  remembered input: {input.strip()}\n  remembered output: {output.strip()}")
+            return None
+
+    # The most similar remembered input, if it's similar enough, as
+    # (similarity, input, output).
+    async def _nearest(self, text):
+        if not self._count:
+            return None
+
+        embedding = np.array(await self.embeddings.query(text), dtype=np.float32)
+        if embedding.shape[0] != self._matrix.shape[1]:
+            return None
+        similarities = self._matrix[:self._count] @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+
+        row = self._rows[best]
+        input, output = row if isinstance(row, tuple) else await self._run(self._answer, row)
+        return float(similarities[best]), input, output
+
+    def _find(self, normalized):
+        row = self.connection.execute(
+            "SELECT output FROM memory WHERE prompt_hash=? AND normalized=?", (self.prompt_hash, normalized)).fetchone()
+        return row[0] if row else None
+
+    def _answer(self, id):
+        return self.connection.execute("SELECT input, output FROM memory WHERE id=?", (id,)).fetchone()
+
+    async def store(self, text, output):
+        normalized = self.normalize(text)
+        if normalized in self._pending:
+            return
+        embedding = np.array(await self.embeddings.query(text), dtype=np.float32)
+        self._pending[normalized] = (text, output, embedding.tobytes())
+        self._add_vector((text, output), embedding)
+
+        if len(self._pending) >= COMMIT_EVERY:
+            pending, self._pending = self._pending, {}
+            await self._run(self._write, pending)
+
+    def _write(self, pending):
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO memory (prompt_hash, normalized, input, output, embedding) VALUES (?, ?, ?, ?, ?)",
+            [ (self.prompt_hash, normalized, text, output, embedding) for normalized, (text, output, embedding) in pending.items() ])
+        self.connection.commit()
+
+    # Appends a row to the matrix, doubling it when it's full so that adding
+    # an answer doesn't copy the whole memory.  Embeddings of another size
+    # (from another embedding model) can't be compared and are left out.
+    def _add_vector(self, row, vector):
+        if self._matrix is None:
+            self._matrix = np.empty((INITIAL_ROWS, vector.shape[0]), dtype=np.float32)
+        elif vector.shape[0] != self._matrix.shape[1]:
+            return
+
+        if self._count == len(self._matrix):
+            grown = np.empty((2 * len(self._matrix), self._matrix.shape[1]), dtype=np.float32)
+            grown[:self._count] = self._matrix[:self._count]
+            self._matrix = grown
+        self._matrix[self._count] = vector
+        self._rows.append(row)
+        self._count += 1
+
+    def summary(self):
+        hits = self.exact_hits + self.near_hits
+        rate = 100 * hits / self.lookups if self.lookups else 0
+        return (f"[translation memory] {self.lookups} lookups: {self.exact_hits} exact matches, {self.near_hits} near matches reused, "
+                f"{self.near_flagged} near matches flagged; {rate:.0f}% hit rate")
+
+    def _close(self):
+        self._write(self._pending)
+        self._pending = {}
+        self.connection.close()
+
+    def close(self):
+        if self._executor is None:
+            return
+        self._executor.submit(self._close).result()
+        self._executor.shutdown()
+        self._executor = None
+
+# The memory for --translation-memory, or None.  Answers are only shared
+# between runs with the same model, prompt template, examples and wordlist.
+def open_translation_memory(args, logger, template, translation_helper):
+    path = getattr(args, "translation_memory", None)
+    if not path:
+        return None
+    embeddings = translation_helper.embeddings or Embeddings(args, logger)
+    return TranslationMemory(path, logger, embeddings, prompt_hash(args, template.template), args.tm_threshold, args.tm_reuse_near)
+
+async def close_translation_memory(memory, logger):
+    if memory is None:
+        return
+    await logger.log_async(memory.summary())
+    memory.close()
@@ -0,0 +1,73 @@
+import asyncio
+import os
+
+# An async context manager that does nothing, for requests that aren't
+# limited.  (contextlib.nullcontext only works with async with from Python
+# 3.10 on.)
+class NoLimit:
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+NO_LIMIT = NoLimit()
+
+# Things that are slow to build and the same from one job to the next, kept
+# by the serve subcommand so that its jobs don't each pay for them.  There's
+# one per process (see `warm_state` below); until serve starts it, load()
+# just builds and request_slot() doesn't limit anything, so a normal run
+# behaves exactly as before.
+class WarmState:
+
+    def __init__(self):
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+        self._loaded = {}
+        self._request_slots = None
+
+    # requests is how many API requests all jobs together may have in flight.
+    def start(self, requests):
+        self.enabled = True
+        self._loaded = {}
+        self._request_slots = asyncio.Semaphore(requests)
+
+    def stop(self):
+        self.enabled = False
+        self._loaded = {}
+        self._request_slots = None
+
+    # Returns build(), which parses the given files, reusing what an earlier
+    # job parsed as long as none of the files has changed since.
+    def load(self, kind, paths, build, logger):
+        if not self.enabled:
+            return build()
+
+        try:
+            stamps = tuple( (os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in paths )
+        except OSError:
+            # let build() report the missing file the usual way
+            return build()
+
+        key = (kind, tuple(os.path.abspath(path) for path in paths))
+        loaded = self._loaded.get(key)
+        if loaded is not None and loaded[0] == stamps:
+            self.hits += 1
+            logger.log(f"[warm] reusing the {kind} loaded from {paths[0]}")
+            return loaded[1]
+
+        self.misses += 1
+        value = build()
+        self._loaded[key] = (stamps, value)
+        return value
+
+    # async with this around an API request to share one budget of
+    # in-flight requests between all the jobs in the process.
+    def request_slot(self):
+        if self._request_slots is None:
+            return NO_LIMIT
+        return self._request_slots
+
+warm_state = WarmState()
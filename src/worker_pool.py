@@ -1,40 +1,150 @@
 # worker_pool.py
 
 import asyncio
+import itertools
+import time
 import traceback
+import numpy as np
+from array import array
+
+from src.metrics import registry
+from src.tracing import lane, tracer
 from typing import Any, Callable, List, Tuple
 
+# Tasks are ordered by (priority, submission order), so lower priorities run
+# first and tasks with equal priority keep FIFO order.
+PRIORITY_HIGH = -1_000_000_000
+PRIORITY_NORMAL = 0
+
 class AsyncWorkerPool:
-    def __init__(self, worker_count: int, logger):
+    # With max_queued set, add_task waits while that many tasks are queued,
+    # so that a producer streaming its input doesn't get ahead of the workers.
+    # Don't use it if callbacks add tasks, since they'd wait on themselves.
+    def __init__(self, worker_count: int, logger, task_timeout: float = None, shutdown_grace: float = 30, max_queued: int = 0):
         self.worker_count = worker_count
-        self.queue = asyncio.Queue()
+        self.queue = asyncio.PriorityQueue(maxsize=max_queued)
         self.workers: List[asyncio.Task] = []
         self.logger = logger
+        self.task_timeout = task_timeout
+        self.shutdown_grace = shutdown_grace
+        self._counter = itertools.count()
+        self._in_flight = {}
+        self._stopping = False
+
+        # how long each task took to run, for the summary logged by join()
+        self.latencies = array('d')
 
-    async def _worker(self):
+    async def _worker(self, worker_id):
+        lane.set(tracer.new_lane(f"worker {worker_id}"))
         while True:
-            task, args, callback = await self.queue.get()
+            _, _, task, args, callback, queued = await self.queue.get()
+            tracer.end_async(queued)
+            self._in_flight[worker_id] = (task, args)
+            registry.add("tasks_queued", -1)
+            registry.add("tasks_in_flight", 1)
             result = None
+            start = time.monotonic()
             try:
-                result = await task(*args)
-            except Exception as e:
-                await self.logger.log_async(f"Error in worker: {e}")
-                await self.logger.log_async(traceback.format_exc())
+                try:
+                    with tracer.span(getattr(task, "__name__", "task"), task=self._describe(task, args)):
+                        if self.task_timeout:
+                            result = await asyncio.wait_for(task(*args), self.task_timeout)
+                        else:
+                            result = await task(*args)
+                except asyncio.TimeoutError:
+                    registry.increment("tasks_failed_total")
+                    await self.logger.log_async(f"Error in worker: task {self._describe(task, args)} timed out after {self.task_timeout} seconds")
+                except asyncio.CancelledError:
+                    # only stop() cancels the worker itself; otherwise it's
+                    # the task that was cancelled, and the worker carries on
+                    if self._stopping:
+                        raise
+                    registry.increment("tasks_failed_total")
+                    await self.logger.log_async(f"Error in worker: task {self._describe(task, args)} was cancelled")
+                except Exception as e:
+                    registry.increment("tasks_failed_total")
+                    await self.logger.log_async(f"Error in worker: {e}")
+                    await self.logger.log_async(traceback.format_exc())
+                finally:
+                    del self._in_flight[worker_id]
+                    self.latencies.append(time.monotonic() - start)
+                    registry.add("tasks_in_flight", -1)
+                    registry.increment("tasks_completed_total")
+                    registry.observe("task_seconds", self.latencies[-1])
 
-            try:
-                if callback:
-                    await callback(result)
-            except Exception as e:
-                await self.logger.log_async(f"Error in callback: {e}")
-                await self.logger.log_async(traceback.format_exc())
+                try:
+                    if callback:
+                        with tracer.span("callback"):
+                            await callback(result)
+                except Exception as e:
+                    await self.logger.log_async(f"Error in callback: {e}")
+                    await self.logger.log_async(traceback.format_exc())
             finally:
                 self.queue.task_done()
 
+    def _describe(self, task, args):
+        name = getattr(task, "__name__", repr(task))
+        described = ", ".join(repr(arg)[:60] for arg in args)
+        return f"{name}({described})"
+
     async def start(self):
-        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+        self._stopping = False
+        self.workers = [asyncio.create_task(self._worker(i)) for i in range(self.worker_count)]
 
-    async def add_task(self, task: Callable[..., Any], *args: Any, callback: Callable[[Any], None]):
-        await self.queue.put((task, args, callback))
+    # Lower priority values are run first.  For longest-job-first scheduling
+    # pass the negated size estimate of the job as its priority.
+    async def add_task(self, task: Callable[..., Any], *args: Any, callback: Callable[[Any], None], priority: int = PRIORITY_NORMAL):
+        queued = tracer.begin_async("queue wait", task=self._describe(task, args))
+        await self.queue.put((priority, next(self._counter), task, args, callback, queued))
+        registry.increment("tasks_queued_total")
+        registry.add("tasks_queued", 1)
 
+    # Waits for every queued task to finish and then stops the workers.  If
+    # we're cancelled while waiting (e.g. Ctrl-C) the pool is shut down.
     async def join(self):
-        await self.queue.join()
+        try:
+            await self.queue.join()
+        except asyncio.CancelledError:
+            await self.shutdown()
+            raise
+        if self.latencies:
+            await self.logger.log_async(self.latency_summary())
+        await self.stop()
+
+    # e.g. "[pool] 120 tasks; latency p50=0.812s p95=2.301s p99=4.010s max=5.120s"
+    def latency_summary(self):
+        p50, p95, p99 = np.percentile(self.latencies, [50, 95, 99])
+        return f"[pool] {len(self.latencies)} tasks; latency p50={p50:.3f}s p95={p95:.3f}s p99={p99:.3f}s max={max(self.latencies):.3f}s"
+
+    # Cancels the worker tasks.
+    async def stop(self):
+        self._stopping = True
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    # Drops the tasks that haven't started yet (logging each one so the run
+    # can be resumed), gives in-flight tasks up to shutdown_grace seconds to
+    # finish and then cancels the workers.
+    async def shutdown(self):
+        dropped = []
+        while not self.queue.empty():
+            _, _, task, args, _, queued = self.queue.get_nowait()
+            tracer.end_async(queued)
+            self.queue.task_done()
+            dropped.append(self._describe(task, args))
+        registry.add("tasks_queued", -len(dropped))
+
+        await self.logger.log_async(f"[pool] shutting down; {len(dropped)} queued tasks dropped, {len(self._in_flight)} in flight")
+        for description in dropped:
+            await self.logger.log_async(f"[pool] not started: {description}")
+
+        if self._in_flight:
+            try:
+                await asyncio.wait_for(self.queue.join(), self.shutdown_grace)
+            except asyncio.TimeoutError:
+                for task, args in self._in_flight.values():
+                    await self.logger.log_async(f"[pool] cancelled in flight: {self._describe(task, args)}")
+
+        await self.stop()
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+# Sends a job to a running `./tool.py serve` and waits for it to finish, e.g.
+#
+#   ./submit.py prompt-all -m gpt-4 -p prompt.txt -i input.txt -o output.txt
+#
+# This only uses the standard library so that it starts quickly; the point of
+# the server is that the jobs don't pay for tool.py's imports and setup.
+
+import http.client
+import json
+import os
+import socket
+import sys
+import tempfile
+
+# The same default as serve's --socket
+def default_socket():
+    return os.path.join(tempfile.gettempdir(), f"gpt-translation-tools-{os.getuid()}.sock")
+
+class UnixConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        super().__init__("localhost", timeout=None)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+# Returns the server's answer: {"status": "done" or "error", ...}
+def submit(argv, socket_path=None, cwd=None):
+    connection = UnixConnection(socket_path or default_socket())
+    try:
+        body = json.dumps({ "argv": argv, "cwd": cwd or os.getcwd() })
+        connection.request("POST", "/jobs", body=body, headers={ "Content-Type": "application/json" })
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
+
+def main():
+    argv = sys.argv[1:]
+    socket_path = os.getenv("GPT_TOOLS_SOCKET")
+    if len(argv) >= 2 and argv[0] == "--socket":
+        socket_path = argv[1]
+        argv = argv[2:]
+    if not argv or argv[0] in ["-h", "--help"]:
+        print("usage: submit.py [--socket PATH] {prompt-all,prompt-folder,map-reduce} [options]")
+        sys.exit(0 if argv else 1)
+
+    try:
+        answer = submit(argv, socket_path)
+    except OSError as e:
+        print(f"Can't reach the server on {socket_path or default_socket()} ({e}); start it with ./tool.py serve")
+        sys.exit(1)
+
+    if answer["status"] == "done":
+        print(f"Job {answer['id']} done in {answer['seconds']:.1f} seconds; output is in {answer['output']}")
+    else:
+        print(f"Job {answer.get('id')} failed: {answer['error']}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
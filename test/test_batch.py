@@ -0,0 +1,97 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from aiohttp.test_utils import TestClient, TestServer
+from mock.logger import MockLogger
+from mock.args import MockArgs
+
+import src.batch
+from src.batch import Batch, CHAT_ENDPOINT, EMBEDDINGS_ENDPOINT
+from src.gpt import GPT
+from src.mock_server import MockServer
+
+class TestBatch(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.logger = MockLogger()
+
+    def args(self, **kwargs):
+        defaults = dict(output=os.path.join(self.temp_dir, "output.txt"), batch_file=None, batch_backend="local",
+                        batch_id=None, batch_poll=0, api_base=None)
+        defaults.update(kwargs)
+        return MockArgs(**defaults)
+
+    def add_problems(self, batch, problems):
+        for index, problem in enumerate(problems):
+            batch.add(str(index), { "model": "math", "messages": GPT.messages("solve", problem) })
+
+    async def test_local_batch(self):
+        batch = Batch(self.args(), self.logger, CHAT_ENDPOINT)
+        self.add_problems(batch, [ f"{i}*2" for i in range(20) ] + [ "1/0" ])
+        results = await batch.run()
+
+        self.assertEqual(len(results), 20)
+        self.assertEqual([ results[str(i)]["choices"][0]["message"]["content"] for i in range(20) ], [ str(2*i) for i in range(20) ])
+        self.assertTrue(any("no result for 20" in log for log in self.logger.logs))
+
+        # the requests are in the batch file in order, and the results aren't
+        with open(os.path.join(self.temp_dir, "output.txt.batch.jsonl"), 'r') as f:
+            self.assertEqual([ json.loads(line)["custom_id"] for line in f ], [ str(i) for i in range(21) ])
+        with open(os.path.join(self.temp_dir, "output.txt.batch.jsonl.results"), 'r') as f:
+            self.assertNotEqual([ json.loads(line)["custom_id"] for line in f ], [ str(i) for i in range(21) ])
+
+    async def test_pick_up_submitted_batch(self):
+        batch = Batch(self.args(), self.logger, CHAT_ENDPOINT)
+        self.add_problems(batch, [ "1+1", "2+2" ])
+        await batch.run()
+        batch_id = next(log for log in self.logger.logs if "--batch-id" in log).split("--batch-id ")[1].split()[0]
+
+        resumed = Batch(self.args(batch_id=batch_id), self.logger, CHAT_ENDPOINT)
+        self.add_problems(resumed, [ "1+1", "2+2" ])
+        with patch.object(resumed.backend, "submit") as submit:
+            results = await resumed.run()
+        submit.assert_not_called()
+        self.assertEqual(results["1"]["choices"][0]["message"]["content"], "4")
+
+    async def test_split_into_several_batches(self):
+        with patch.object(src.batch, "MAX_REQUESTS", 3):
+            batch = Batch(self.args(), self.logger, CHAT_ENDPOINT)
+            self.add_problems(batch, [ f"{i}+0" for i in range(7) ])
+            results = await batch.run()
+
+        self.assertEqual({ custom_id: body["choices"][0]["message"]["content"] for custom_id, body in results.items() },
+                         { str(i): str(i) for i in range(7) })
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, "output.txt.batch.part2.jsonl")))
+
+    @patch.dict(os.environ, {"OPENAI_API_KEY": "test"})
+    def test_versioned_model_in_response(self):
+        gpt = GPT(MockArgs(model="gpt-4", top_p=1.0, best_of=1, max_tokens=9000, gpt_n=1, hedge_percentile=None, hedge_budget=0.05), self.logger)
+        body = { "model": "gpt-4-0613", "usage": { "prompt_tokens": 1000, "completion_tokens": 1000 },
+                 "choices": [ { "index": 0, "message": { "role": "assistant", "content": "hello" } } ] }
+
+        # priced as the model the request was sent to
+        self.assertEqual(gpt.read_batch_response(body, "gpt-4"), "hello")
+        self.assertEqual(gpt.get_cost(), 0.09)
+
+    async def test_openai_batch_against_mock_server(self):
+        server = MockServer(MockArgs(seed=0, responder="math", latency=0, latency_distribution="fixed", latency_sigma=0.5,
+                                     latency_per_token=0, concurrency=None, rpm=None, tpm=None, error_429=0, error_500=0, model=None),
+                            MockLogger())
+        client = TestClient(TestServer(server.make_app()))
+        await client.start_server()
+        self.addAsyncCleanup(client.close)
+
+        batch = Batch(self.args(batch_backend="openai", api_base=str(client.make_url("/v1"))), self.logger, EMBEDDINGS_ENDPOINT)
+        batch.add("0", { "model": "text-embedding-ada-002", "input": "hello" })
+        batch.add("1", { "model": "text-embedding-ada-002", "input": "there" })
+        results = await batch.run()
+
+        self.assertEqual(results["0"]["data"][0]["embedding"], server.embeddings._test_math("hello"))
+        self.assertEqual(results["1"]["data"][0]["embedding"], server.embeddings._test_math("there"))
+        # the mock server finishes a batch on the second poll
+        self.assertTrue(any("in_progress" in log for log in self.logger.logs))
@@ -0,0 +1,92 @@
+import unittest
+from unittest.mock import AsyncMock
+from mock.logger import MockLogger
+from mock.args import MockArgs
+
+from src.chat_history import ChatHistory, MESSAGE_OVERHEAD
+
+class TestChatHistory(unittest.IsolatedAsyncioTestCase):
+
+    def make_history(self, budget, summarize=False, gpt=None):
+        args = MockArgs(model="math", history_tokens=budget, summarize_history=summarize)
+        return ChatHistory(args, MockLogger(), gpt, "be helpful")
+
+    def contents(self, messages):
+        return [ message["content"] for message in messages ]
+
+    async def test_everything_fits(self):
+        history = self.make_history(1000)
+        history.append("user", "one two")
+        history.append("assistant", "three")
+
+        messages = await history.window()
+        self.assertEqual(self.contents(messages), ["be helpful", "one two", "three"])
+        self.assertEqual(history.total_tokens(), 5 + 3 * MESSAGE_OVERHEAD)
+
+    async def test_drops_oldest_turns(self):
+        # each message is 1 word + overhead; room for the system prompt and three messages
+        history = self.make_history(2 + 3 + 4 * MESSAGE_OVERHEAD)
+        for content in ["a", "b", "c", "d", "e"]:
+            history.append("user" if content in "ace" else "assistant", content)
+
+        messages = await history.window()
+        self.assertEqual(self.contents(messages), ["be helpful", "c", "d", "e"])
+
+    async def test_keeps_latest_message(self):
+        history = self.make_history(5)
+        history.append("user", "this message is longer than the budget")
+
+        messages = await history.window()
+        self.assertEqual(len(messages), 2)
+
+    async def test_no_limit(self):
+        history = self.make_history(0)
+        for i in range(100):
+            history.append("user", "word " * 50)
+
+        messages = await history.window()
+        self.assertEqual(len(messages), 101)
+
+    async def test_summarize_dropped_turns(self):
+        gpt = AsyncMock()
+        gpt.query.return_value = "they said hello"
+
+        # room for the system prompt, the latest message and a three word summary
+        history = self.make_history(2 + 7 + 8 + 3 * MESSAGE_OVERHEAD, summarize=True, gpt=gpt)
+        history.append("user", "hello")
+        history.append("assistant", "hi there how can I help")
+        history.append("user", "how are you doing today my friend")
+
+        messages = await history.window()
+        gpt.query.assert_called_once()
+        self.assertIn("user: hello\nassistant: hi there how can I help", gpt.query.call_args.kwargs["user"])
+        self.assertEqual(self.contents(messages), ["be helpful", "Summary of the earlier conversation: they said hello", "how are you doing today my friend"])
+
+    async def test_summary_stays_within_budget(self):
+        gpt = AsyncMock()
+        gpt.query.side_effect = [ "they said hello and hi", "short" ]
+
+        # room for the system prompt, a four word summary and two one word messages
+        history = self.make_history(2 + 9 + 2 + 3 * MESSAGE_OVERHEAD, summarize=True, gpt=gpt)
+        for content in ["hello", "hi", "how", "are", "you"]:
+            history.append("user" if content in "hello how you" else "assistant", content)
+
+        messages = await history.window()
+        # the first summary pushes the history over the budget again, so another
+        # turn is dropped and folded into a new summary
+        self.assertEqual(gpt.query.call_count, 2)
+        self.assertIn("they said hello and hi", gpt.query.call_args.kwargs["user"])
+        self.assertLessEqual(history.total_tokens(), history.budget)
+        self.assertEqual(self.contents(messages), ["be helpful", "Summary of the earlier conversation: short", "you"])
+
+    async def test_summary_too_big_is_dropped(self):
+        gpt = AsyncMock()
+        gpt.query.return_value = "a long summary of everything that was said before this message"
+
+        history = self.make_history(2 + 1 + 2 * MESSAGE_OVERHEAD + 2, summarize=True, gpt=gpt)
+        history.append("user", "hello")
+        history.append("assistant", "hi")
+        history.append("user", "bye")
+
+        messages = await history.window()
+        self.assertEqual(self.contents(messages), ["be helpful", "bye"])
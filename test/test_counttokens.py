@@ -1,5 +1,9 @@
 
 import asyncio
+import os
+import shutil
+import tempfile
+import numpy as np
 
 import unittest
 from unittest.mock import Mock
@@ -29,4 +33,57 @@ class TestCountTokens(unittest.TestCase):
         count = ct.count_tokens()
 
         self.assertEqual(5, count)
-        
+
+class TestCountTokensReport(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_per_line(self):
+        path = self.write("input.txt", "one\none two\none two three four\n\n")
+        args = MockArgs(model="math", input=path, lines=None, processes=1)
+        logger = MockLogger()
+
+        counts = CountTokens(args, logger, Input(args, logger)).count_tokens_report()
+
+        self.assertEqual(list(counts), [1, 2, 4, 0])
+        self.assertIn("Number of tokens: 7", logger.outputs)
+        self.assertIn("Tokens per line over 4 lines: mean=1.8 p50=2 p90=3 p95=4 p99=4 max=4", logger.outputs)
+
+    def test_directory(self):
+        self.write("b.txt", "one two")
+        self.write("a.txt", "one")
+        self.write("ignored.csv", "one two three")
+        args = MockArgs(model="math", input=self.temp_dir, lines=None, processes=1)
+        logger = MockLogger()
+
+        counts = CountTokens(args, logger, Mock()).count_tokens_report()
+
+        self.assertEqual(list(counts), [1, 2])
+        self.assertEqual(logger.outputs[:2], ["a.txt: 1", "b.txt: 2"])
+
+    def test_parallel_matches_serial(self):
+        path = self.write("input.txt", "".join(f"{'word ' * (i % 17)}\n" for i in range(2500)))
+        results = []
+        for processes in [1, 2]:
+            args = MockArgs(model="math", input=path, lines=None, processes=processes)
+            logger = MockLogger()
+            results.append(list(CountTokens(args, logger, Input(args, logger)).count_tokens_report()))
+
+        self.assertEqual(len(results[0]), 2500)
+        self.assertEqual(results[0], results[1])
+
+    def test_histogram(self):
+        ct = CountTokens(MockArgs(model="math"), MockLogger(), Mock())
+        lines = ct._histogram(np.array([0, 1, 2, 3, 5]))
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[2].strip().startswith("2-3:        2"))
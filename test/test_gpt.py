@@ -0,0 +1,354 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+
+import unittest
+from unittest.mock import Mock, patch
+from mock.logger import MockLogger
+from mock.args import MockArgs
+
+from src.gpt import GPT, HEDGE_MIN_SAMPLES, RateLimiter, api_options
+from src.tokenizer import Tokenizer
+
+def make_args(**kwargs):
+    defaults = dict(model="gpt-4", top_p=1.0, best_of=1, max_tokens=9000, gpt_n=1,
+                    hedge_percentile=None, hedge_budget=0.05)
+    defaults.update(kwargs)
+    return MockArgs(**defaults)
+
+def make_result(content):
+    result = Mock()
+    result.usage = {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+    message = Mock()
+    message.message = {"content": content}
+    result.choices = [message]
+    return result
+
+@patch.dict(os.environ, {"OPENAI_API_KEY": "test"})
+class TestGPTHedging(unittest.IsolatedAsyncioTestCase):
+
+    def make_gpt(self, responses, **kwargs):
+        gpt = GPT(make_args(**kwargs), MockLogger())
+        calls = []
+
+        # each call to _create takes the next (delay, content) pair
+        async def create(messages, route):
+            delay, content = responses[len(calls)]
+            calls.append(content)
+            await asyncio.sleep(delay)
+            return make_result(content)
+
+        gpt._create = create
+        return gpt, calls
+
+    def prime_latencies(self, gpt, latency):
+        gpt.default_route.latencies.extend([latency] * HEDGE_MIN_SAMPLES)
+
+    async def test_no_hedge_without_samples(self):
+        gpt, calls = self.make_gpt([(0.05, "slow")], hedge_percentile=50, hedge_budget=1.0)
+        result = await gpt._query([{"role": "user", "content": "hi"}])
+        self.assertEqual(result, "slow")
+        self.assertEqual(calls, ["slow"])
+
+    async def test_hedge_wins(self):
+        gpt, calls = self.make_gpt([(1.0, "slow"), (0.0, "fast")], hedge_percentile=50, hedge_budget=1.0)
+        self.prime_latencies(gpt, 0.01)
+        result = await gpt._query([{"role": "user", "content": "hi"}])
+        self.assertEqual(result, "fast")
+        self.assertEqual(calls, ["slow", "fast"])
+        self.assertEqual(gpt.hedged_requests, 1)
+
+    async def test_primary_wins_when_fast(self):
+        gpt, calls = self.make_gpt([(0.0, "primary")], hedge_percentile=50, hedge_budget=1.0)
+        self.prime_latencies(gpt, 0.5)
+        result = await gpt._query([{"role": "user", "content": "hi"}])
+        self.assertEqual(result, "primary")
+        self.assertEqual(gpt.hedged_requests, 0)
+
+    async def test_budget_limits_hedging(self):
+        gpt, calls = self.make_gpt([(0.05, "slow"), (0.0, "fast")], hedge_percentile=50, hedge_budget=0.01)
+        self.prime_latencies(gpt, 0.01)
+        result = await gpt._query([{"role": "user", "content": "hi"}])
+        self.assertEqual(result, "slow")
+        self.assertEqual(calls, ["slow"])
+
+    async def test_losing_request_keeps_its_slot(self):
+        gpt = GPT(make_args(hedge_percentile=50, hedge_budget=1.0), MockLogger())
+        gpt.default_route.slots = asyncio.Semaphore(2)
+        self.prime_latencies(gpt, 0.01)
+        finished = threading.Event()
+        delays = [0.2, 0.0]
+        def create(**kwargs):
+            delay = delays.pop(0)
+            time.sleep(delay)
+            if delay:
+                finished.set()
+            return make_result(str(delay))
+
+        with patch("src.gpt.openai.ChatCompletion") as api:
+            api.create = create
+            self.assertEqual(await gpt._query([{"role": "user", "content": "hi"}]), "0.0")
+            # the slow request is still being sent and holds its slot
+            self.assertFalse(finished.is_set())
+            self.assertEqual(gpt.default_route.slots._value, 1)
+
+            await asyncio.get_running_loop().run_in_executor(None, finished.wait)
+            await asyncio.sleep(0.01)
+        self.assertEqual(gpt.default_route.slots._value, 2)
+        # both requests count towards the hedging delay
+        self.assertEqual(len(gpt.default_route.latencies), HEDGE_MIN_SAMPLES + 2)
+        self.assertGreaterEqual(max(gpt.default_route.latencies), 0.2)
+
+    async def test_hedge_delay_percentile(self):
+        gpt = GPT(make_args(hedge_percentile=90), MockLogger())
+        gpt.default_route.latencies.extend([i / 10 for i in range(1, 101)])
+        self.assertAlmostEqual(gpt._hedge_delay(gpt.default_route), 9.1)
+
+class TestGPTSingleFlight(unittest.IsolatedAsyncioTestCase):
+
+    def make_gpt(self):
+        gpt = GPT(make_args(model="math"), MockLogger())
+        calls = []
+
+        async def query(messages):
+            calls.append(messages)
+            await asyncio.sleep(0.01)
+            return messages[-1]["content"].upper()
+
+        gpt._query = query
+        return gpt, calls
+
+    async def test_identical_requests_share_one_call(self):
+        gpt, calls = self.make_gpt()
+        results = await asyncio.gather(*[gpt.query("system", "refrain") for _ in range(5)])
+        self.assertEqual(results, ["REFRAIN"] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(gpt.coalesced_requests, 4)
+
+    async def test_different_requests_are_not_shared(self):
+        gpt, calls = self.make_gpt()
+        results = await asyncio.gather(gpt.query("system", "a"), gpt.query("system", "b"), gpt.query("other", "a"))
+        self.assertEqual(results, ["A", "B", "A"])
+        self.assertEqual(len(calls), 3)
+
+    async def test_sequential_requests_are_sent_again(self):
+        gpt, calls = self.make_gpt()
+        await gpt.query("system", "a")
+        await gpt.query("system", "a")
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(gpt._in_flight, {})
+
+    async def test_request_is_cancelled_when_every_caller_gives_up(self):
+        gpt, calls = self.make_gpt()
+        cancelled = []
+        async def query(messages):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(messages)
+                raise
+        gpt._query = query
+
+        callers = [ asyncio.ensure_future(gpt.query("system", "a")) for _ in range(2) ]
+        await asyncio.sleep(0.01)
+        callers[0].cancel()
+        await asyncio.sleep(0.01)
+        self.assertEqual(cancelled, [])
+
+        callers[1].cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(cancelled), 1)
+        self.assertEqual(gpt._in_flight, {})
+
+    async def test_new_caller_does_not_join_a_cancelled_request(self):
+        gpt, calls = self.make_gpt()
+        async def query(messages):
+            calls.append(messages)
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                # like _create, which waits for the API call it's sending
+                await asyncio.sleep(0.05)
+                raise
+        gpt._query = query
+
+        caller = asyncio.ensure_future(gpt.query("system", "a"))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        await asyncio.gather(caller, return_exceptions=True)
+        self.assertEqual(gpt._in_flight, {})
+
+        gpt._query = lambda messages: asyncio.sleep(0, "answer")
+        self.assertEqual(await asyncio.wait_for(gpt.query("system", "a"), 1), "answer")
+        self.assertEqual(gpt.coalesced_requests, 0)
+        await asyncio.sleep(0.1)
+        self.assertEqual(gpt._in_flight, {})
+
+    async def test_samples_are_not_shared(self):
+        gpt, calls = self.make_gpt()
+        gpt.n = 2
+        await asyncio.gather(gpt.query("system", "a"), gpt.query("system", "a"))
+        gpt.n = 1
+        gpt.top_p = 0.9
+        await asyncio.gather(gpt.query("system", "a"), gpt.query("system", "a"))
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(gpt.coalesced_requests, 0)
+
+@patch.dict(os.environ, {"OPENAI_API_KEY": "test"})
+class TestGPTStream(unittest.IsolatedAsyncioTestCase):
+
+    async def test_stream_yields_pieces_and_counts_usage(self):
+        gpt = GPT(make_args(), MockLogger())
+        gpt.tokenizer = Tokenizer(MockArgs(model="math"), MockLogger())
+
+        chunks = [{"choices": [{"delta": {"role": "assistant"}}]}]
+        chunks += [{"choices": [{"delta": {"content": piece}}]} for piece in ["Hello", " there", " friend"]]
+
+        async def open_stream(messages, route):
+            return iter(chunks)
+        gpt._open_stream = open_stream
+
+        pieces = [piece async for piece in gpt.stream("be brief", "say hello to my friend")]
+
+        self.assertEqual(pieces, ["Hello", " there", " friend"])
+        self.assertEqual(gpt.get_usage(), {"prompt": 7, "completion": 3, "total": 10})
+
+    async def test_stream_math(self):
+        gpt = GPT(make_args(model="math"), MockLogger())
+        pieces = [piece async for piece in gpt.stream(None, "1+1")]
+        self.assertEqual(pieces, ["2"])
+
+class TestGPTApiBase(unittest.TestCase):
+
+    @patch.dict(os.environ, {"OPENAI_API_KEY": ""})
+    def test_api_base_needs_no_key(self):
+        with self.assertRaises(ValueError):
+            GPT(make_args(), MockLogger())
+        gpt = GPT(make_args(api_base="http://127.0.0.1:8000/v1"), MockLogger())
+        self.assertEqual(gpt.api_options, { "api_base": "http://127.0.0.1:8000/v1", "api_key": "unused" })
+
+    @patch.dict(os.environ, {"OPENAI_API_KEY": "test"})
+    def test_api_options(self):
+        self.assertEqual(api_options(make_args()), {})
+        self.assertEqual(api_options(make_args(api_base="http://localhost/v1")), { "api_base": "http://localhost/v1" })
+
+@patch.dict(os.environ, {"OPENAI_API_KEY": "test"})
+class TestGPTRoutes(unittest.IsolatedAsyncioTestCase):
+
+    def make_gpt(self, routes):
+        with tempfile.NamedTemporaryFile('w', suffix=".json", delete=False) as f:
+            json.dump(routes, f)
+        self.addCleanup(os.remove, f.name)
+
+        gpt = GPT(make_args(routes=f.name), MockLogger())
+        gpt.tokenizer = Tokenizer(MockArgs(model="math"), MockLogger())
+        models = []
+
+        async def create(messages, route):
+            models.append(route.model)
+            async with route.slots:
+                await asyncio.sleep(0.01)
+            return make_result(messages[-1]["content"])
+
+        gpt._create = create
+        return gpt, models
+
+    async def test_routes_by_length_and_pattern(self):
+        gpt, models = self.make_gpt([
+            { "model": "math", "pattern": "^[0-9+*]+$" },
+            { "model": "gpt-3.5-turbo", "pattern": "^O God" },
+            { "model": "gpt-3.5-turbo", "max_input_tokens": 3 }
+        ])
+        await gpt.query("system", "a short heading")
+        await gpt.query("system", "O God, my God, this is a longer invocation")
+        await gpt.query("system", "a passage long enough to need the bigger model")
+        self.assertEqual(models, ["gpt-3.5-turbo", "gpt-3.5-turbo", "gpt-4"])
+
+        # the math model is answered locally
+        self.assertEqual(await gpt.query("system", "1+1"), "2")
+
+    async def test_usage_by_model(self):
+        gpt, models = self.make_gpt([ { "model": "gpt-3.5-turbo", "max_input_tokens": 1 } ])
+        await gpt.query("system", "short")
+        await gpt.query("system", "much longer")
+        self.assertEqual(gpt.usage_by_model["gpt-3.5-turbo"], {"prompt": 1, "completion": 1, "total": 2})
+        self.assertEqual(gpt.usage_by_model["gpt-4"], {"prompt": 1, "completion": 1, "total": 2})
+        self.assertEqual(gpt.get_usage()["total"], 4)
+        self.assertIn("usage by model", gpt.logger.logs[-1])
+
+    async def test_route_concurrency(self):
+        gpt, models = self.make_gpt([ { "model": "gpt-4", "concurrency": 2 } ])
+        # the real _create, with a blocking stand-in for the API call that
+        # notes how many requests are in flight at once
+        del gpt._create
+        in_flight = [0, 0]
+        lock = threading.Lock()
+        def create(model, messages, **kwargs):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.02)
+            with lock:
+                in_flight[0] -= 1
+            return make_result(messages[-1]["content"])
+
+        with patch("src.gpt.openai.ChatCompletion") as api:
+            api.create = create
+            results = await asyncio.gather(*[ gpt.query("system", str(i)) for i in range(6) ])
+        self.assertEqual(results, [ str(i) for i in range(6) ])
+        self.assertEqual(in_flight[1], 2)
+
+    async def test_requests_without_a_limit(self):
+        # the default route has no concurrency limit; this has to work on
+        # every supported version of Python, not just 3.10 and later
+        gpt = GPT(make_args(), MockLogger())
+        gpt.tokenizer = Tokenizer(MockArgs(model="math"), MockLogger())
+        with patch("src.gpt.openai.ChatCompletion") as api:
+            def create(messages, stream=False, **kwargs):
+                if stream:
+                    return iter([ {"choices": [{"delta": {"content": messages[-1]["content"]}}]} ])
+                return make_result(messages[-1]["content"])
+            api.create = create
+            self.assertEqual(await gpt.query("system", "hello"), "hello")
+            self.assertEqual([ piece async for piece in gpt.stream("system", "there") ], ["there"])
+
+    async def test_latencies_are_kept_per_route(self):
+        gpt, models = self.make_gpt([ { "model": "gpt-3.5-turbo", "max_input_tokens": 1 } ])
+        gpt.hedge_percentile = 50
+        fast = gpt.routes[0]
+        fast.latencies.extend([0.1] * HEDGE_MIN_SAMPLES)
+        gpt.default_route.latencies.extend([5.0] * HEDGE_MIN_SAMPLES)
+        self.assertEqual(gpt._hedge_delay(fast), 0.1)
+        self.assertEqual(gpt._hedge_delay(gpt.default_route), 5.0)
+
+    def test_bad_routes(self):
+        with self.assertRaises(ValueError):
+            self.make_gpt([ { "model": "gpt-5" } ])
+        with self.assertRaises(ValueError):
+            self.make_gpt([ { "model": "gpt-4", "max_tokens": 10 } ])
+
+class TestRateLimiter(unittest.IsolatedAsyncioTestCase):
+
+    async def test_rpm(self):
+        limiter = RateLimiter(rpm=2)
+        # two requests made just under a minute ago
+        limiter._sent.extend([ (time.monotonic() - 59.95, 0) ] * 2)
+        start = time.monotonic()
+        await limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        self.assertEqual(len(limiter._sent), 1)
+
+    async def test_tpm(self):
+        limiter = RateLimiter(tpm=100)
+        await limiter.acquire(60)
+        limiter._sent[0] = (time.monotonic() - 59.95, 60)
+        start = time.monotonic()
+        await limiter.acquire(60)
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+        # one request bigger than the budget isn't held up forever
+        await asyncio.wait_for(RateLimiter(tpm=10).acquire(50), 1)
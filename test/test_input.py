@@ -1,6 +1,12 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from src.input import Input
+from src.line_index import LineIndex
 
 class TestInput(unittest.TestCase):
     def setUp(self):
@@ -56,3 +62,98 @@ class TestInput(unittest.TestCase):
         with self.assertRaises(ValueError):
             input_obj._filter_lines(["line 1", "line 2", "line 3", "line 4", "line 5"])
 
+
+class TestInputIterLines(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "input.txt")
+        with open(self.path, "w") as f:
+            for i in range(1, 3001):
+                f.write(f"line {i}\n")
+        self.logger = MagicMock()
+        self.logger.fatal_error.side_effect = Exception("fatal error")
+
+        self.index_dir = tempfile.mkdtemp()
+        patcher = patch("src.line_index.index_directory", return_value=self.index_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        shutil.rmtree(self.index_dir)
+
+    def make_input(self, lines):
+        args = MagicMock()
+        args.input = self.path
+        args.lines = lines
+        return Input(args, self.logger)
+
+    def test_all_lines(self):
+        input_obj = self.make_input(None)
+        self.assertEqual(list(input_obj.iter_lines()), input_obj.get_text_lines())
+
+    def test_ranges_match_get_text_lines(self):
+        for lines in ["5", "1-3,2999-3000", "1023-1026,2048", "3000"]:
+            input_obj = self.make_input(lines)
+            self.assertEqual(list(input_obj.iter_lines()), input_obj.get_text_lines())
+
+    def test_index_is_saved_and_reused(self):
+        list(self.make_input("10-12").iter_lines())
+        self.assertEqual(len(os.listdir(self.index_dir)), 1)
+        # nothing is written next to the input
+        self.assertEqual(os.listdir(self.temp_dir), ["input.txt"])
+
+        with patch.object(LineIndex, "_build") as build:
+            self.assertEqual(list(self.make_input("2050").iter_lines()), ["line 2050\n"])
+            build.assert_not_called()
+
+    def test_index_rebuilt_when_file_changes(self):
+        list(self.make_input("1").iter_lines())
+        with open(self.path, "a") as f:
+            f.write("line 3001\n")
+        self.assertEqual(list(self.make_input("3001").iter_lines()), ["line 3001\n"])
+
+    def test_count_lines(self):
+        self.assertEqual(self.make_input(None).count_lines(), 3000)
+        # without -L there's no index
+        self.assertEqual(os.listdir(self.index_dir), [])
+        self.assertEqual(self.make_input("1-3,2048").count_lines(), 4)
+
+    def test_line_endings(self):
+        with open(self.path, "wb") as f:
+            f.write(b"".join(f"line {i}".encode() + [b"\n", b"\r\n", b"\r"][i % 3] for i in range(1, 3001)))
+            f.write(b"last")
+
+        # -L numbers the lines the same way as reading the whole file does
+        everything = self.make_input(None)
+        self.assertEqual(everything.count_lines(), 3001)
+        for lines in ["1-3001", "1023-1026,2048", "3001"]:
+            input_obj = self.make_input(lines)
+            self.assertEqual(list(input_obj.iter_lines()), input_obj.get_text_lines())
+            self.assertEqual(input_obj.count_lines(), len(input_obj.get_text_lines()))
+
+    def test_same_encoding_with_and_without_index(self):
+        with open(self.path, "wb") as f:
+            f.write("línea 1\n".encode("utf-8"))
+
+        # in a locale whose encoding isn't UTF-8 (the C locale's is ASCII)
+        script = "\n".join([
+            "import sys",
+            "from unittest.mock import MagicMock",
+            "from src.line_index import LineIndex",
+            "def read(function):",
+            "    try:",
+            "        return function()",
+            "    except UnicodeDecodeError:",
+            "        return 'UnicodeDecodeError'",
+            "print(repr(read(lambda: open(sys.argv[1], 'r').readline())))",
+            "print(repr(read(lambda: next(LineIndex(sys.argv[1], MagicMock()).read_lines(1, 1)))))"])
+        env = dict(os.environ, LC_ALL="C", PYTHONUTF8="0", PYTHONCOERCECLOCALE="0", PYTHONIOENCODING="utf-8", TMPDIR=self.index_dir)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run([ sys.executable, "-c", script, self.path ], cwd=root, env=env, capture_output=True, text=True)
+        without_index, with_index = result.stdout.splitlines()
+        self.assertEqual(with_index, without_index)
+
+    def test_invalid_range(self):
+        with self.assertRaises(Exception):
+            list(self.make_input("2990-3010").iter_lines())
@@ -4,6 +4,7 @@ import os
 import subprocess
 import tempfile
 import shutil
+import socket
 from pathlib import Path
 
 class BaseIntegrationTest(unittest.TestCase):
@@ -105,6 +106,60 @@ class IntegrationTest(BaseIntegrationTest):
  
         self.check_log_contents(log_file)     
 
+    def test_promptall_sharded(self):
+        output = self.run_tool(["prompt-all", "-m", "math", "-i", self.fixture_file("0123.txt"), "-p", self.fixture_file("paragraph.txt"), "-o", self.temp_file("output.txt"), "-w", "2", "--shards", "2"])
+
+        output_file = self.get_file_contents(self.temp_file("output.txt"))
+        log_file = self.get_file_contents(self.temp_file("output.txt.log"))
+
+        # the workers' answers are written in the original order
+        self.assertEqual("0\n1\n2\n3\n", output_file)
+        self.assertIn("[shards] 4 jobs", log_file)
+        self.assertNotIn("ERROR", log_file.upper())
+
+    def test_promptall_batch(self):
+        output = self.run_tool(["prompt-all", "-m", "math", "-i", self.fixture_file("0123.txt"), "-p", self.fixture_file("paragraph.txt"), "-o", self.temp_file("output.txt"),
+                                "--batch", "--batch-backend", "local", "--batch-poll", "0"])
+
+        output_file = self.get_file_contents(self.temp_file("output.txt"))
+        log_file = self.get_file_contents(self.temp_file("output.txt.log"))
+
+        # the answers come back shuffled but are written in the original order
+        self.assertEqual("0\n1\n2\n3\n", output_file)
+        self.assertIn("[batch] 4 of 4 requests answered", log_file)
+        self.assertTrue(os.path.exists(self.temp_file("output.txt.batch.jsonl")))
+        self.assertNotIn("ERROR", log_file.upper())
+
+    def test_promptall_sharded_with_metrics(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = str(s.getsockname()[1])
+        output = self.run_tool(["prompt-all", "-m", "math", "-i", self.fixture_file("0123.txt"), "-p", self.fixture_file("paragraph.txt"), "-o", self.temp_file("output.txt"),
+                                "--shards", "2", "--metrics-port", port, "--trace", self.temp_file("trace.json")])
+
+        # only the coordinator serves metrics and writes the trace
+        self.assertEqual("0\n1\n2\n3\n", self.get_file_contents(self.temp_file("output.txt")))
+        for number in range(2):
+            self.assertNotIn("Fatal", self.get_file_contents(self.temp_file(f"output.txt.shard{number}.log")))
+        self.assertTrue(os.path.exists(self.temp_file("trace.json")))
+
+    def test_promptall_previous(self):
+        self.run_tool(["prompt-all", "-m", "math", "-i", self.fixture_file("0123.txt"), "-p", self.fixture_file("paragraph.txt"), "-o", self.temp_file("old.txt")])
+        with open(self.temp_file("new_input.txt"), 'w') as f:
+            f.write("0*0\n0+1\n5*5\n1+1+1\n")
+
+        output = self.run_tool(["prompt-all", "-m", "math", "-i", self.temp_file("new_input.txt"), "-p", self.fixture_file("paragraph.txt"), "-o", self.temp_file("output.txt"),
+                                "--previous-input", self.fixture_file("0123.txt"), "--previous-output", self.temp_file("old.txt")])
+
+        output_file = self.get_file_contents(self.temp_file("output.txt"))
+        log_file = self.get_file_contents(self.temp_file("output.txt.log"))
+
+        # only the edited line is sent to GPT
+        self.assertEqual("0\n1\n25\n3\n", output_file)
+        self.assertIn("sending 1 lines to GPT", log_file)
+        self.assertEqual(1, log_file.count("[_run_prompt] prompt:"))
+        self.check_log_contents(log_file)
+
     def test_chat(self):
         output = self.run_tool(["chat", "-m", "math", "-o", self.temp_file("output.txt")], stdin=self.fixture_file("chat.txt"))
 
@@ -120,6 +175,35 @@ class IntegrationTest(BaseIntegrationTest):
         self.check_log_contents(log_file)     
 
 
+    def test_chat_summarize_needs_budget(self):
+        output = self.run_tool(["chat", "-m", "math", "--summarize-history", "-o", self.temp_file("output.txt")], stdin=self.fixture_file("chat.txt"))
+
+        self.assertEqual(output.returncode, 1)
+        self.assertIn("Fatal: --summarize-history needs --history-tokens.", self.get_file_contents(self.temp_file("output.txt")))
+
+    def test_chat_stream(self):
+        output = self.run_tool(["chat", "-m", "math", "--stream", "-o", self.temp_file("output.txt")], stdin=self.fixture_file("chat.txt"))
+
+        output_file = self.get_file_contents(self.temp_file("output.txt"))
+        log_file = self.get_file_contents(self.temp_file("output.txt.log"))
+
+        self.assertIn("2", output.stdout)
+        self.assertEqual("2\n", output_file)
+        self.assertIn("2\n", log_file)
+
+        self.check_log_contents(log_file)
+
+    def test_prompt_stream(self):
+        output = self.run_tool(["prompt", "-m", "math", "--stream", "-i", self.fixture_file("one-plus-one.txt"), "-o", self.temp_file("output.txt")])
+
+        output_file = self.get_file_contents(self.temp_file("output.txt"))
+        log_file = self.get_file_contents(self.temp_file("output.txt.log"))
+
+        self.assertIn("2", output.stdout)
+        self.assertEqual("2\n", output_file)
+
+        self.check_log_contents(log_file)
+
     def test_prompt_directory(self):
         output = self.run_tool(["prompt-folder", "-m", "math", "--input-dir", self.fixture_dir(), "-p", self.fixture_file("paragraph.txt"), "-o", self.temp_file("output.txt"), "-w", "2"])
 
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from aiohttp.test_utils import TestClient, TestServer
+from mock.logger import MockLogger
+from mock.args import MockArgs
+
+from src.job_server import JobServer
+from src.warm_state import warm_state
+from tool import build_parser
+
+class TestJobServer(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.test_dir = os.path.dirname(os.path.abspath(__file__))
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+        warm_state.start(4)
+        self.addCleanup(warm_state.stop)
+
+        self.server = JobServer(MockArgs(socket=None), MockLogger(), build_parser())
+        self.client = TestClient(TestServer(self.server.make_app()))
+        await self.client.start_server()
+        self.addAsyncCleanup(self.client.close)
+
+    def fixture_file(self, relative_path):
+        return os.path.join(self.test_dir, "fixtures/files", relative_path)
+
+    async def submit(self, argv):
+        response = await self.client.post("/jobs", json={ "argv": argv, "cwd": self.temp_dir })
+        return response.status, await response.json()
+
+    async def test_prompt_all_job(self):
+        with open(os.path.join(self.temp_dir, "wordlist.json"), 'w') as f:
+            f.write('["1", ["one"]]\n')
+        argv = ["prompt-all", "-m", "math", "-i", self.fixture_file("0123.txt"), "-p", self.fixture_file("paragraph.txt"), "--wordlist", "wordlist.json"]
+
+        # relative paths are relative to the cwd the job was sent with
+        status, answer = await self.submit(argv + ["-o", "first.txt"])
+        self.assertEqual(status, 200)
+        self.assertEqual(answer["status"], "done")
+        self.assertEqual(answer["output"], os.path.join(self.temp_dir, "first.txt"))
+        with open(answer["output"]) as f:
+            self.assertEqual(f.read(), "0\n1\n2\n3\n")
+
+        # the second job reuses the parsed wordlist
+        status, answer = await self.submit(argv + ["-o", "second.txt"])
+        self.assertEqual(answer["status"], "done")
+        self.assertEqual((warm_state.misses, warm_state.hits), (1, 1))
+
+        response = await self.client.get("/status")
+        self.assertEqual((await response.json())["finished"], 2)
+
+    async def test_failed_job(self):
+        status, answer = await self.submit(["prompt-all", "-m", "math", "-i", "missing.txt", "-p", self.fixture_file("paragraph.txt")])
+        self.assertEqual(answer["status"], "error")
+        with open(os.path.join(self.temp_dir, "output.txt.log")) as f:
+            self.assertIn("Fatal", f.read())
+        # the input is only read once the pool is started; its workers are gone
+        self.assertFalse([ task for task in asyncio.all_tasks() if "AsyncWorkerPool._worker" in repr(task.get_coro()) ])
+
+        # the server carries on after a job fails
+        status, answer = await self.submit(["prompt-all", "-m", "math", "-i", self.fixture_file("0123.txt"), "-p", self.fixture_file("paragraph.txt")])
+        self.assertEqual(answer["status"], "done")
+
+    async def test_rejected_jobs(self):
+        status, answer = await self.submit(["counttokens", "-i", "input.txt"])
+        self.assertEqual(status, 400)
+        self.assertIn("can be submitted", answer["error"])
+
+        status, answer = await self.submit(["prompt-all", "-i", "input.txt"])
+        self.assertIn("-p/--prompt", answer["error"])
+
+        status, answer = await self.submit(["prompt-all", "-i", "input.txt", "-p", "prompt.txt", "--trace", "trace.json"])
+        self.assertIn("--trace", answer["error"])
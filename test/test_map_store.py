@@ -0,0 +1,61 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import unittest
+from unittest.mock import patch
+from mock.logger import MockLogger
+
+import src.map_store
+from src.map_store import MapStore
+
+class TestMapStore(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "store.sqlite")
+        self.store = MapStore(self.path, MockLogger())
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.temp_dir)
+
+    async def test_miss(self):
+        self.assertIsNone(await self.store.get("BH1", 0, "p", "l"))
+        self.assertEqual(self.store.misses, 1)
+
+    async def test_put_get(self):
+        await self.store.put("BH1", 0, "p", "l", "output")
+        self.assertEqual(await self.store.get("BH1", 0, "p", "l"), "output")
+        self.assertEqual(self.store.hits, 1)
+
+    async def test_key_includes_prompt_and_line(self):
+        await self.store.put("BH1", 0, "p", "l", "output")
+        self.assertIsNone(await self.store.get("BH1", 0, "other prompt", "l"))
+        self.assertIsNone(await self.store.get("BH1", 0, "p", "edited line"))
+        self.assertIsNone(await self.store.get("BH1", 1, "p", "l"))
+        self.assertIsNone(await self.store.get("AB1", 0, "p", "l"))
+
+    async def test_persists(self):
+        await self.store.put("BH1", 3, "p", "l", "output")
+        self.store.close()
+
+        self.store = MapStore(self.path, MockLogger())
+        self.assertEqual(await self.store.get("BH1", 3, "p", "l"), "output")
+
+    async def test_commits_in_groups(self):
+        def committed():
+            with sqlite3.connect(self.path) as connection:
+                return connection.execute("SELECT COUNT(*) FROM map_outputs").fetchone()[0]
+
+        with patch.object(src.map_store, "COMMIT_EVERY", 3):
+            for line in range(4):
+                await self.store.put("BH1", line, "p", "l", "output")
+            self.assertEqual(committed(), 3)
+            self.store.close()
+        self.assertEqual(committed(), 4)
+        self.store = MapStore(self.path, MockLogger())
+
+    def test_hash(self):
+        self.assertEqual(self.store.hash("abc"), self.store.hash("abc"))
+        self.assertNotEqual(self.store.hash("abc"), self.store.hash("abd"))
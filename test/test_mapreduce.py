@@ -0,0 +1,151 @@
+import asyncio
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import unittest
+from unittest.mock import AsyncMock, patch
+from mock.logger import MockLogger
+from mock.args import MockArgs
+
+from src.map_store import MapStore
+from src.mapreduce import MapReduce
+from src.worker_pool import AsyncWorkerPool
+
+class TestMapReduce(unittest.IsolatedAsyncioTestCase):
+
+    def make_map_reduce(self, reduce_tokens=3000, gpt=None):
+        args = MockArgs(model="math", workers=2, schedule="fifo", task_timeout=None, reduce_tokens=reduce_tokens, map_store=None)
+        mr = MapReduce(args, MockLogger(), gpt)
+        mr.pool = AsyncMock()
+        mr.reduce_prompt = "Summarize"
+        return mr
+
+    def setup_file(self, mr, fileid, total_lines):
+        mr._output_data[fileid] = {}
+        mr._remaining[fileid] = total_lines
+        mr._map_done[fileid] = False
+
+    async def test_reduce_queued_once_after_all_lines(self):
+        mr = self.make_map_reduce()
+        self.setup_file(mr, "BH1", 3)
+
+        for index in [2, 0]:
+            await mr._map_callback(f"out{index}", "BH1", index, 3, 10)
+            mr.pool.add_task.assert_not_called()
+
+        await mr._map_callback("out1", "BH1", 1, 3, 10)
+        mr.pool.add_task.assert_called_once()
+        args = mr.pool.add_task.call_args.args
+        self.assertEqual(args[1], "BH1")
+        self.assertEqual(args[2], ["out0", "out1", "out2"])
+
+    async def test_duplicate_callback_does_not_complete_file(self):
+        mr = self.make_map_reduce()
+        self.setup_file(mr, "BH1", 2)
+
+        await mr._map_callback("out0", "BH1", 0, 2, 10)
+        await mr._map_callback("out0", "BH1", 0, 2, 10)
+        mr.pool.add_task.assert_not_called()
+
+        await mr._map_callback("out1", "BH1", 1, 2, 10)
+        await mr._map_callback("out1", "BH1", 1, 2, 10)
+        mr.pool.add_task.assert_called_once()
+
+    async def test_concurrent_callbacks_reduce_exactly_once(self):
+        mr = self.make_map_reduce()
+        self.setup_file(mr, "AB2", 50)
+
+        await asyncio.gather(*[mr._map_callback(str(i), "AB2", i, 50, 10) for i in range(50)])
+        mr.pool.add_task.assert_called_once()
+
+    async def test_tree_reduce(self):
+        # the fake reduce just counts the words it was given
+        reduce_inputs = []
+        async def query(system, user):
+            reduce_inputs.append(user)
+            return str(len(user.split()))
+        gpt = AsyncMock()
+        gpt.query.side_effect = query
+
+        mr = self.make_map_reduce(reduce_tokens=10, gpt=gpt)
+        mr.reduce_prompt = "Summarize {AUTHOR}"
+        mr.pool = AsyncWorkerPool(worker_count=3, logger=mr.logger)
+        await mr.pool.start()
+
+        self.setup_file(mr, "BH1", 8)
+        for i in range(8):
+            await mr._map_callback("one two three four", "BH1", i, 8, 32)
+        await mr.pool.join()
+
+        # 8 outputs of 4 words -> 4 chunks of 8 words -> 4 one-word partials -> 1 final reduce
+        self.assertEqual(len(reduce_inputs), 5)
+        self.assertTrue(all(len(data.split()) <= 10 for data in reduce_inputs))
+        self.assertEqual(mr.logger.outputs, ["REDUCTION FOR BH1: 4"])
+        self.assertEqual(mr._partials, {})
+
+    async def test_reduce_chunks_leave_room_for_the_prompt(self):
+        requests = []
+        async def query(system, user):
+            requests.append((system, user))
+            return "partial"
+        gpt = AsyncMock()
+        gpt.query.side_effect = query
+
+        mr = self.make_map_reduce(reduce_tokens=12, gpt=gpt)
+        mr.reduce_prompt = "Summarize these four words"
+        mr.pool = AsyncWorkerPool(worker_count=3, logger=mr.logger)
+        await mr.pool.start()
+
+        self.setup_file(mr, "BH1", 6)
+        for i in range(6):
+            await mr._map_callback("one two three four", "BH1", i, 6, 24)
+        await mr.pool.join()
+
+        # 8 tokens of outputs fit with the 4 of the prompt
+        self.assertEqual(len(requests), 4)
+        self.assertTrue(all(len(system.split()) + len(user.split()) <= 12 for system, user in requests))
+
+    async def test_map_reuses_stored_output(self):
+        gpt = AsyncMock()
+        gpt.query.return_value = "fresh"
+
+        mr = self.make_map_reduce(gpt=gpt)
+        mr.map_prompt = "Translate"
+        mr.map_store = MapStore(":memory:", mr.logger)
+        mr.map_prompt_hash = mr.map_store.hash(mr.map_prompt)
+
+        self.assertEqual(await mr._map("line one", "BH1", 0), "fresh")
+        self.assertEqual(await mr._map("line one", "BH1", 0), "fresh")
+        self.assertEqual(gpt.query.call_count, 1)
+
+        # an edited line is mapped again
+        self.assertEqual(await mr._map("line one, edited", "BH1", 0), "fresh")
+        self.assertEqual(gpt.query.call_count, 2)
+        mr.map_store.close()
+
+    async def test_map_store_is_committed_when_the_run_is_cut_short(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+        store = os.path.join(temp_dir, "store.sqlite")
+        args = MockArgs(model="math", workers=2, schedule="fifo", task_timeout=None, reduce_tokens=3000, map_store=store,
+                        input_dir=os.path.join(fixtures, "directory"), map_prompt=os.path.join(fixtures, "files/paragraph.txt"),
+                        reduce_prompt=os.path.join(fixtures, "files/paragraph.txt"))
+        gpt = AsyncMock()
+        gpt.query.return_value = "mapped"
+        mr = MapReduce(args, MockLogger(), gpt)
+
+        # e.g. Ctrl-C once the maps are done
+        async def interrupted_join(pool):
+            await asyncio.sleep(0.05)
+            await pool.stop()
+            raise asyncio.CancelledError()
+
+        with patch.object(AsyncWorkerPool, "join", interrupted_join):
+            with self.assertRaises(asyncio.CancelledError):
+                await mr.map_reduce()
+
+        with sqlite3.connect(store) as connection:
+            self.assertEqual(connection.execute("SELECT COUNT(*) FROM map_outputs").fetchone()[0], 4)
@@ -0,0 +1,100 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+
+import unittest
+from unittest.mock import patch
+from mock.logger import MockLogger
+from mock.args import MockArgs
+
+from src.metrics import Metrics, MetricsReporter, registry, progress_line, prometheus_text
+from src.worker_pool import AsyncWorkerPool
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counters_gauges_and_latency(self):
+        metrics = Metrics()
+        metrics.increment("gpt_requests_total")
+        metrics.increment("gpt_prompt_tokens_total", 30)
+        metrics.add("tasks_in_flight", 2)
+        metrics.add("tasks_in_flight", -1)
+        for seconds in range(1, 101):
+            metrics.observe("gpt_request_seconds", seconds / 100)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["counters"], { "gpt_requests_total": 1, "gpt_prompt_tokens_total": 30 })
+        self.assertEqual(snapshot["gauges"], { "tasks_in_flight": 1 })
+        self.assertAlmostEqual(snapshot["latency_seconds"]["gpt_request_seconds"]["p50"], 0.505)
+        self.assertGreater(snapshot["rates"]["gpt_tokens_per_second"], 0)
+
+    def test_eta(self):
+        metrics = Metrics()
+        metrics.add("tasks_queued", 10)
+        with patch("src.metrics.time.monotonic", return_value=metrics.start_time + 10):
+            metrics.increment("tasks_completed_total", 5)
+            # 0.5 tasks a second with 10 left in the queue
+            self.assertAlmostEqual(metrics.snapshot()["eta_seconds"], 20)
+
+        metrics.expect_tasks(105)
+        with patch("src.metrics.time.monotonic", return_value=metrics.start_time + 20):
+            metrics.increment("tasks_completed_total", 5)
+            # 0.5 tasks a second since the last snapshot, with 95 to go
+            self.assertAlmostEqual(metrics.snapshot()["eta_seconds"], 190)
+
+    def test_retry_counter(self):
+        metrics = Metrics()
+        before_sleep = metrics.retry_counter("gpt")
+        before_sleep(None)
+        before_sleep(None)
+        self.assertEqual(metrics.counters["gpt_retries_total"], 2)
+
+    def test_prometheus_text(self):
+        metrics = Metrics()
+        metrics.increment("tasks_completed_total", 3)
+        metrics.observe("task_seconds", 1.5)
+        text = prometheus_text(metrics.snapshot())
+        self.assertIn("# TYPE gpttools_tasks_completed_total counter\ngpttools_tasks_completed_total 3\n", text)
+        self.assertIn('gpttools_task_seconds{quantile="0.99"} 1.5', text)
+
+    def test_progress_line(self):
+        metrics = Metrics()
+        metrics.increment("gpt_requests_total", 4)
+        metrics.increment("gpt_retries_total")
+        line = progress_line(metrics.snapshot())
+        self.assertTrue(line.startswith("[metrics] tasks: 0 done, 0 in flight, 0 queued"))
+        self.assertIn("GPT: 4 requests, 1 retries", line)
+
+class TestMetricsReporter(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.temp_dir, "output.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    async def test_pool_updates_and_file_written(self):
+        async def task():
+            await asyncio.sleep(0)
+
+        logger = MockLogger()
+        reporter = MetricsReporter(MockArgs(output=self.output, metrics_interval=60, metrics_port=None), logger)
+        await reporter.start()
+        pool = AsyncWorkerPool(worker_count=2, logger=logger)
+        await pool.start()
+        for _ in range(3):
+            await pool.add_task(task, callback=None)
+        await pool.join()
+        await reporter.stop()
+
+        with open(self.output + ".metrics.json") as f:
+            snapshot = json.load(f)
+        self.assertEqual(snapshot["counters"]["tasks_completed_total"], 3)
+        self.assertEqual(snapshot["gauges"], { "tasks_queued": 0, "tasks_in_flight": 0 })
+        self.assertTrue(any(log.startswith("[metrics] tasks: 3 done") for log in logger.logs))
+        self.assertFalse(registry.enabled)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import json
+import unittest
+from aiohttp.test_utils import TestClient, TestServer
+from mock.logger import MockLogger
+from mock.args import MockArgs
+
+from src.mock_server import MockServer
+
+class TestMockServer(unittest.IsolatedAsyncioTestCase):
+
+    async def make_client(self, **kwargs):
+        defaults = dict(model=None, seed=0, responder="math", latency=0, latency_distribution="fixed",
+                        latency_sigma=0.5, latency_per_token=0, concurrency=None, rpm=None, tpm=None,
+                        error_429=0, error_500=0)
+        defaults.update(kwargs)
+        self.server = MockServer(MockArgs(**defaults), MockLogger())
+        client = TestClient(TestServer(self.server.make_app()))
+        await client.start_server()
+        self.addAsyncCleanup(client.close)
+        return client
+
+    def chat(self, content, **kwargs):
+        body = { "model": "gpt-4", "messages": [ { "role": "system", "content": "add" }, { "role": "user", "content": content } ] }
+        body.update(kwargs)
+        return body
+
+    async def test_chat_completion(self):
+        client = await self.make_client()
+        response = await client.post("/v1/chat/completions", json=self.chat("1+1\n2*3"))
+        self.assertEqual(response.status, 200)
+        body = await response.json()
+        self.assertEqual(body["choices"][0]["message"]["content"], "2\n6")
+        self.assertEqual(body["usage"]["prompt_tokens"], 3)
+        self.assertEqual(body["usage"]["completion_tokens"], 2)
+
+    async def test_echo(self):
+        client = await self.make_client(responder="echo")
+        response = await client.post("/v1/chat/completions", json=self.chat("hello there", n=2))
+        body = await response.json()
+        self.assertEqual([choice["message"]["content"] for choice in body["choices"]], ["hello there", "hello there"])
+
+    async def test_stream(self):
+        client = await self.make_client(responder="echo")
+        response = await client.post("/v1/chat/completions", json=self.chat("one two  three", stream=True))
+        self.assertEqual(response.status, 200)
+        text = await response.text()
+        events = [ line[len("data: "):] for line in text.split("\n\n") if line ]
+        self.assertEqual(events[-1], "[DONE]")
+        pieces = [ json.loads(event)["choices"][0]["delta"].get("content", "") for event in events[:-1] ]
+        self.assertEqual("".join(pieces), "one two  three")
+
+    async def test_embeddings(self):
+        client = await self.make_client()
+        response = await client.post("/v1/embeddings", json={ "model": "text-embedding-ada-002", "input": "hello" })
+        body = await response.json()
+        self.assertEqual(body["data"][0]["embedding"], self.server.embeddings._test_math("hello"))
+        self.assertEqual(body["usage"]["prompt_tokens"], 1)
+
+    async def test_injected_errors(self):
+        client = await self.make_client(error_429=0.5, error_500=0.5)
+        statuses = []
+        for _ in range(20):
+            response = await client.post("/v1/chat/completions", json=self.chat("1+1"))
+            statuses.append(response.status)
+        self.assertEqual(set(statuses), {429, 500})
+        self.assertEqual(self.server.stats["429"] + self.server.stats["500"], 20)
+
+    async def test_rpm_limit(self):
+        client = await self.make_client(rpm=2)
+        statuses = []
+        for _ in range(3):
+            response = await client.post("/v1/chat/completions", json=self.chat("1+1"))
+            statuses.append(response.status)
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertIn("Retry-After", response.headers)
+
+    async def test_bad_expression(self):
+        client = await self.make_client()
+        response = await client.post("/v1/chat/completions", json=self.chat("not math"))
+        self.assertEqual(response.status, 400)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from mock.logger import MockLogger
+from mock.args import MockArgs
+
+from src.input import Input
+from src.mapreduce import MapReduce
+from src.planner import Planner, REDUCE_OUTPUT_TOKENS
+from src.prompt_folder import PromptFolder
+
+class TestPlanner(unittest.IsolatedAsyncioTestCase):
+
+    def make_args(self, **kwargs):
+        defaults = dict(model="math", top_p=1.0, best_of=1, max_tokens=9000, gpt_n=1,
+                        hedge_percentile=None, hedge_budget=0.05, workers=2, task_timeout=None,
+                        rpm=60, tpm=600, completion_ratio=1.0, processes=1,
+                        prompt="test/fixtures/files/one-plus-one.txt",
+                        map_prompt="test/fixtures/files/one-plus-one.txt",
+                        reduce_prompt="test/fixtures/files/one-plus-one.txt",
+                        input_dir="test/fixtures/directory", schedule="fifo",
+                        chunk_tokens=2000, reduce_tokens=3000, map_store=None)
+        defaults.update(kwargs)
+        return MockArgs(**defaults)
+
+    async def test_plan_prompt_all(self):
+        args = self.make_args(input="test/fixtures/files/0123.txt", lines=None)
+        logger = MockLogger()
+        planner = Planner(args, logger)
+        await planner.plan_prompt_all(Input(args, logger))
+
+        # each line is one word, and the prompt "1+1" is one word
+        self.assertEqual(planner.requests, 4)
+        self.assertEqual(planner.prompt_tokens, 8)
+        self.assertEqual(planner.completion_tokens, 4)
+        self.assertEqual(logger.outputs[0], "Dry run for math: 4 requests")
+        self.assertEqual(logger.fatals, [])
+
+    def routes_file(self, routes):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, "routes.json")
+        with open(path, 'w') as f:
+            json.dump(routes, f)
+        return path
+
+    async def test_plan_prompt_all_with_routes(self):
+        routes = self.routes_file([ { "model": "gpt-4", "pattern": "\\+" } ])
+        args = self.make_args(input="test/fixtures/files/0123.txt", lines=None, routes=routes)
+        logger = MockLogger()
+        planner = Planner(args, logger)
+        await planner.plan_prompt_all(Input(args, logger))
+
+        # the lines with a + go to gpt-4, the others to --model
+        self.assertEqual(planner.usage_by_model, {
+            "gpt-4": { "requests": 2, "prompt": 4, "completion": 2 },
+            "math": { "requests": 2, "prompt": 4, "completion": 2 } })
+        self.assertIn("  gpt-4: 2 requests, 4 prompt tokens, 2 completion tokens, $0.0", logger.outputs)
+
+    def test_plan_reduce_with_routes(self):
+        routes = self.routes_file([ { "model": "gpt-4", "pattern": "." }, { "model": "gpt-3.5-turbo", "max_input_tokens": 900 } ])
+        planner = Planner(self.make_args(reduce_tokens=1000, routes=routes), MockLogger())
+        planner._plan_reduce(10, 800)
+        planner._plan_reduce(10, 950)
+        self.assertEqual(planner.usage_by_model["gpt-3.5-turbo"]["prompt"], 810)
+        self.assertEqual(planner.usage_by_model["math"]["prompt"], 960)
+
+    async def test_plan_prompt_folder(self):
+        args = self.make_args()
+        logger = MockLogger()
+        planner = Planner(args, logger)
+        await planner.plan_prompt_folder(PromptFolder(planner.mock_args, logger, None))
+        self.assertEqual(planner.requests, 4)
+
+    async def test_plan_map_reduce(self):
+        args = self.make_args()
+        logger = MockLogger()
+        planner = Planner(args, logger)
+        await planner.plan_map_reduce(MapReduce(planner.mock_args, logger, None))
+
+        # one map per line plus one reduce per file
+        lines = 0
+        for name in ["zero", "one", "two", "three"]:
+            with open(f"test/fixtures/directory/{name}.txt") as f:
+                lines += len(f.readlines())
+        self.assertEqual(planner.requests, lines + 4)
+
+    def test_plan_reduce_tree(self):
+        args = self.make_args(reduce_tokens=1010)
+        planner = Planner(args, MockLogger())
+        planner._plan_reduce(10, 3000)
+        # 1000 tokens of outputs fit with the prompt;
+        # 3 chunks of 1000 reduce to 1500 tokens, 2 chunks reduce to 1000, then one final reduce
+        self.assertEqual(planner.requests, 3 + 2 + 1)
+        self.assertEqual(planner.completion_tokens, 6 * REDUCE_OUTPUT_TOKENS)
+
+    def test_projected_duration(self):
+        planner = Planner(self.make_args(), MockLogger())
+        planner.add_counted_request(100, 200)
+        planner.add_counted_request(100, 200)
+        duration, bottleneck = planner.projected_duration()
+        # 600 tokens at 600 tokens per minute
+        self.assertEqual(duration, 60)
+        self.assertTrue(bottleneck.startswith("tokens per minute"))
+
+if __name__ == '__main__':
+    unittest.main()
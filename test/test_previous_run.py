@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+from mock.logger import MockLogger
+from mock.args import MockArgs
+
+from src.previous_run import PreviousRun
+
+class TestPreviousRun(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.logger = MockLogger()
+
+    def previous_run(self, input_lines, output_lines):
+        args = MockArgs(previous_input=os.path.join(self.temp_dir, "input.txt"), previous_output=os.path.join(self.temp_dir, "output.txt"))
+        with open(args.previous_input, 'w') as f:
+            f.write("".join(line + "\n" for line in input_lines))
+        with open(args.previous_output, 'w') as f:
+            f.write("".join(line + "\n" for line in output_lines))
+        return PreviousRun(args, self.logger)
+
+    def test_unchanged_lines_are_reused(self):
+        previous = self.previous_run(["a", "b", "c", "d", "e"], ["A", "B", "C", "D", "E"])
+
+        # "b" edited, "x" inserted, "d" deleted; the last line has no newline
+        reused = previous.reusable_outputs(["a\n", "b2\n", "x\n", "c\n", "e"])
+        self.assertEqual(reused, { 0: "A", 3: "C", 4: "E" })
+        self.assertIn("3 of 5 lines unchanged; 1 changed, 1 inserted, 1 deleted", self.logger.logs[-1])
+
+    def test_repeated_lines_keep_their_position(self):
+        previous = self.previous_run(["same", "a", "same", "b"], ["S1", "A", "S2", "B"])
+        reused = previous.reusable_outputs(["new\n", "same\n", "a\n", "same\n", "b\n"])
+        self.assertEqual(reused, { 1: "S1", 2: "A", 3: "S2", 4: "B" })
+
+    def test_lines_without_an_answer_are_retried(self):
+        previous = self.previous_run(["a", "b"], ["A", ""])
+        self.assertEqual(previous.reusable_outputs(["a\n", "b\n"]), { 0: "A" })
+
+    def test_mismatched_files(self):
+        self.previous_run(["a", "b"], ["A"])
+        self.assertEqual(len(self.logger.fatals), 1)
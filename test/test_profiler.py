@@ -0,0 +1,88 @@
+import asyncio
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+
+import unittest
+from unittest.mock import patch
+from mock.logger import MockLogger
+from mock.args import MockArgs
+
+from src.profiler import Profiler
+
+def busy():
+    end = time.monotonic() + 0.05
+    while time.monotonic() < end:
+        pass
+
+class TestProfiler(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.temp_dir, "output.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    async def test_profile_busy_and_waiting(self):
+        async def waiting():
+            await asyncio.sleep(0.1)
+
+        logger = MockLogger()
+        profiler = Profiler(MockArgs(output=self.output), logger)
+        profiler.start()
+        busy()
+        await waiting()
+        profiler.stop()
+
+        with open(self.output + ".collapsed") as f:
+            collapsed = f.read()
+        self.assertIn(";busy (test_profiler.py:", collapsed)
+        self.assertIn("[idle] ", collapsed)
+        self.assertIn("[awaiting];", collapsed)
+        self.assertIn(";waiting (test_profiler.py:", collapsed)
+        for line in collapsed.splitlines():
+            self.assertRegex(line, r" \d+$")
+
+        self.assertTrue(any("busy" in function for _, _, function in pstats.Stats(self.output + ".prof").stats))
+        with open(self.output + ".alloc.txt") as f:
+            self.assertTrue(f.read().startswith("Total allocated"))
+        self.assertTrue(any(log.startswith("[profile] wrote") for log in logger.logs))
+
+    async def test_tasks_are_only_read_on_the_loop(self):
+        threads = set()
+        all_tasks = asyncio.all_tasks
+        def record(loop=None):
+            threads.add(threading.get_ident())
+            return all_tasks(loop)
+
+        profiler = Profiler(MockArgs(output=self.output), MockLogger())
+        with patch("src.profiler.asyncio.all_tasks", side_effect=record):
+            profiler.start()
+            busy()
+            await asyncio.sleep(0.1)
+            profiler.stop()
+
+        self.assertEqual(threads, { threading.get_ident() })
+        self.assertTrue(any(stack.startswith("[awaiting];") for stack in profiler.stacks))
+
+    async def test_idle_loop_is_not_woken(self):
+        loop = asyncio.get_running_loop()
+        profiler = Profiler(MockArgs(output=self.output), MockLogger())
+        profiler.start()
+        await asyncio.sleep(0.01)
+        with patch.object(loop, "call_soon_threadsafe", wraps=loop.call_soon_threadsafe) as call_soon_threadsafe:
+            await asyncio.sleep(0.1)
+        profiler.stop()
+
+        # only the samples that caught the loop busy (e.g. waking up at the
+        # end of the sleep) ask for the tasks
+        snapshots = [ call for call in call_soon_threadsafe.call_args_list if call.args[0] == profiler._snapshot_chains ]
+        self.assertGreater(profiler.idle_samples, 5)
+        self.assertLessEqual(len(snapshots), profiler.samples - profiler.idle_samples)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,7 @@
 import asyncio
 
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 from mock.logger import MockLogger
 from mock.args import MockArgs
 
@@ -41,3 +41,25 @@ class TestPrompt(unittest.IsolatedAsyncioTestCase):
         self.assertIn(test_output, logger.outputs)
         self.assertEqual(0, len(logger.fatals))
         
+
+    # Verify that a streamed answer is printed in pieces and written out whole
+    async def test_prompt_stream(self):
+        args = MockArgs(stream=True)
+        logger = MockLogger()
+
+        data = Mock()
+        data.get_text.return_value = "Hello, "
+
+        async def stream(system, user):
+            for piece in ["wor", "ld", "!"]:
+                yield piece
+        gpt = Mock(spec=GPT)
+        gpt.stream.side_effect = stream
+
+        promptone = PromptOne(args,logger,data,gpt)
+        with patch('builtins.print') as mock_print:
+            await promptone.prompt_one()
+
+        gpt.query.assert_not_called()
+        mock_print.assert_any_call("wor", end='', flush=True)
+        self.assertEqual(["world!"], logger.outputs)
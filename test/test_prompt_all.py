@@ -1,11 +1,15 @@
 
 import asyncio
+import threading
+import time
+import numpy as np
 
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 from mock.logger import MockLogger
 from mock.args import MockArgs
 
+from src.embeddings import Embeddings
 from src.gpt import GPT
 from src.input import Input
 from src.prompt_all import PromptAll
@@ -27,3 +31,48 @@ class TestPromptAll(unittest.IsolatedAsyncioTestCase):
         pa = PromptAll(Mock(), Mock(), Mock(), Mock())
         self.assertEqual(pa._count_words(text), 4)
         
+
+    async def test_pipeline(self):
+        # a stand-in for the blocking API call, which notes how many requests
+        # are in flight at once
+        batches = []
+        in_flight = [0, 0]
+        lock = threading.Lock()
+        def create(input, model, **kwargs):
+            with lock:
+                batches.append(input)
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.1)
+            with lock:
+                in_flight[0] -= 1
+            return { "data": [ { "index": i, "embedding": [1.0, 0.0] } for i in range(len(input)) ], "usage": { "prompt_tokens": len(input) } }
+
+        class FakeGPT:
+            async def query(self, system, user):
+                return str(eval(user))
+
+        class FakeTemplate:
+            def expand(self, variables):
+                return f"example: {variables['NEAREST_EXAMPLE_IN']}"
+
+        logger = MockLogger()
+        pa = PromptAll(MockArgs(workers=3, task_timeout=None, embedding_workers=2, embedding_batch=4), logger, None, FakeGPT())
+        pa.translation_helper.embeddings = Embeddings(MockArgs(model="gpt-4", api_base="http://127.0.0.1:1/v1"), logger)
+        pa.translation_helper.examples_in = ["1+1"]
+        pa.translation_helper.examples_out = ["2"]
+        pa.translation_helper.examples_embeddings = np.array([[1.0, 0.0]])
+
+        lines = [ f"{i}*3" for i in range(10) ]
+        with patch("src.embeddings.openai.Embedding") as api:
+            api.create = create
+            await pa._launch_pipeline(iter(lines), FakeTemplate(), reused={ 5: "reused" })
+
+        # answers are written in order; the reused line isn't embedded or sent
+        self.assertEqual(logger.outputs, [ str(3*i) for i in range(5) ] + [ "reused" ] + [ str(3*i) for i in range(6, 10) ])
+        self.assertEqual(sorted(batches), sorted([ lines[0:4], lines[4:5] + lines[6:9], lines[9:10] ]))
+        self.assertIn("[_run_prompt] prompt: example: 1+1", logger.logs)
+
+        # both preparation workers had a request in flight at once, so the
+        # requests didn't hold up the event loop
+        self.assertEqual(in_flight[1], 2)
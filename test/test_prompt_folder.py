@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+
+import unittest
+from mock.logger import MockLogger
+from mock.args import MockArgs
+
+from src.gpt import GPT
+from src.prompt_folder import PromptFolder
+from src.template import Template
+
+class TestPromptFolder(unittest.IsolatedAsyncioTestCase):
+
+    def make_prompt_folder(self, chunk_tokens):
+        args = MockArgs(model="math", top_p=1.0, best_of=1, max_tokens=9000, gpt_n=1,
+                        hedge_percentile=None, hedge_budget=0.05,
+                        workers=3, schedule="fifo", task_timeout=None, chunk_tokens=chunk_tokens)
+        logger = MockLogger()
+        return PromptFolder(args, logger, GPT(args, logger))
+
+    def test_split_small_file(self):
+        pf = self.make_prompt_folder(100)
+        self.assertEqual(pf._split("one two\n\nthree\n"), ["one two\n\nthree\n"])
+
+    def test_split_paragraphs(self):
+        pf = self.make_prompt_folder(3)
+        text = "a b\n\nc d\n\ne f g\n"
+        chunks = pf._split(text)
+        self.assertEqual(chunks, ["a b\n\n", "c d\n\n", "e f g\n"])
+        self.assertEqual("".join(chunks), text)
+
+    def test_split_large_paragraph_by_line(self):
+        pf = self.make_prompt_folder(2)
+        text = "a b\nc d\ne\n\nf"
+        chunks = pf._split(text)
+        self.assertEqual("".join(chunks), text)
+        self.assertTrue(all(pf.tokenizer.count(chunk) <= 2 for chunk in chunks))
+
+    def test_split_disabled(self):
+        pf = self.make_prompt_folder(0)
+        self.assertEqual(pf._split("a b c\n\nd e f"), ["a b c\n\nd e f"])
+
+    async def test_chunked_output_matches_whole_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(temp_dir, "BH1.txt"), "w") as f:
+                f.write("1+1\n\n2+2\n\n3+3\n4+4\n")
+
+            outputs = []
+            for chunk_tokens in [0, 1]:
+                pf = self.make_prompt_folder(chunk_tokens)
+                template = Template(pf.args, pf.logger, "Compute")
+                await pf._launch_jobs([os.path.join(temp_dir, "BH1.txt")], template)
+                outputs.append(pf.logger.outputs)
+
+            self.assertEqual(outputs[0], ["BH1: 2\t4\t6\t8"])
+            self.assertEqual(outputs[1], outputs[0])
+        finally:
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,165 @@
+import asyncio
+import os
+import shutil
+import socket
+import sqlite3
+import tempfile
+import time
+
+import unittest
+from unittest.mock import patch
+from mock.logger import MockLogger
+from mock.args import MockArgs
+
+from src.sharding import JobQueue, ShardCoordinator, ShardWorker, LEASE_SECONDS, worker_argv
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.queue = JobQueue(os.path.join(self.temp_dir, "jobs.sqlite"), MockLogger())
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_claim_in_order(self):
+        self.queue.add_jobs([ ("a", ["1", "2"]), ("b", ["3"]) ])
+        self.assertEqual(self.queue.claim("w1", 2), [ (1, "a", "1"), (2, "a", "2") ])
+        self.assertEqual(self.queue.claim("w2", 2), [ (3, "b", "3") ])
+        self.assertEqual(self.queue.claim("w2", 2), [])
+        self.assertEqual(self.queue.counts(), { "claimed": 3 })
+
+    def test_finished_from_stops_at_first_unfinished(self):
+        self.queue.add_jobs([ (str(i), [str(i)]) for i in range(4) ])
+        self.queue.claim("w", 4)
+        self.queue.complete(1, "one")
+        self.queue.fail(2)
+        self.queue.complete(4, "four")
+
+        finished = self.queue.finished_from(1)
+        self.assertEqual([ (row[0], row[4], row[5]) for row in finished ], [ (1, "done", "one"), (2, "failed", None) ])
+        self.assertEqual(self.queue.finished_from(3), [])
+
+    def test_no_wal(self):
+        # WAL only works between processes on one machine
+        self.assertEqual(self.queue.connection.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+
+    def test_expired_lease_is_claimed_again(self):
+        self.queue.add_jobs([ ("a", ["1"]) ])
+        self.queue.claim("dead", 1)
+        self.assertEqual(self.queue.claim("alive", 1), [])
+        with patch("src.sharding.time.time", return_value=time.time() + LEASE_SECONDS + 1):
+            self.assertEqual(self.queue.claim("alive", 1), [ (1, "a", "1") ])
+
+    def test_waiting_on_a_lock_does_not_block_the_loop(self):
+        self.queue.add_jobs([ ("a", ["1"]) ])
+        other = sqlite3.connect(os.path.join(self.temp_dir, "jobs.sqlite"), isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")
+
+        # another process holds the lock until the loop lets it go
+        async def claim():
+            claiming = asyncio.ensure_future(self.queue.call(self.queue.claim, "w", 1))
+            await asyncio.sleep(0.1)
+            self.assertFalse(claiming.done())
+            other.execute("COMMIT")
+            return await claiming
+
+        self.assertEqual(asyncio.run(claim()), [ (1, "a", "1") ])
+        other.close()
+
+class FakeProcess:
+    def __init__(self, worker_task):
+        self.worker_task = worker_task
+        self.pid = 0
+
+    def poll(self):
+        return 0 if self.worker_task.done() else None
+
+    def wait(self):
+        pass
+
+class TestSharding(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.args = MockArgs(output=os.path.join(self.temp_dir, "output.txt"), job_queue=None, shards=1, workers=3, task_timeout=None)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    async def test_coordinator_writes_in_order(self):
+        async def run_job(key, text):
+            # later jobs finish first
+            await asyncio.sleep(0.01 * (10 - int(key)))
+            if text == "fail":
+                raise ValueError("failed")
+            return text.upper()
+
+        written = []
+        async def write(key, outputs):
+            written.append((key, outputs))
+
+        worker_tasks = []
+        def start_worker(number):
+            worker = ShardWorker(self.args, MockLogger())
+            worker_tasks.append(asyncio.create_task(worker.run(run_job)))
+            return FakeProcess(worker_tasks[-1])
+
+        coordinator = ShardCoordinator(self.args, MockLogger())
+        jobs = [ ("1", ["a"]), ("2", ["b", "fail", "c"]), ("3", ["d"]) ]
+        with patch.object(coordinator, "_start_worker", start_worker), patch("src.sharding.POLL_INTERVAL", 0.01):
+            await coordinator.run(jobs, write)
+
+        self.assertEqual(written, [ ("1", ["A"]), ("2", ["B", None, "C"]), ("3", ["D"]) ])
+
+    async def test_jobs_of_dead_workers_fail(self):
+        written = []
+        async def write(key, outputs):
+            written.append((key, outputs))
+
+        class DeadProcess:
+            pid = 1234
+            def poll(self):
+                return 1
+            def wait(self):
+                pass
+
+        coordinator = ShardCoordinator(self.args, MockLogger())
+        def start_worker(number):
+            coordinator.queue.claim(f"{socket.gethostname()}:1234", 1)
+            return DeadProcess()
+
+        with patch.object(coordinator, "_start_worker", start_worker), patch("src.sharding.POLL_INTERVAL", 0.01):
+            await coordinator.run([ ("1", ["a"]), ("2", ["b"]) ], write)
+
+        self.assertEqual(written, [ ("1", [None]), ("2", [None]) ])
+
+    async def test_lease_is_held_while_the_job_runs(self):
+        claimed_at = []
+        worker = ShardWorker(self.args, MockLogger())
+        self.addCleanup(worker.queue.close)
+        worker.queue.add_jobs([ ("1", ["a"]) ])
+
+        async def run_job(key, text):
+            # long enough for the lease to be renewed twice
+            for _ in range(3):
+                claimed_at.append(worker.queue.connection.execute("SELECT claimed_at FROM jobs").fetchone()[0])
+                await asyncio.sleep(0.04)
+            return text
+
+        start = time.time()
+        with patch("src.sharding.LEASE_SECONDS", 0.09):
+            await worker.run(run_job)
+        self.assertGreaterEqual(claimed_at[0], start)
+        self.assertTrue(claimed_at[0] < claimed_at[1] < claimed_at[2])
+
+if __name__ == '__main__':
+    unittest.main()
+
+class TestWorkerArgv(unittest.TestCase):
+
+    def test_process_options_stay_with_the_coordinator(self):
+        argv = [ "tool.py", "prompt-all", "--metrics-port", "9100", "-i", "in.txt", "--profile", "--trace=run.json",
+                 "--logfile", "run.log", "--metrics-interval", "5", "-w", "4" ]
+        self.assertEqual(worker_argv(argv), [ "tool.py", "prompt-all", "-i", "in.txt", "-w", "4" ])
@@ -0,0 +1,27 @@
+import unittest
+from mock.logger import MockLogger
+from mock.args import MockArgs
+
+from src.tokenizer import Tokenizer
+
+class TestTokenizer(unittest.TestCase):
+    def setUp(self):
+        self.tokenizer = Tokenizer(MockArgs(model="math"), MockLogger())
+
+    def test_count_math(self):
+        self.assertEqual(self.tokenizer.count("one two  three\n"), 3)
+
+    def test_pack_within_budget(self):
+        chunks = self.tokenizer.pack(["a b", "c d", "e f", "g"], 4)
+        self.assertEqual(chunks, [["a b", "c d"], ["e f", "g"]])
+
+    def test_pack_oversized_piece(self):
+        chunks = self.tokenizer.pack(["a", "b c d e f", "g"], 3)
+        self.assertEqual(chunks, [["a"], ["b c d e f"], ["g"]])
+
+    def test_pack_min_pieces(self):
+        chunks = self.tokenizer.pack(["a b c", "d e f", "g h i"], 2, min_pieces=2)
+        self.assertEqual(chunks, [["a b c", "d e f"], ["g h i"]])
+
+    def test_pack_empty(self):
+        self.assertEqual(self.tokenizer.pack([], 10), [])
@@ -0,0 +1,77 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+
+import unittest
+from mock.logger import MockLogger
+
+from src.tracing import Tracer, tracer
+from src.worker_pool import AsyncWorkerPool
+
+class TestTracing(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, "trace.json")
+
+    def tearDown(self):
+        tracer.enabled = False
+        shutil.rmtree(self.temp_dir)
+
+    def read_events(self):
+        with open(self.filename) as f:
+            return json.load(f)["traceEvents"]
+
+    def test_disabled_records_nothing(self):
+        t = Tracer()
+        with t.span("nothing"):
+            pass
+        self.assertEqual(t.events, [])
+
+    def test_span_records_error(self):
+        t = Tracer()
+        t.start(self.filename)
+        with self.assertRaises(ValueError):
+            with t.span("failing", line=3):
+                raise ValueError("bad")
+        t.stop()
+
+        spans = [ event for event in self.read_events() if event["ph"] == "X" ]
+        self.assertEqual(len(spans), 1)
+        self.assertEqual(spans[0]["args"], { "line": 3, "error": "ValueError: bad" })
+
+    async def test_pool_tasks_get_lanes_and_queue_waits(self):
+        async def task(name):
+            with tracer.span("stage", item=name):
+                await asyncio.sleep(0.01)
+
+        tracer.start(self.filename)
+        pool = AsyncWorkerPool(worker_count=2, logger=MockLogger())
+        await pool.start()
+        for name in ["a", "b", "c"]:
+            await pool.add_task(task, name, callback=None)
+        await pool.join()
+        tracer.stop()
+
+        events = self.read_events()
+        lanes = { event["args"]["name"]: event["tid"] for event in events if event["ph"] == "M" }
+        self.assertIn("worker 0", lanes)
+        self.assertIn("worker 1", lanes)
+
+        tasks = [ event for event in events if event["name"] == "task" ]
+        stages = [ event for event in events if event["name"] == "stage" ]
+        self.assertEqual(len(tasks), 3)
+        self.assertEqual(len(stages), 3)
+        # each stage is on the same lane as, and inside, the task that ran it
+        for stage in stages:
+            parent = [ t for t in tasks if t["tid"] == stage["tid"] and t["ts"] <= stage["ts"] and stage["ts"] + stage["dur"] <= t["ts"] + t["dur"] + 1 ]
+            self.assertEqual(len(parent), 1)
+            self.assertIn(stage["tid"], [lanes["worker 0"], lanes["worker 1"]])
+
+        waits = [ event for event in events if event["name"] == "queue wait" ]
+        self.assertEqual(sorted(event["ph"] for event in waits), ["b", "b", "b", "e", "e", "e"])
+
+if __name__ == '__main__':
+    unittest.main()
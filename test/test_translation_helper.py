@@ -1,6 +1,9 @@
+import os
+import tempfile
 import unittest
 from unittest.mock import MagicMock, patch
-from src.translation_helper import TranslationHelper
+from mock.args import MockArgs
+from src.translation_helper import TranslationHelper, prompt_hash
 
 class TestTranslationHelper(unittest.IsolatedAsyncioTestCase):
     def setUp(self):
@@ -116,3 +119,21 @@ class TestTranslationHelper(unittest.IsolatedAsyncioTestCase):
         }
         self.assertEqual(result, expected_result)
 
+class TestPromptHash(unittest.TestCase):
+
+    def test_prompt_hash(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            wordlist = os.path.join(temp_dir, "wordlist.json")
+            with open(wordlist, 'w') as f:
+                f.write("[]")
+            args = MockArgs(model="math", wordlist=wordlist)
+
+            before = prompt_hash(args, "Translate")
+            self.assertEqual(prompt_hash(args, "Translate"), before)
+            self.assertNotEqual(prompt_hash(args, "Summarize"), before)
+            self.assertNotEqual(prompt_hash(MockArgs(model="gpt-4", wordlist=wordlist), "Translate"), before)
+
+            # answers made with another wordlist aren't reused
+            with open(wordlist, 'w') as f:
+                f.write('[{"original": "word", "translations": ["translation"]}]')
+            self.assertNotEqual(prompt_hash(args, "Translate"), before)
@@ -0,0 +1,110 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import patch
+import numpy as np
+from mock.logger import MockLogger
+
+import src.translation_memory
+from src.translation_memory import TranslationMemory
+
+class FakeEmbeddings:
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+        self.queries = 0
+
+    async def query(self, text):
+        self.queries += 1
+        vector = np.array(self.vectors[text], dtype=float)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+class TestTranslationMemory(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.path = os.path.join(self.temp_dir, "memory.sqlite")
+        self.logger = MockLogger()
+        self.embeddings = FakeEmbeddings({
+            "كتاب": [1, 0, 0],
+            "كِتَابٌ": [1, 0, 0],
+            "the book": [0, 1, 0],
+            "the books": [0.1, 1, 0],
+            "a river": [0, 0, 1]
+        })
+
+    def open(self, prompt="translate", reuse_near=False):
+        memory = TranslationMemory(self.path, self.logger, self.embeddings, TranslationMemory.hash(prompt), 0.95, reuse_near)
+        self.addCleanup(memory.close)
+        return memory
+
+    async def test_exact_match_ignores_diacritics(self):
+        memory = self.open()
+        self.assertIsNone(await memory.lookup("كتاب"))
+        await memory.store("كتاب", "book")
+
+        self.assertEqual(await memory.lookup("كِتَابٌ"), "book")
+        self.assertEqual((memory.lookups, memory.exact_hits), (2, 1))
+
+        # kept on disk for the next run, but only for the same prompt
+        memory.close()
+        self.assertEqual(await self.open().lookup("كتاب"), "book")
+        self.assertIsNone(await self.open(prompt="summarize").lookup("كتاب"))
+
+    async def test_near_match_is_flagged(self):
+        memory = self.open()
+        await memory.store("the book", "el libro")
+
+        self.assertIsNone(await memory.lookup("the books"))
+        self.assertEqual(memory.near_flagged, 1)
+        self.assertTrue(any("near match" in log and "el libro" in log for log in self.logger.logs))
+
+        # not similar enough to count
+        self.assertIsNone(await memory.lookup("a river"))
+        self.assertEqual(memory.near_flagged, 1)
+
+    async def test_near_match_is_reused(self):
+        memory = self.open()
+        await memory.store("the book", "el libro")
+        memory.close()
+
+        memory = self.open(reuse_near=True)
+        self.assertEqual(await memory.lookup("the books"), "el libro")
+        self.assertIn("1 near matches reused", memory.summary())
+        self.assertIn("100% hit rate", memory.summary())
+
+    async def test_matrix_grows_without_rebuilding(self):
+        self.embeddings.vectors.update({ f"word {i}": [1, 1, i] for i in range(5) })
+        with patch.object(src.translation_memory, "INITIAL_ROWS", 2):
+            memory = self.open()
+            await memory.store("the book", "el libro")
+            for i in range(5):
+                await memory.store(f"word {i}", f"palabra {i}")
+                # a lookup between stores doesn't stack the vectors again
+                with patch("numpy.vstack") as vstack:
+                    self.assertIsNone(await memory.lookup("a river"))
+                    vstack.assert_not_called()
+
+        self.assertEqual((memory._count, len(memory._matrix)), (6, 8))
+        memory.close()
+        self.assertEqual(await self.open(reuse_near=True).lookup("the books"), "el libro")
+
+    async def test_answers_are_written_in_groups(self):
+        def written():
+            with sqlite3.connect(self.path) as connection:
+                return connection.execute("SELECT COUNT(*) FROM memory").fetchone()[0]
+
+        self.embeddings.vectors.update({ f"word {i}": [1, 1, i] for i in range(4) })
+        memory = self.open()
+        with patch.object(src.translation_memory, "COMMIT_EVERY", 3):
+            for i in range(4):
+                await memory.store(f"word {i}", f"palabra {i}")
+        self.assertEqual(written(), 3)
+
+        # answers that aren't written yet are found all the same
+        self.assertEqual(await memory.lookup("word 3"), "palabra 3")
+        memory.close()
+        self.assertEqual(written(), 4)
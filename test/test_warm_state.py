@@ -0,0 +1,29 @@
+import asyncio
+import unittest
+
+from src.warm_state import WarmState
+
+class TestWarmState(unittest.IsolatedAsyncioTestCase):
+
+    async def test_request_slot_without_serve(self):
+        state = WarmState()
+        # no limit, on every supported version of Python
+        async with state.request_slot():
+            async with state.request_slot():
+                pass
+
+    async def test_request_slot_limits_requests(self):
+        state = WarmState()
+        state.start(1)
+        self.addCleanup(state.stop)
+
+        async with state.request_slot():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(state.request_slot().acquire(), 0.01)
+
+    def test_load_reuses_nothing_without_serve(self):
+        state = WarmState()
+        builds = []
+        state.load("wordlist", [ __file__ ], lambda: builds.append(1), None)
+        state.load("wordlist", [ __file__ ], lambda: builds.append(1), None)
+        self.assertEqual(len(builds), 2)
@@ -0,0 +1,142 @@
+import asyncio
+
+import unittest
+from mock.logger import MockLogger
+
+from src.worker_pool import AsyncWorkerPool, PRIORITY_HIGH
+
+class TestAsyncWorkerPool(unittest.IsolatedAsyncioTestCase):
+
+    async def run_tasks(self, tasks):
+        order = []
+
+        async def task(name):
+            order.append(name)
+            return name
+
+        pool = AsyncWorkerPool(worker_count=1, logger=MockLogger())
+        for name, priority in tasks:
+            await pool.add_task(task, name, callback=None, priority=priority)
+        await pool.start()
+        await pool.join()
+        return order
+
+    async def test_fifo_by_default(self):
+        order = await self.run_tasks([("a", 0), ("b", 0), ("c", 0)])
+        self.assertEqual(order, ["a", "b", "c"])
+
+    async def test_lower_priority_runs_first(self):
+        order = await self.run_tasks([("small", -10), ("large", -500), ("medium", -100)])
+        self.assertEqual(order, ["large", "medium", "small"])
+
+    async def test_high_priority_jumps_queue(self):
+        order = await self.run_tasks([("map1", 0), ("map2", 0), ("reduce", PRIORITY_HIGH)])
+        self.assertEqual(order, ["reduce", "map1", "map2"])
+
+    async def test_callback_receives_result(self):
+        results = []
+
+        async def task(x):
+            return x * 2
+
+        async def callback(result):
+            results.append(result)
+
+        pool = AsyncWorkerPool(worker_count=2, logger=MockLogger())
+        await pool.start()
+        for i in range(4):
+            await pool.add_task(task, i, callback=callback)
+        await pool.join()
+        self.assertEqual(sorted(results), [0, 2, 4, 6])
+
+    async def test_task_timeout(self):
+        results = []
+
+        async def slow():
+            await asyncio.sleep(10)
+            return "slow"
+
+        async def fast():
+            return "fast"
+
+        async def callback(result):
+            results.append(result)
+
+        logger = MockLogger()
+        pool = AsyncWorkerPool(worker_count=1, logger=logger, task_timeout=0.05)
+        await pool.start()
+        await pool.add_task(slow, callback=callback)
+        await pool.add_task(fast, callback=callback)
+        await pool.join()
+
+        self.assertEqual(results, [None, "fast"])
+        self.assertTrue(any("timed out" in log for log in logger.logs))
+
+    async def test_cancelled_task_fails_alone(self):
+        results = []
+
+        async def cancelled():
+            raise asyncio.CancelledError()
+
+        async def fast():
+            return "fast"
+
+        async def callback(result):
+            results.append(result)
+
+        logger = MockLogger()
+        pool = AsyncWorkerPool(worker_count=1, logger=logger)
+        await pool.start()
+        await pool.add_task(cancelled, callback=callback)
+        await pool.add_task(fast, callback=callback)
+        await asyncio.wait_for(pool.join(), 1)
+
+        self.assertEqual(results, [None, "fast"])
+        self.assertTrue(any("was cancelled" in log for log in logger.logs))
+
+    async def test_join_stops_workers(self):
+        async def task():
+            return None
+
+        pool = AsyncWorkerPool(worker_count=3, logger=MockLogger())
+        await pool.start()
+        workers = pool.workers
+        await pool.add_task(task, callback=None)
+        await pool.join()
+
+        self.assertEqual(pool.workers, [])
+        self.assertTrue(all(worker.done() for worker in workers))
+
+    async def test_shutdown_drops_queued_tasks(self):
+        started = []
+
+        async def task(name):
+            started.append(name)
+            await asyncio.sleep(0.01)
+
+        logger = MockLogger()
+        pool = AsyncWorkerPool(worker_count=1, logger=logger)
+        for name in ["a", "b", "c"]:
+            await pool.add_task(task, name, callback=None)
+        await pool.start()
+        await asyncio.sleep(0)
+        await pool.shutdown()
+
+        self.assertEqual(started, ["a"])
+        self.assertTrue(any("2 queued tasks dropped" in log for log in logger.logs))
+        self.assertTrue(any("task('b')" in log for log in logger.logs))
+
+    async def test_join_logs_latency_summary(self):
+        async def task(delay):
+            await asyncio.sleep(delay)
+
+        logger = MockLogger()
+        pool = AsyncWorkerPool(worker_count=2, logger=logger)
+        await pool.start()
+        for delay in [0, 0, 0.05]:
+            await pool.add_task(task, delay, callback=None)
+        await pool.join()
+
+        self.assertEqual(len(pool.latencies), 3)
+        self.assertGreaterEqual(max(pool.latencies), 0.05)
+        self.assertTrue(any(log.startswith("[pool] 3 tasks; latency p50=") for log in logger.logs))
@@ -9,11 +9,16 @@ from src.chat import chat
 from src.counttokens import count_tokens
 from src.csv_downloader import csv_download
 from src.embeddings import compute_embeddings
+from src.job_server import serve
 from src.prompt import prompt_one
 from src.prompt_all import prompt_all
 from src.prompt_folder import prompt_folder
 from src.logger import Logger
 from src.mapreduce import map_reduce
+from src.metrics import MetricsReporter
+from src.mock_server import mock_server
+from src.profiler import Profiler
+from src.tracing import tracer
 from src.url_downloader import url_download
 
 
@@ -26,7 +31,7 @@ def quote_argument(arg):
 def get_invocation():
     return ' '.join(quote_argument(arg) for arg in sys.argv)
 
-def main():
+def build_parser():
 
     common_args = argparse.ArgumentParser(add_help=False)
     common_args.add_argument('-d', '--debug', action="store_true", help="enable debug output")
@@ -36,6 +41,16 @@ def main():
                              help="File to write log entries to.  Defaults to putput file with '.log' appended.")
     common_args.add_argument('-o', '--output', type=str, default="output.txt",
                                     help='Output file.  Defaults to output.txt.')
+    common_args.add_argument('--profile', action="store_true",
+                              help="Profile the run and write <output>.prof, <output>.collapsed (for flame graphs) and <output>.alloc.txt.")
+    common_args.add_argument('--metrics-interval', type=float, default=0,
+                              help="Print progress (tasks, throughput, latency, retries, ETA) and write <output>.metrics.json every this many seconds.  Defaults to off.")
+    common_args.add_argument('--metrics-port', type=int, default=None,
+                              help="Serve the metrics in the Prometheus text format on http://127.0.0.1:<port>/metrics while running.  Optional.")
+    common_args.add_argument('--trace', type=str, default=None,
+                              help="Write a Chrome trace-event JSON file with a timed span for every stage of every task.  Optional.")
+    common_args.add_argument('--task-timeout', type=float, default=None,
+                              help='Give up on a task after this many seconds.  Optional, defaults to no timeout.')
 
     gpt_args = argparse.ArgumentParser(add_help=False)
     gpt_args.add_argument('-m', '--model', type=str, default='gpt-4',
@@ -45,6 +60,14 @@ def main():
     gpt_args.add_argument('--best-of', default=1, type=int, help="value of best_of to pass to GPT")
     gpt_args.add_argument('--max-tokens', default=9000, type=int, help="value of max_tokens to pass to GPT")
     gpt_args.add_argument('--gpt-n', default=1, type=int, help="value of n (number responses) to pass to GPT")
+    gpt_args.add_argument('--hedge-percentile', default=None, type=float,
+                              help="send a duplicate request when one takes longer than this percentile of recent requests, e.g. 95.  Optional, defaults to off.")
+    gpt_args.add_argument('--api-base', default=None, type=str,
+                              help="base URL of an OpenAI-compatible API to use instead of OpenAI, e.g. http://127.0.0.1:8000/v1 for the mock-server subcommand.  No API key is needed with this.")
+    gpt_args.add_argument('--routes', default=None, type=str,
+                              help="JSON file of rules that send each request to a model by its length or a pattern, with a concurrency and rate limit per rule.  Requests that match no rule use --model.  Optional.")
+    gpt_args.add_argument('--hedge-budget', default=0.05, type=float,
+                              help="maximum fraction of requests that may be duplicated by --hedge-percentile.  Defaults to 0.05.")
 
     input_args = argparse.ArgumentParser(add_help=False)
     input_args.add_argument('-i', '--input', type=str, required=True,
@@ -60,41 +83,101 @@ def main():
     translation_args.add_argument('--wordlist', type=str, default=None, help='JSON file with specific translations to use.')
 
 
+    plan_args = argparse.ArgumentParser(add_help=False)
+    plan_args.add_argument('--dry-run', action="store_true",
+                              help="Don't call GPT; count the tokens of every prompt and project the cost and duration of the run.")
+    plan_args.add_argument('--rpm', type=int, default=None, help='Requests per minute allowed for the model, for --dry-run.  Defaults to a typical limit.')
+    plan_args.add_argument('--tpm', type=int, default=None, help='Tokens per minute allowed for the model, for --dry-run.  Defaults to a typical limit.')
+    plan_args.add_argument('--completion-ratio', type=float, default=1.0,
+                              help='Expected answer length as a multiple of the input length, for --dry-run.  Defaults to 1.0.')
+    plan_args.add_argument('--processes', type=int, default=None, help='Number of processes to count tokens with in --dry-run.  Defaults to the number of CPUs.')
+
+    shard_args = argparse.ArgumentParser(add_help=False)
+    shard_args.add_argument('--shards', type=int, default=0,
+                              help='Run the work in this many worker processes that share a job queue.  The output keeps the original order.  Defaults to 0 (run in this process).')
+    shard_args.add_argument('--shard-worker', action="store_true",
+                              help='Work on the jobs in --job-queue as one worker of a sharded run, e.g. from another machine.')
+    shard_args.add_argument('--job-queue', type=str, default=None,
+                              help="SQLite file holding the jobs of a sharded run.  Defaults to the output file with '.jobs.sqlite' appended.")
+
+    memory_args = argparse.ArgumentParser(add_help=False)
+    memory_args.add_argument('--translation-memory', type=str, default=None,
+                              help='SQLite file of past answers to reuse for inputs that match one already translated with the same model and prompt.  Optional.')
+    memory_args.add_argument('--tm-threshold', type=float, default=0.95,
+                              help='Embedding similarity above which a remembered input counts as a near match.  Defaults to 0.95.')
+    memory_args.add_argument('--tm-reuse-near', action="store_true",
+                              help='Reuse the answers of near matches too, instead of only logging them.')
+
+    batch_args = argparse.ArgumentParser(add_help=False)
+    batch_args.add_argument('--batch', action="store_true",
+                              help="Send every request in one job to the batch API, at half the price, instead of one at a time.  Waits (up to a day) for the answers and writes them in order.")
+    batch_args.add_argument('--batch-backend', type=str, default='openai', choices=['openai', 'local'],
+                              help="Where to send the batch: the OpenAI batch API (or --api-base), or a local stand-in that answers with the math model, for testing.  Defaults to openai.")
+    batch_args.add_argument('--batch-file', type=str, default=None,
+                              help="File to write the batch requests to.  Defaults to the output file with '.batch.jsonl' appended.")
+    batch_args.add_argument('--batch-id', type=str, default=None,
+                              help="Pick up the results of batches already submitted by an earlier run (comma-separated ids, as logged) instead of submitting again.")
+    batch_args.add_argument('--batch-poll', type=float, default=60,
+                              help="Seconds between checks on whether the batch is done.  Defaults to 60.")
+
     # Define argparse parser
     parser = argparse.ArgumentParser(description='Translation tool')
     # Define subcommands
     subparsers = parser.add_subparsers(title='Subcommands')
 
     # Subcommand: promptall
-    parser_promptall = subparsers.add_parser('prompt-all', help='Run a prompt against every line of a file', parents=[common_args, gpt_args, input_args, translation_args])
+    parser_promptall = subparsers.add_parser('prompt-all', help='Run a prompt against every line of a file', parents=[common_args, gpt_args, input_args, translation_args, memory_args, plan_args, shard_args, batch_args])
     parser_promptall.add_argument('-p', '--prompt', type=str, required=True,
                                     help='Filename with a prompt to provide to GPT.')
+    parser_promptall.add_argument('--previous-input', type=str, default=None,
+                                    help='Input of an earlier run.  Lines that are unchanged since then reuse their answers from --previous-output, so only inserted and edited lines are sent to GPT.')
+    parser_promptall.add_argument('--previous-output', type=str, default=None,
+                                    help='Output of the earlier run with --previous-input.')
+    parser_promptall.add_argument('--embedding-workers', type=int, default=0,
+                                    help='Prepare prompts (embeddings, translation memory, templates) in a separate stage with this many workers, ahead of the --workers GPT calls.  Defaults to 0 (each worker does both).')
+    parser_promptall.add_argument('--embedding-batch', type=int, default=16,
+                                    help='Lines embedded with one request in the preparation stage of --embedding-workers.  Defaults to 16.')
     parser_promptall.set_defaults(func=prompt_all)
 
     # Subcommand: prompt-folder
-    parser_prompt_folder = subparsers.add_parser('prompt-folder', help='Run a prompt against every file in a folder', parents=[common_args, gpt_args, translation_args])
+    parser_prompt_folder = subparsers.add_parser('prompt-folder', help='Run a prompt against every file in a folder', parents=[common_args, gpt_args, translation_args, memory_args, plan_args, shard_args, batch_args])
     parser_prompt_folder.add_argument('-p', '--prompt', type=str, required=True,
                                     help='Filename with a prompt to provide to GPT.')
     parser_prompt_folder.add_argument('-i', '--input-dir', type=str, required=True,
                                     help='Input text to count tokens')
+    parser_prompt_folder.add_argument('--schedule', type=str, default='fifo', choices=['fifo', 'largest-first'],
+                                    help='Order in which files are processed.  Defaults to fifo.')
+    parser_prompt_folder.add_argument('--chunk-tokens', type=int, default=0,
+                                    help='Split files bigger than this many tokens into chunks on paragraph boundaries and run them in parallel.  Defaults to 0, which sends each file whole.')
     parser_prompt_folder.set_defaults(func=prompt_folder)
 
     # Subcommand: mapreduce
-    parser_prompt_folder = subparsers.add_parser('map-reduce', help='Run a prompt against every file in a folder', parents=[common_args, gpt_args, translation_args])
+    parser_prompt_folder = subparsers.add_parser('map-reduce', help='Run a prompt against every file in a folder', parents=[common_args, gpt_args, translation_args, plan_args])
     parser_prompt_folder.add_argument('-p', '--map-prompt', type=str, required=True,
                                     help='Filename with a prompt to provide to GPT for mapping.')
     parser_prompt_folder.add_argument('-r', '--reduce-prompt', type=str, required=True,
                                     help='Filename with a prompt to provide to GPT for reducing/summarizing.')
     parser_prompt_folder.add_argument('-i', '--input-dir', type=str, required=True,
                                     help='Input text to count tokens')
+    parser_prompt_folder.add_argument('--schedule', type=str, default='fifo', choices=['fifo', 'largest-first'],
+                                    help='Order in which files are mapped.  Reduce jobs always run before map jobs.  Defaults to fifo.')
+    parser_prompt_folder.add_argument('--reduce-tokens', type=int, default=3000,
+                                    help='Token budget for one reduce request; larger outputs are reduced in chunks and then combined.  Defaults to 3000.')
+    parser_prompt_folder.add_argument('--map-store', type=str, default=None,
+                                    help='SQLite file in which to keep map outputs, so that re-runs only redo the maps that changed.  Optional.')
     parser_prompt_folder.set_defaults(func=map_reduce)
 
     # Subcommand: counttokens
     parser_counttokens = subparsers.add_parser('counttokens', help='Count tokens in text', parents=[common_args, gpt_args, input_args])
+    parser_counttokens.add_argument('--per-line', action="store_true",
+                                    help='Count each line separately and report percentiles and a histogram.  Implied when -i is a directory.')
+    parser_counttokens.add_argument('--processes', type=int, default=None,
+                                    help='Number of processes to count with.  Defaults to the number of CPUs.')
     parser_counttokens.set_defaults(func=count_tokens)
 
     # Subcommand: prompt
     parser_prompt = subparsers.add_parser('prompt', help='Run GPT on one input', parents=[common_args, gpt_args, input_args])
+    parser_prompt.add_argument('--stream', action="store_true", help="Print the answer as it arrives.")
     parser_prompt.set_defaults(func=prompt_one)
 
     # Subcommand: download-csv
@@ -112,13 +195,47 @@ def main():
     # Subcommand: chat
     parser_chat = subparsers.add_parser('chat', help='Chat with GPT', parents=[common_args, gpt_args])
     parser_chat.add_argument('-p', '--prompt', type=str, help="System prompt for chat.", default="You are a helpful assistant.")
+    parser_chat.add_argument('--stream', action="store_true", help="Print answers as they arrive.")
+    parser_chat.add_argument('--history-tokens', type=int, default=0,
+                             help="Token budget for the conversation sent with each message; older turns are dropped.  Defaults to 0, which sends the whole conversation.")
+    parser_chat.add_argument('--summarize-history', action="store_true",
+                             help="Summarize turns dropped from the history instead of forgetting them.  Needs --history-tokens.")
     parser_chat.set_defaults(func=chat)
 
     # Subcommand: compute-embeddings
-    embeddings = subparsers.add_parser('compute-embeddings', help='Get an embedding for each line of a file', parents=[common_args, gpt_args, input_args])
+    embeddings = subparsers.add_parser('compute-embeddings', help='Get an embedding for each line of a file', parents=[common_args, gpt_args, input_args, batch_args])
     embeddings.set_defaults(func=compute_embeddings)
 
+    # Subcommand: mock-server
+    parser_mock_server = subparsers.add_parser('mock-server', help='Run a local stand-in for the OpenAI API, for testing with --api-base', parents=[common_args])
+    parser_mock_server.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on.  Defaults to 127.0.0.1.')
+    parser_mock_server.add_argument('--port', type=int, default=8000, help='Port to listen on.  Defaults to 8000.')
+    parser_mock_server.add_argument('--responder', type=str, default='math', choices=['math', 'echo'],
+                                    help='How to answer: evaluate the last message like the math model, or echo it back.  Defaults to math.')
+    parser_mock_server.add_argument('--latency', type=float, default=0.5, help='Mean seconds before answering.  Defaults to 0.5.')
+    parser_mock_server.add_argument('--latency-distribution', type=str, default='lognormal', choices=['fixed', 'uniform', 'exponential', 'lognormal'],
+                                    help='Distribution of the latency around --latency.  Defaults to lognormal.')
+    parser_mock_server.add_argument('--latency-sigma', type=float, default=0.5, help='Spread of the lognormal latency distribution.  Defaults to 0.5.')
+    parser_mock_server.add_argument('--latency-per-token', type=float, default=0.0, help='Extra seconds per completion token.  Defaults to 0.')
+    parser_mock_server.add_argument('--concurrency', type=int, default=None, help='Requests answered at once; the rest wait.  Optional, defaults to no limit.')
+    parser_mock_server.add_argument('--rpm', type=int, default=None, help='Requests per minute before answering 429.  Optional, defaults to no limit.')
+    parser_mock_server.add_argument('--tpm', type=int, default=None, help='Prompt tokens per minute before answering 429.  Optional, defaults to no limit.')
+    parser_mock_server.add_argument('--error-429', type=float, default=0.0, help='Fraction of requests answered with a 429 rate limit error.  Defaults to 0.')
+    parser_mock_server.add_argument('--error-500', type=float, default=0.0, help='Fraction of requests answered with a 500 server error.  Defaults to 0.')
+    parser_mock_server.add_argument('--seed', type=int, default=0, help='Random seed for the latencies and injected errors.  Defaults to 0.')
+    parser_mock_server.set_defaults(func=mock_server)
+
+    # Subcommand: serve
+    parser_serve = subparsers.add_parser('serve', help='Keep running and take prompt-all, prompt-folder and map-reduce jobs from ./submit.py', parents=[common_args])
+    parser_serve.add_argument('--socket', type=str, default=None,
+                              help='Unix socket to listen on.  Defaults to gpt-translation-tools-<uid>.sock in the temporary directory.')
+    parser_serve.set_defaults(func=serve, job_parser=parser)
+
+    return parser
+
+def main():
     # Parse arguments
+    parser = build_parser()
     args = parser.parse_args()
     asyncio.run(start(args, parser))
 
@@ -137,7 +254,27 @@ async def start(args, parser):
             logger.log(f"Starting at {starttime.strftime('%B %d %Y %I:%M %p')}")
             logger.log("")
 
-            await args.func(args, logger)
+            profiler = Profiler(args, logger) if args.profile else None
+            if profiler:
+                profiler.start()
+            reporter = MetricsReporter(args, logger) if args.metrics_interval or args.metrics_port else None
+            if reporter:
+                await reporter.start()
+            if args.trace:
+                tracer.start(args.trace)
+            try:
+                await args.func(args, logger)
+            finally:
+                if args.trace:
+                    tracer.stop()
+                    logger.log(f"[trace] wrote {args.trace}")
+                if reporter:
+                    await reporter.stop()
+                if profiler:
+                    profiler.stop()
+        except asyncio.CancelledError:
+            logger.log("Interrupted; shut down before finishing.")
+            raise
         except Exception as e:
             logger.fatal_error(e)
     else: